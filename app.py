@@ -1,17 +1,70 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_cors import CORS
 import requests
+import hashlib
 import json
 import re
 import traceback
 import logging
+import os
+import random
+import threading
+import time
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from ollama_client import OllamaClient, OllamaOverloadedError
+from candidate_ranking import rank_candidates
+from conversation_memory import ConversationStateStore, RollingSummaryCache, message_fingerprint
+from early_stop import EarlyStopMonitor, close_early, stop_reason
+from feedback_batch import BatchFeedbackRunner, batch_record_id, parse_batch_concurrency, parse_batch_records
+from feedback_jobs import FeedbackJobManager
+from model_warmup import ModelWarmer
+from feedback_parser import FEEDBACK_JSON_SCHEMA, SCORE_CATEGORIES, TURN_ASSESSMENT_SCHEMA, StructuredFeedbackStream, parse_feedback_text, parse_turn_assessment
+from incremental_feedback import TurnAssessmentCache, merge_turn_assessments
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY as METRICS_REGISTRY, GaugeCallback, INCREMENTAL_FEEDBACK, TOKENS_SAVED, current_labels, observe_admission_wait, observe_prompt_tokens, observe_request, observe_stage, record_aborted_generation, record_early_stop, record_ollama_response, server_timing_header, stage
+from prompt_budget import TokenCounter, pack_history, token_report
+import request_deadline
+from reply_postprocess import PROFILES as POST_PROCESSING_PROFILES, StreamingPostProcessor
+from request_logging import RequestLogSampler, configure_logging, current_timings, dropped_log_records, note_request, request_field
+from response_cache import ResponseCache, make_cache_key
+from session_store import SessionNotFoundError, create_session_store, new_session, trim_session_messages
+from single_flight import SingleFlight, coalescing_key
 
 app = Flask(__name__)
 CORS(app)
 
 class AppConfig:
-    OLLAMA_BASE_API_URL = "http://localhost:11434"
+    OLLAMA_BASE_API_URL = os.environ.get("OLLAMA_BASE_API_URL", "http://localhost:11434")
+    # 多個 Ollama 後端以逗號分隔；未設定時只使用 OLLAMA_BASE_API_URL
+    OLLAMA_BACKEND_URLS = [url.strip() for url in os.environ.get("OLLAMA_BACKEND_URLS", OLLAMA_BASE_API_URL).split(",") if url.strip()]
+    OLLAMA_ROUTER_OPTIONS = {
+        "affinity_slack": 2, # 親和節點最多可比最空閒節點多幾個進行中請求，超過就改走最空閒節點
+        "max_failures": 3, # 連續失敗幾次後暫時剔除該節點
+        "eject_seconds": 30.0,
+    }
+    OLLAMA_POOL_MAXSIZE = int(os.environ.get("OLLAMA_POOL_MAXSIZE", 16)) # 連線池上限 (keep-alive 重用)
+    OLLAMA_MAX_IN_FLIGHT_PER_MODEL = int(os.environ.get("OLLAMA_MAX_IN_FLIGHT_PER_MODEL", 4)) # 每個模型同時進行中的生成數上限
+    OLLAMA_MAX_QUEUED_PER_MODEL = int(os.environ.get("OLLAMA_MAX_QUEUED_PER_MODEL", 16)) # 超過此排隊數直接回 503
+    OLLAMA_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("OLLAMA_QUEUE_TIMEOUT_SECONDS", 30)) # 排隊超過此秒數回 503，而不是等到 120 秒讀取逾時
+    OLLAMA_MAX_QUEUED_PER_USER = int(os.environ.get("OLLAMA_MAX_QUEUED_PER_USER", 4)) # 同一使用者 (X-User-ID 或來源 IP) 最多同時排隊幾個請求
+    OLLAMA_SCHEDULING = { # 排隊中的請求依類別權重、使用者公平與預估工作量 (短工作優先) 取得空出的名額，見 ollama_client.AdmissionQueue
+        "class_weights": {"character_play": 4, "assistant": 2, "feedback": 1},
+        # 回饋評估 (num_predict 1500) 最多佔一半名額，保留其餘給互動聊天
+        "class_max_in_flight": {"feedback": max(1, int(os.environ.get("OLLAMA_FEEDBACK_MAX_IN_FLIGHT", OLLAMA_MAX_IN_FLIGHT_PER_MODEL // 2)))},
+        "class_aliases": {"summary": "feedback", "feedback_turn": "feedback"}, # 背景摘要、逐輪評估與回饋同屬批次工作
+        "default_class": "assistant",
+        "aging_seconds": 10.0, # 每多等這麼久，預估工作量的排序權重就打一次折，長工作不會一直被插隊
+    }
+    PROMPT_TOKEN_COST = 0.1 # 預估工作量時，評估一個 prompt token 約等於生成 0.1 個 token 的時間
+    OLLAMA_RETRY_AFTER_SECONDS = int(os.environ.get("OLLAMA_RETRY_AFTER_SECONDS", 5))
+    REQUEST_TIMEOUT_HEADER = "X-Request-Timeout-Ms" # 用戶端剩餘的等待時間 (毫秒)；超過期限或用戶端斷線時中止進行中的生成
+    REQUEST_DEADLINE_MARGIN_SECONDS = 1.0 # 期限扣掉回應傳回用戶端的時間
+    REQUEST_MAX_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_MAX_TIMEOUT_SECONDS", 600))
+    ABORT_ON_CLIENT_DISCONNECT = os.environ.get("ABORT_ON_CLIENT_DISCONNECT", "1") == "1"
+    DEADLINE_MIN_NUM_PREDICT = 24 # 剩餘時間預估連這麼多 token 都生成不了時，不送出請求直接回 504
+    OLLAMA_COALESCE_REQUESTS = os.environ.get("OLLAMA_COALESCE_REQUESTS", "1") == "1" # 完全相同的 payload 同時進來時只生成一次 (重複點擊、前端逾時重送)
 
     LINE_STYLE_INSTRUCTION_TAIWAN_UNI = """### **[輸出風格：台灣大學生 LINE/IG 私訊風格 - 絕對規則] (MUST FOLLOW RULES FOR YOUR REPLY):**
 *   **核心要求 (Core Requirement)**: 你的回覆必須 100% 模仿台灣大學生用 LINE 或 IG 私訊聊天。輸出**應簡潔明瞭**，**保持語義連貫性，並自然地承接上下文。**
@@ -27,8 +80,58 @@ class AppConfig:
     *   (使用者說：週末要不要出去玩？) 你回覆：\n好啊\n想去哪\n我都可以
     *   (使用者說：上次你說的那部電影好好看喔) 你回覆：\n真的齁\n我就說很讚啊\n那你還有想看什麼嗎
 """
-    # 此處保留上次的修改，即允許逗號和句號通過後處理
-    POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE = "、；：「」『』（）《》\"'();:"
+    OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m") # 讓模型與其 KV cache 常駐，避免閒置卸載後重新載入
+    MODEL_WARMUP_ENABLED = os.environ.get("MODEL_WARMUP", "1") == "1" # 啟動時預載模型並預熱共用的系統 prompt 前綴，完成前 /readyz 回 503
+    MODEL_HEARTBEAT_SECONDS = float(os.environ.get("MODEL_HEARTBEAT_SECONDS", 600)) # keep_alive 心跳間隔，須短於 OLLAMA_KEEP_ALIVE
+    MODEL_WARMUP_RETRY_SECONDS = 15.0 # 預熱失敗 (Ollama 還沒起來) 後多久重試
+    MODEL_WARMUP_TIMEOUT = (25, 300) # 冷啟動載入 GGUF 可能遠超過一般請求的讀取逾時
+    OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", 4096)) # 每個請求都帶同一個 num_ctx (值不同會讓 Ollama 重新載入模型)；0 代表沿用 Modelfile 的設定
+    CHAT_MODES = ("character_play", "assistant") # /api/chat_py 接受的 mode；其餘一律回 400
+    PROMPT_TOKEN_BUDGETS = {"character_play": 2048, "assistant": 2048, "feedback": 2400} # 各模式 prompt 的 token 上限，另受 OLLAMA_NUM_CTX - num_predict 限制
+    PROMPT_TOKEN_MARGIN = 32 # 片段分開計數與整段 tokenize 的誤差
+    PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "estimate") # "ollama" 以 /api/tokenize 精確計數 (失敗時退回估計)；"estimate" 只用本地估計
+    CHAT_HISTORY_COMPACTION_STEP = 4 # 歷史視窗起點每累積 4 則新訊息才往前跳一次，其餘時間只往後附加
+
+    SESSION_STORE_BACKEND = os.environ.get("SESSION_STORE_BACKEND", "memory") # "memory" 或 "sqlite"
+    SESSION_SQLITE_PATH = os.environ.get("SESSION_SQLITE_PATH", "wingchat_sessions.db")
+    SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", 1000)) # 記憶體後端的 LRU 上限
+    SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", 6 * 3600))
+    SESSION_MAX_MESSAGES = 40 # 每個 session 保留的訊息數 (回饋評估也從這裡取)
+    SESSION_REUSE_OLLAMA_CONTEXT = False # 角色扮演模式下，以 Ollama 回傳的 context 接續上一輪，只送出本輪新增的訊息
+
+    CONVERSATION_SUMMARY_ENABLED = True # 超出歷史視窗的舊訊息在背景增量摘要，放在最近視窗之前
+    CONVERSATION_SUMMARY_FEEDBACK_WAIT_SECONDS = 30 # 回饋評估時最多等待摘要追上的秒數
+    CONVERSATION_SUMMARY_CONFIG = {
+        "name": "my-custom-llama3:latest",
+        "system_prompt": "你是一位對話記錄員。請把對話濃縮成精簡的摘要 (繁體中文，不超過 150 字)，保留雙方提到的重要事實、話題、約定與情緒變化，讓之後能自然地接續對話。只輸出摘要本身，不要有任何前綴或說明。",
+        "ollama_options": {
+            "temperature": 0.2,
+            "top_p": 0.5,
+            "num_predict": 200
+        }
+    }
+
+    RESPONSE_CACHE_MODES = ("assistant",) # 輸出只取決於 prompt 與固定 options 的模式才快取
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600))
+    RESPONSE_CACHE_SQLITE_PATH = os.environ.get("RESPONSE_CACHE_SQLITE_PATH") # 設定後啟用持久層
+
+    FEEDBACK_JOB_MAX_WORKERS = int(os.environ.get("FEEDBACK_JOB_MAX_WORKERS", 2)) # 非同步回饋評估同時執行的工作數
+    FEEDBACK_JOB_MAX_QUEUED = int(os.environ.get("FEEDBACK_JOB_MAX_QUEUED", 32)) # 超過此排隊數直接回 503
+    FEEDBACK_JOB_RETENTION_SECONDS = float(os.environ.get("FEEDBACK_JOB_RETENTION_SECONDS", 600)) # 完成的結果保留多久供輪詢取回
+    FEEDBACK_JOB_MAX_POLL_WAIT_SECONDS = 30 # 長輪詢 ?wait= 的上限
+    FEEDBACK_JOB_CALLBACK_TIMEOUT_SECONDS = 10
+    FEEDBACK_JOB_SQLITE_PATH = os.environ.get("FEEDBACK_JOB_SQLITE_PATH") # 設定後工作狀態存在 SQLite，多個 worker 行程共用 (serve.py 多 worker 時預設啟用)
+    FEEDBACK_BATCH_MAX_CONCURRENCY = int(os.environ.get("FEEDBACK_BATCH_MAX_CONCURRENCY", 8)) # /api/feedback/batch 每個請求同時評估的上限
+
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper() # DEBUG 才會輸出完整 prompt / 回覆
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "text") # "text" 或 "json" (一行一個 JSON 物件)
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000)) # log 佇列上限，滿了就丟棄，不讓請求等待寫出
+    REQUEST_LOG_SAMPLE_RATE = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", 0.1)) # 每個請求摘要紀錄的取樣率
+    REQUEST_LOG_SLOW_MS = float(os.environ.get("REQUEST_LOG_SLOW_MS", 5000)) # 超過此耗時的請求與 5xx 一律記錄
+    SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "0") == "1" # 在回應加上 Server-Timing 標頭 (各階段耗時，瀏覽器 DevTools 可直接顯示)
+
+    POST_PROCESS_PROFILE = "line_style" # reply_postprocess.PROFILES 中的名稱；line_style 允許逗號和句號通過後處理
 
     CHAT_MODEL_CONFIG = {
         "name": "my-custom-llama3:latest",
@@ -40,6 +143,11 @@ class AppConfig:
             "stop": ["<|eot_id|>", "<|end_of_text|>", "user:", "assistant:", "User:", "Assistant:", "\n\n\n", "Human:", "System:"]
         }
     }
+    CHAT_MAX_CANDIDATES = 5 # 助手模式一次請求最多生成幾個候選建議 ("candidates": N)
+    CHAT_CANDIDATE_TEMPERATURES = (0.4, 0.7, 0.9, 0.55, 1.0) # 第 i 個候選的 temperature (第一個與單一回覆相同)，搭配不同 seed
+    CHAT_CANDIDATE_OVERLAP_MESSAGES = 10 # 候選排序時與最近幾則訊息比較重複程度
+    CHAT_EARLY_STOP = os.environ.get("CHAT_EARLY_STOP", "1") == "1" # 聊天回覆一律向 Ollama 串流取回，湊滿行數、開始重複或解說時立即中止生成
+    CHAT_EARLY_STOP_MAX_LINES = int(os.environ.get("CHAT_EARLY_STOP_MAX_LINES", "5")) # 風格規則要求 2~5 則短訊息
     USER_FEEDBACK_MODEL_CONFIG = {
         "name": "my-custom-llama3:latest",
         "base_system_prompt_template": """你是一位專業的社交技能教練與評估員。
@@ -64,77 +172,326 @@ AI 聊天夥伴的角色是：「{character_name}」(描述：「{character_desc
 4. 給使用者的具體改進建議 (條列式，1-3點，每點15-30字，提供可操作建議):
     - [改進建議 1]
     - [改進建議 2，若無則填「無明顯其他改進空間」]""",
+        # 結構化模式：輸出受 FEEDBACK_JSON_SCHEMA 限制，欄位名稱與格式由 schema 決定，這裡只說明內容要求
+        "user_feedback_json_instruction_template": """現在，請以 JSON 物件提供對 User 的評估 (所有文字內容使用繁體中文)，不要有任何其他文字。
+* summary: 使用者整體表現總結，50-100字。
+* scores: clarity (表達清晰度)、empathy (同理心展現)、confidence (自信程度)、appropriateness (言談適當性)、goalAchievement (目標達成技巧) 五項，每項包含 score (0-100 的整數) 與 justification (具體理由，20-50字)。若無明確目標，goalAchievement 請評估對話推進或互動有效性並給予分數。
+* strengths: 使用者本次對話的優點，1-3點，每點15-30字。
+* improvements: 給使用者的具體改進建議，1-3點，每點15-30字，提供可操作建議。""",
         "ollama_options": { 
             "temperature": 0.1, 
             "top_p": 0.4,
             "num_predict": 1500 
         }
     }
-    POST_PROCESS_PREFIX_PATTERN = re.compile(
-        r'^\s*(?:好的[,，]?這是我(?:的|建議的)回覆：|你可以(?:這麼|這樣)說：|我建議你回覆：|(?:Okay|Ok|Alright|Sure)[,.]?\s*(?:here(?: is|\'s)\s*(?:a|my|the)?\s*(?:suggestion|reply)|I suggest|you could say)[:：]?|話翼|AI|Assistant|模型|回答|建議|助手|WingChat)\s*[:：]?\s*',
-        re.IGNORECASE | re.DOTALL
-    )
-    POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE = "、；：「」『』（）《》\"'();:"
+    USER_FEEDBACK_STRUCTURED_OUTPUT = os.environ.get("USER_FEEDBACK_STRUCTURED_OUTPUT", "1") == "1" # 以 Ollama format (JSON schema) 產生回饋，不必再用 regex 解析自由文字
+    FEEDBACK_INCREMENTAL_ENABLED = os.environ.get("FEEDBACK_INCREMENTAL", "1") == "1" # 角色扮演的每一輪在背景評估使用者的新發言，回饋時只合併並生成總結
+    FEEDBACK_INCREMENTAL_WAIT_SECONDS = float(os.environ.get("FEEDBACK_INCREMENTAL_WAIT_SECONDS", 20)) # 回饋時最多等待逐輪評估追上的秒數，逾時改做完整評估
+    FEEDBACK_INCREMENTAL_MAX_WORKERS = int(os.environ.get("FEEDBACK_INCREMENTAL_MAX_WORKERS", 2)) # 同時進行的逐輪評估數 (仍受 feedback 類別的名額限制)
+    FEEDBACK_INCREMENTAL_CONTEXT_MESSAGES = 4 # 逐輪評估附上新發言之前的幾則訊息作為上下文
+    CONVERSATION_STATE_SQLITE_PATH = os.environ.get("CONVERSATION_STATE_SQLITE_PATH") # 設定後滾動摘要與逐輪評估存在 SQLite，多個 worker 行程共用 (serve.py 多 worker 時預設啟用)
+    FEEDBACK_TURN_ASSESSMENT_CONFIG = {
+        "name": "my-custom-llama3:latest",
+        # system prompt 沿用 USER_FEEDBACK_MODEL_CONFIG 的 base_system_prompt_template
+        "instruction_template": """以上「先前的對話」只是上下文，請只評估「本輪對話」中 User 的發言，以 JSON 物件回答 (文字內容使用繁體中文)，不要有任何其他文字。
+* scores: clarity (表達清晰度)、empathy (同理心展現)、confidence (自信程度)、appropriateness (言談適當性)、goalAchievement (目標達成技巧) 五項，每項包含 score (0-100 的整數) 與 justification (針對本輪發言的理由，10-30字)。
+* strengths: 本輪發言的優點，0-2點，每點15-30字，沒有就給空陣列。
+* improvements: 本輪發言可以改進的地方，0-2點，每點15-30字，提供可操作建議，沒有就給空陣列。""",
+        "ollama_options": {
+            "temperature": 0.1,
+            "top_p": 0.4,
+            "num_predict": 400
+        }
+    }
+    FEEDBACK_MERGED_SUMMARY_CONFIG = {
+        "name": "my-custom-llama3:latest",
+        "instruction_template": """以下是對話進行中逐輪評估 User 的結果 (已合併)：
+{assessment}
+請根據這些評估，用繁體中文寫一段 50-100 字的使用者整體表現總結。只輸出總結本身，不要有任何前綴或說明。""",
+        "ollama_options": {
+            "temperature": 0.2,
+            "top_p": 0.5,
+            "num_predict": 200
+        }
+    }
 
 cfg = AppConfig()
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', force=True)
+configure_logging(cfg.LOG_LEVEL, cfg.LOG_FORMAT, cfg.LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
-if not app.debug: logger.setLevel(logging.INFO)
-else: logger.setLevel(logging.DEBUG)
+request_log = RequestLogSampler(logging.getLogger("wingchat.requests"), cfg.REQUEST_LOG_SAMPLE_RATE, cfg.REQUEST_LOG_SLOW_MS, on_finish=observe_request)
 
-def call_ollama_api(endpoint_path, payload, model_name_for_log, timeout=(25, 120)):
-    ollama_url = f"{cfg.OLLAMA_BASE_API_URL}{endpoint_path}"
-    try:
-        logger.info(f"Sending request to Ollama ({ollama_url}), Model: {model_name_for_log}")
-        logger.debug(f"Ollama Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-        response = requests.post(ollama_url, json=payload, timeout=timeout)
+POST_PROCESS_PROFILE = POST_PROCESSING_PROFILES[cfg.POST_PROCESS_PROFILE]
+response_cache = ResponseCache(cfg.RESPONSE_CACHE_MAX_BYTES, cfg.RESPONSE_CACHE_TTL_SECONDS, cfg.RESPONSE_CACHE_SQLITE_PATH)
+session_store = create_session_store(cfg.SESSION_STORE_BACKEND, cfg.SESSION_SQLITE_PATH, cfg.SESSION_MAX_SESSIONS, cfg.SESSION_TTL_SECONDS)
+ollama_client = OllamaClient(cfg.OLLAMA_BACKEND_URLS, pool_maxsize=cfg.OLLAMA_POOL_MAXSIZE,
+                             max_in_flight_per_model=cfg.OLLAMA_MAX_IN_FLIGHT_PER_MODEL, max_waiting_per_model=cfg.OLLAMA_MAX_QUEUED_PER_MODEL,
+                             queue_timeout=cfg.OLLAMA_QUEUE_TIMEOUT_SECONDS, retry_after=cfg.OLLAMA_RETRY_AFTER_SECONDS,
+                             router_options=cfg.OLLAMA_ROUTER_OPTIONS, scheduling=cfg.OLLAMA_SCHEDULING, max_waiting_per_user=cfg.OLLAMA_MAX_QUEUED_PER_USER)
+admission_limiters = [ollama_client.limiter] # async_app 會加入它自己的 limiter，/metrics 的排隊指標才包含兩者
+ollama_single_flight = SingleFlight()
+candidate_executor = ThreadPoolExecutor(max_workers=cfg.CHAT_MAX_CANDIDATES * cfg.OLLAMA_MAX_IN_FLIGHT_PER_MODEL, thread_name_prefix="reply-candidates")
+generation_rates = request_deadline.GenerationRateEstimator()
+
+def ollama_tokenize(model, text):
+    with ollama_client.post("/api/tokenize", {"model": model, "content": text}, timeout=(2, 5)) as response:
         response.raise_for_status()
-        response_data = response.json()
+        return len(response.json()["tokens"])
+
+token_counter = TokenCounter(ollama_tokenize if cfg.PROMPT_TOKENIZER == "ollama" else None)
+
+@app.before_request
+def start_request_log():
+    g.request_id = request_log.start(request.headers.get("X-Request-ID"))
+    note_request(user=request_user_key(request.headers, request.remote_addr))
+    client_socket = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    request_deadline.start(request_deadline.parse_timeout_header(request.headers.get(cfg.REQUEST_TIMEOUT_HEADER), cfg.REQUEST_DEADLINE_MARGIN_SECONDS, cfg.REQUEST_MAX_TIMEOUT_SECONDS),
+                           disconnect_check=request_deadline.socket_disconnect_check(client_socket) if cfg.ABORT_ON_CLIENT_DISCONNECT and client_socket is not None else None)
+
+@app.after_request
+def tag_request_id(response):
+    response.headers["X-Request-ID"] = g.request_id
+    note_request(method=request.method, path=request.path, route=request.url_rule.rule if request.url_rule else "unmatched", status=response.status_code)
+    # 串流回應的標頭在生成前就送出，只會包含到此為止的階段 (驗證、組 prompt)
+    if cfg.SERVER_TIMING_ENABLED and current_timings(): response.headers["Server-Timing"] = server_timing_header(current_timings())
+    if response.is_streamed:
+        # 串流結束時才輸出摘要，耗時才包含整段生成
+        response.response = request_log.wrap_stream(response.response)
+        g.request_log_streaming = True
+    return response
+
+@app.teardown_request
+def finish_request_log(_error=None):
+    # 串流回應的期限與斷線檢查要留給之後才開始讀取的 body (wrap_stream 會帶著目前的 contextvars)
+    if g.pop("request_log_streaming", False): return
+    request_deadline.finish()
+    request_log.finish(**({"status": 500, "error": str(_error)} if _error is not None else {}))
+
+def request_user_key(headers, remote_addr):
+    """排程的每使用者公平以此為單位：前端帶 X-User-ID 時用它，否則用來源 IP。"""
+    return headers.get("X-User-ID") or remote_addr or "-"
+
+def admission_options(payload, mode):
+    """limiter.slot 的排程參數：請求類別、使用者與預估工作量 (num_predict + 折算後的 prompt 長度)。"""
+    options = payload.get("options") or {}
+    prompt_chars = len(payload.get("prompt") or "") + sum(len(message.get("content", "")) for message in payload.get("messages", []))
+    cost = (options.get("num_predict") or 128) + prompt_chars / prompt_cache_tracker.default_chars_per_token * cfg.PROMPT_TOKEN_COST
+    return {"request_class": mode or request_field("mode"), "user": request_field("user"), "cost": cost}
+
+def _raise_ollama_request_error(e, ollama_url, payload, model_name_for_log):
+    logger.error(f"Error during Ollama API request ({model_name_for_log}) to {ollama_url}: {e}")
+    error_detail_str = ""
+    if e.response is not None:
+        try:
+            error_detail = e.response.json(); error_detail_str = json.dumps(error_detail)
+            model_name_in_payload = payload.get('model', 'N/A')
+            if "model not found" in error_detail_str.lower() or \
+               (isinstance(error_detail.get("error"), str) and "model" in error_detail.get("error").lower() and "not found" in error_detail.get("error").lower()):
+                logger.error(f"Ollama error: Model '{model_name_in_payload}' not found.")
+                raise Exception(f"Ollama API 錯誤: 模型 '{model_name_in_payload}' 未找到。")
+            logger.error(f"Ollama error details (JSON): {error_detail_str}")
+        except json.JSONDecodeError: error_detail_str = e.response.text; logger.error(f"Ollama error details (Non-JSON): {error_detail_str}")
+    raise Exception(f"Ollama API ({model_name_for_log}) 請求錯誤: {e} - Details: {error_detail_str}")
+
+def call_ollama_api(endpoint_path, payload, model_name_for_log, timeout=(25, 120), affinity_key=None, mode=None, monitor=None):
+    """mode 只用於指標的 label；背景摘要等不在請求內的呼叫要自己帶。
+    相同 payload 的請求正在生成時直接等它的結果 (OLLAMA_COALESCE_REQUESTS)。
+    請求帶有期限 (X-Request-Timeout-Ms) 時改以串流向 Ollama 取回，才能在逾期或用戶端放棄時中途停止生成。
+    帶 monitor (EarlyStopMonitor) 時同樣以串流取回，monitor 回報停止原因就中止生成並回傳已接受的行。
+    只有斷線檢查 (每個 Flask 請求都有) 時仍走連線池的非串流請求與合併，送出前檢查一次用戶端是否已離開。"""
+    if monitor is not None or request_deadline.current_deadline() is not None:
+        return _collect_ollama_stream(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode, monitor)
+    try:
+        request_deadline.raise_if_abandoned("dispatch")
+    except request_deadline.RequestAbandonedError as e:
+        record_aborted_generation(f"{e.reason}_before_dispatch", payload.get("model", model_name_for_log), mode, (payload.get("options") or {}).get("num_predict"))
+        raise
+    call = lambda: _call_ollama_api(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode)
+    if not cfg.OLLAMA_COALESCE_REQUESTS: return call()
+    (generated_text, response_data), shared = ollama_single_flight.do(coalescing_key(endpoint_path, payload), call)
+    if not shared: return generated_text, response_data
+    logger.info("Coalesced with an in-flight identical Ollama request (Model: %s)", model_name_for_log)
+    note_request(coalesced=True)
+    return generated_text, dict(response_data)
+
+def _call_ollama_api(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode):
+    ollama_url = f"[{', '.join(cfg.OLLAMA_BACKEND_URLS)}]{endpoint_path}"
+    model = payload.get("model", model_name_for_log)
+    try:
+        logger.info("Sending request to Ollama (%s), Model: %s, Affinity: %s", endpoint_path, model_name_for_log, affinity_key)
+        if logger.isEnabledFor(logging.DEBUG): logger.debug("Ollama Payload: %s", json.dumps(payload, ensure_ascii=False, indent=2))
+        started = time.perf_counter()
+        with ollama_client.limiter.slot(model, **admission_options(payload, mode)) as ticket:
+            observe_stage("queue_wait", time.perf_counter() - started, model, mode)
+            observe_admission_wait(model, ticket)
+            started = time.perf_counter()
+            with ollama_client.post(endpoint_path, payload, timeout=timeout, affinity_key=affinity_key) as response:
+                ollama_url = f"{response.ollama_backend_url}{endpoint_path}"
+                response.raise_for_status()
+                response_data = response.json()
+            observe_stage("ollama_http", time.perf_counter() - started, model, mode)
+        record_ollama_response(response_data, model, mode)
+        generation_rates.observe(model, response_data)
+        note_request(model=model, backend=response.ollama_backend_url,
+                     prompt_eval_count=response_data.get("prompt_eval_count"), eval_count=response_data.get("eval_count"))
         generated_text = ""
         if endpoint_path == "/api/generate": generated_text = response_data.get("response", "").strip()
         elif endpoint_path == "/api/chat": generated_text = response_data.get("message", {}).get("content", "").strip()
-        logger.info(f"Ollama raw response (Model {model_name_for_log}): {repr(generated_text)[:500]}...")
+        if logger.isEnabledFor(logging.DEBUG): logger.debug("Ollama raw response (Model %s): %s", model_name_for_log, repr(generated_text)[:500])
         return generated_text, response_data
     except requests.exceptions.Timeout:
         logger.error(f"Timeout error calling Ollama API ({model_name_for_log}) at {ollama_url}")
         raise Exception(f"Ollama API ({model_name_for_log}) 超時")
     except requests.exceptions.ConnectionError as e:
         logger.error(f"Connection error calling Ollama API ({model_name_for_log}) at {ollama_url}: {e}")
-        raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {cfg.OLLAMA_BASE_API_URL}")
+        raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {', '.join(cfg.OLLAMA_BACKEND_URLS)}")
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error during Ollama API request ({model_name_for_log}) to {ollama_url}: {e}")
-        error_detail_str = ""
-        if e.response is not None:
-            try:
-                error_detail = e.response.json(); error_detail_str = json.dumps(error_detail)
-                model_name_in_payload = payload.get('model', 'N/A')
-                if "model not found" in error_detail_str.lower() or \
-                   (isinstance(error_detail.get("error"), str) and "model" in error_detail.get("error").lower() and "not found" in error_detail.get("error").lower()):
-                    logger.error(f"Ollama error: Model '{model_name_in_payload}' not found.")
-                    raise Exception(f"Ollama API 錯誤: 模型 '{model_name_in_payload}' 未找到。")
-                logger.error(f"Ollama error details (JSON): {error_detail_str}")
-            except json.JSONDecodeError: error_detail_str = e.response.text; logger.error(f"Ollama error details (Non-JSON): {error_detail_str}")
-        raise Exception(f"Ollama API ({model_name_for_log}) 請求錯誤: {e} - Details: {error_detail_str}")
+        _raise_ollama_request_error(e, ollama_url, payload, model_name_for_log)
+    except OllamaOverloadedError:
+        logger.warning(f"Ollama request rejected by concurrency limiter ({model_name_for_log})")
+        raise
     except Exception as e:
         logger.error(f"Unexpected error during Ollama communication (Model {model_name_for_log}): {e}\n{traceback.format_exc()}")
         raise Exception(f"與 Ollama API ({model_name_for_log}) 通訊時發生未知內部錯誤: {e}")
 
-def create_chat_prompt_for_ollama(goal, messages, character_info, mode):
-    history_limit = 10 # <--- 將歷史訊息限制增加到 10 條，即 5 輪對話
-    relevant_messages = messages[-history_limit:]
-    logger.debug(f"Using last {len(relevant_messages)} of {len(messages)} messages for context (limit was {history_limit}).")
+def _collect_ollama_stream(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode, monitor=None):
+    """把串流片段組回與非串流相同的 (generated_text, response_data)；每個片段之間檢查期限與斷線。"""
+    text_chunks, response_data = [], {}
+    chunks = request_deadline.guard(call_ollama_api_stream(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode))
+    try:
+        for text_chunk, response_data in chunks:
+            text_chunks.append(text_chunk)
+            if monitor is None: continue
+            monitor.feed(text_chunk)
+            if monitor.reason is not None: break
+    finally:
+        stopped_early = monitor is not None and monitor.reason is not None and not response_data.get("done")
+        if stopped_early: close_early(chunks, monitor.reason)
+        else: chunks.close()
+    if stopped_early:
+        text_chunks = [monitor.text]
+        response_data = dict(response_data, done=True, done_reason="early_stop", early_stop=early_stop_report(monitor, payload, response_data.get("model", model_name_for_log), mode))
+    generated_text = "".join(text_chunks)
+    if endpoint_path == "/api/generate": response_data = dict(response_data, response=generated_text)
+    else: response_data = dict(response_data, message=dict(response_data.get("message", {}), content=generated_text))
+    return generated_text.strip(), response_data
+
+def chat_stop_monitor(processor=None):
+    """聊天回覆的 EarlyStopMonitor；CHAT_EARLY_STOP 關閉時回傳 None (照常生成到 num_predict 或模型自行結束)。"""
+    if not cfg.CHAT_EARLY_STOP: return None
+    return EarlyStopMonitor(processor or LineStyleStreamProcessor(), cfg.CHAT_EARLY_STOP_MAX_LINES)
+
+def early_stop_report(monitor, payload, model, mode=None):
+    """記錄提前停止的指標並回傳放進回應的摘要 (reason、已接受的行數、省下的 token 上限估計)。"""
+    tokens_saved = monitor.tokens_saved((payload.get("options") or {}).get("num_predict"))
+    logger.info("Stopped generation early (%s) after %d lines, ~%d tokens saved (Model: %s)", monitor.reason, len(monitor.lines), tokens_saved, model)
+    record_early_stop(monitor.reason, model, mode, tokens_saved)
+    note_request(early_stop=monitor.reason)
+    return {"reason": monitor.reason, "lines": len(monitor.lines), "tokens_saved": tokens_saved}
+
+def budget_generation_payload(payload, model, mode):
+    """剩餘期限不夠生成完整的 num_predict 時依實測速率縮小；連 DEADLINE_MIN_NUM_PREDICT 都不夠時直接放棄。"""
+    options = payload.get("options") or {}
+    num_predict = options.get("num_predict")
+    max_tokens = generation_rates.max_tokens(model, request_deadline.remaining())
+    if not num_predict or max_tokens is None or max_tokens >= num_predict: return payload
+    if max_tokens < cfg.DEADLINE_MIN_NUM_PREDICT:
+        raise request_deadline.DeadlineExceededError(f"剩餘期限預估只能生成 {max_tokens} 個 token，不送出請求")
+    logger.info("Shrinking num_predict %d -> %d to fit the remaining %.1fs deadline (Model: %s)", num_predict, max_tokens, request_deadline.remaining(), model)
+    TOKENS_SAVED.inc(num_predict - max_tokens, reason="num_predict_budget", **current_labels(model, mode))
+    note_request(num_predict=max_tokens)
+    return dict(payload, options=dict(options, num_predict=max_tokens))
 
+def call_ollama_api_stream(endpoint_path, payload, model_name_for_log, timeout=(25, 120), affinity_key=None, mode=None):
+    """串流版本的 call_ollama_api：回傳逐一產生 (文字片段, 該片段的原始 JSON) 的 iterator，最後一個片段的 done 為 True。
+    相同 payload 的串流正在進行時共用它；所有讀取者都關閉 iterator (斷線) 後才中止上游的生成。
+    期限在合併之前檢查並套用到 num_predict，已放棄的請求不會拖累 (或搭上) 其他人的串流。"""
+    model = payload.get("model", model_name_for_log)
+    try:
+        request_deadline.raise_if_abandoned("dispatch")
+        payload = budget_generation_payload(payload, model, mode)
+    except request_deadline.RequestAbandonedError as e:
+        # 還沒送出就放棄：整個 num_predict 都省下來了
+        record_aborted_generation(f"{e.reason}_before_dispatch", model, mode, (payload.get("options") or {}).get("num_predict"))
+        raise
+    start = lambda: _call_ollama_api_stream(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode)
+    if not cfg.OLLAMA_COALESCE_REQUESTS: return start()
+    chunks, shared = ollama_single_flight.stream(coalescing_key(endpoint_path, dict(payload, stream=True)), start)
+    if shared:
+        logger.info("Coalesced with an in-flight identical Ollama stream (Model: %s)", model_name_for_log)
+        note_request(coalesced=True)
+    return chunks
+
+def _call_ollama_api_stream(endpoint_path, payload, model_name_for_log, timeout, affinity_key, mode):
+    ollama_url = f"[{', '.join(cfg.OLLAMA_BACKEND_URLS)}]{endpoint_path}"
+    stream_payload = dict(payload, stream=True)
+    model = payload.get("model", model_name_for_log)
+    generated_chunks, finished = 0, False
+    try:
+        logger.info("Sending streaming request to Ollama (%s), Model: %s, Affinity: %s", endpoint_path, model_name_for_log, affinity_key)
+        note_request(model=model, stream=True)
+        started = time.perf_counter()
+        with ollama_client.limiter.slot(model, **admission_options(stream_payload, mode)) as ticket:
+            observe_stage("queue_wait", time.perf_counter() - started, model, mode)
+            observe_admission_wait(model, ticket)
+            request_deadline.raise_if_abandoned("queue_wait")
+            started = time.perf_counter()
+            with ollama_client.post(endpoint_path, stream_payload, timeout=(timeout[0], request_deadline.read_timeout(timeout[1])), stream=True, affinity_key=affinity_key) as response:
+                ollama_url = f"{response.ollama_backend_url}{endpoint_path}"
+                response.raise_for_status()
+                for raw_line in response.iter_lines():
+                    if not raw_line: continue
+                    if generated_chunks == 0: observe_stage("ollama_first_chunk", time.perf_counter() - started, model, mode)
+                    generated_chunks += 1
+                    chunk_data = json.loads(raw_line)
+                    if chunk_data.get("error"):
+                        raise Exception(f"Ollama API ({model_name_for_log}) 串流錯誤: {chunk_data['error']}")
+                    if endpoint_path == "/api/generate": text_chunk = chunk_data.get("response", "")
+                    else: text_chunk = chunk_data.get("message", {}).get("content", "")
+                    if chunk_data.get("done"):
+                        finished = True
+                        observe_stage("ollama_http", time.perf_counter() - started, model, mode)
+                        record_ollama_response(chunk_data, model, mode)
+                        generation_rates.observe(model, chunk_data)
+                        note_request(backend=response.ollama_backend_url, prompt_eval_count=chunk_data.get("prompt_eval_count"), eval_count=chunk_data.get("eval_count"))
+                    yield text_chunk, chunk_data
+                    if chunk_data.get("done"): break
+    except request_deadline.RequestAbandonedError as e:
+        record_aborted_generation(f"{e.reason}_in_queue", model, mode, (stream_payload.get("options") or {}).get("num_predict"))
+        raise
+    except GeneratorExit:
+        # 讀取者 (或共用串流的最後一個讀取者) 提前關閉：離開 with 時關閉上游連線，Ollama 隨即停止生成
+        # 提前停止 (回覆已完成) 由呼叫端另外記錄，不算中止
+        if not finished and stop_reason() is None:
+            record_aborted_generation(request_deadline.abandoned() or request_deadline.ClientDisconnectedError.reason, model, mode,
+                                      max(0, ((stream_payload.get("options") or {}).get("num_predict") or 0) - generated_chunks))
+        raise
+    except requests.exceptions.Timeout:
+        if request_deadline.abandoned() == request_deadline.DeadlineExceededError.reason:
+            record_aborted_generation(request_deadline.DeadlineExceededError.reason, model, mode,
+                                      max(0, ((stream_payload.get("options") or {}).get("num_predict") or 0) - generated_chunks))
+            raise request_deadline.DeadlineExceededError(f"Ollama API ({model_name_for_log}) 在用戶端期限內沒有回應")
+        logger.error(f"Timeout error streaming from Ollama API ({model_name_for_log}) at {ollama_url}")
+        raise Exception(f"Ollama API ({model_name_for_log}) 超時")
+    except requests.exceptions.ConnectionError as e:
+        logger.error(f"Connection error streaming from Ollama API ({model_name_for_log}) at {ollama_url}: {e}")
+        raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {', '.join(cfg.OLLAMA_BACKEND_URLS)}")
+    except requests.exceptions.RequestException as e:
+        _raise_ollama_request_error(e, ollama_url, payload, model_name_for_log)
+
+def render_chat_history(messages):
     conversation_str = ""
-    for msg in relevant_messages:
+    for msg in messages:
         role = msg.get("role")
         content = msg.get("content", "").strip()
         if not content: continue
         if role == "user": conversation_str += f"<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>"
         elif role == "assistant": conversation_str += f"<|start_header_id|>assistant<|end_header_id|>\n\n{content}<|eot_id|>"
-    
+    return conversation_str
+
+def render_chat_system_prompt(goal, character_info, mode):
     system_prompt_str = ""
     if mode == "character_play":
-        system_parts = []
+        system_parts = [cfg.LINE_STYLE_INSTRUCTION_TAIWAN_UNI]
         persona_name = "一個聊天夥伴"
         persona_desc_detail = "健談的"
         if character_info:
@@ -148,12 +505,12 @@ def create_chat_prompt_for_ollama(goal, messages, character_info, mode):
         system_parts.append(f"### 對話連貫性與上下文利用 (CRITICAL): ###\n**你必須嚴格根據之前的所有對話紀錄 (如果你接收到了的話) 來連貫地生成回覆。**\n回覆應展現你對對話流程、之前討論過的話題、以及使用者先前發言的理解。維持對話的邏輯性與一致性，讓互動感覺自然且流暢，就像真人對話一樣。請特別注意之前討論過的特定細節和主題，並在你的回覆中自然地提及或延續這些內容。\n")
         # --- 結束新增 ---
 
+        system_parts.append(f"### 你的任務：\n作為 **{persona_name}**，嚴格遵守上述所有角色設定、對話連貫性要求和 LINE/IG 私訊風格規則，自然地與使用者互動。直接輸出你作為 **{persona_name}** 的回覆，不要有任何角色名稱外的註解或前綴。")
+
         user_goal_statement = "使用者希望與你進行自然的對話練習。"
         if goal and goal.strip() and goal.lower() != "進行自然的對話練習":
              user_goal_statement = f"使用者目前希望與你達成的社交目標是：「{goal}」。"
         system_parts.append(f"### 對話情境：\n{user_goal_statement}\n")
-        system_parts.append(cfg.LINE_STYLE_INSTRUCTION_TAIWAN_UNI)
-        system_parts.append(f"### 你的任務：\n作為 **{persona_name}**，嚴格遵守上述所有角色設定、對話連貫性要求和 LINE/IG 私訊風格規則，自然地與使用者互動。直接輸出你作為 **{persona_name}** 的回覆，不要有任何角色名稱外的註解或前綴。")
         system_prompt_str = "\n\n".join(system_parts)
 
     elif mode == "assistant":
@@ -164,180 +521,679 @@ def create_chat_prompt_for_ollama(goal, messages, character_info, mode):
             partner_desc = character_info.get('description', partner_desc)
         partner_persona_desc = f"你的聊天對象是 **{partner_name}**。\n對方的個性簡述：{partner_desc}。"
         
-        partner_last_message = "對方剛才說了一些話"
-        if messages and messages[-1].get("role") == "user":
-             partner_last_message = messages[-1].get("content","").strip()
-        
         system_parts = [
+            cfg.LINE_STYLE_INSTRUCTION_TAIWAN_UNI,
             "你是一位 AI 聊天助手，專門為使用者草擬回覆。",
-            f"使用者希望達成的溝通目標是：「{goal}」。", 
-            partner_persona_desc,
-            f"該聊天對象剛剛傳來的訊息是：「{partner_last_message}」。",
+            "你的任務是提供「代表使用者本人」的回覆建議，而非基於AI角色回應。這個回覆應該是使用者可以直接複製貼上的文本。",  # 修改這一行，強調是代表使用者本人回覆
             # <--- 新增這一段，明確指示模型利用上下文
             f"### 回覆建議的連貫性與上下文利用 (CRITICAL): ###\n**你必須嚴格根據之前的所有對話紀錄 (如果你接收到了的話) 來連貫地生成回覆建議。**\n回覆應展現使用者對對話流程、之前討論過的話題、以及對方先前發言的理解。維持對話的邏輯性與一致性，讓建議感覺自然且流暢。請特別注意之前討論過的特定細節和主題，並在建議中自然地提及或延續這些內容。\n",
             # --- 結束新增 ---
-            "你的任務是提供「代表使用者本人」的回覆建議，而非基於AI角色回應。這個回覆應該是使用者可以直接複製貼上的文本。",  # 修改這一行，強調是代表使用者本人回覆
-            cfg.LINE_STYLE_INSTRUCTION_TAIWAN_UNI,
-            "請根據對話上下文，幫使用者草擬一個真實自然、符合台灣大學生風格的回覆。直接輸出回覆內容，不要有任何解釋或前綴。這個回覆應該代表使用者的聲音和立場，而不是AI的建議。"  # 修改這一行，強調代表使用者的聲音
+            partner_persona_desc,
+            f"使用者希望達成的溝通目標是：「{goal}」。", 
         ]
         system_prompt_str = "\n\n".join(system_parts)
-        
+    return system_prompt_str
+
+def render_chat_latest_turn(messages, mode):
+    if mode != "assistant": return ""
+    partner_last_message = "對方剛才說了一些話"
+    if messages and messages[-1].get("role") == "user":
+         partner_last_message = messages[-1].get("content","").strip()
+    # 對方最新訊息每輪都不同，放在歷史之後，避免破壞前面可快取的前綴
+    return (
+        f"<|start_header_id|>system<|end_header_id|>\n\n該聊天對象剛剛傳來的訊息是：「{partner_last_message}」。\n"
+        "請根據對話上下文，幫使用者草擬一個真實自然、符合台灣大學生風格的回覆。直接輸出回覆內容，不要有任何解釋或前綴。這個回覆應該代表使用者的聲音和立場，而不是AI的建議。<|eot_id|>"  # 修改這一行，強調代表使用者的聲音
+    )
+
+def render_conversation_summary(summary):
+    if not summary: return ""
+    return f"<|start_header_id|>system<|end_header_id|>\n\n### 先前對話摘要 (更早的對話已省略)：\n{summary}<|eot_id|>"
+
+def render_chat_system_block(system_prompt_str):
+    return f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt_str}<|eot_id|>"
+
+ASSISTANT_HEADER = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+def prompt_token_budget(mode, model_config):
+    """模式的 prompt 預算，且 prompt 加上 num_predict 不超過 num_ctx (超過時 Ollama 會自己截掉 prompt 開頭，又慢又會丟掉風格規則)。"""
+    budget = cfg.PROMPT_TOKEN_BUDGETS[mode]
+    if not cfg.OLLAMA_NUM_CTX: return budget
+    return min(budget, cfg.OLLAMA_NUM_CTX - (model_config["ollama_options"].get("num_predict") or 0) - cfg.PROMPT_TOKEN_MARGIN)
+
+def plan_history(mode, model_config, fixed_fragments, message_tokens):
+    """依 token 預算決定歷史視窗的起點。放不下全部歷史時，先保留摘要 (最多 num_predict 個 token) 的空間再重新挑選。"""
+    budget = prompt_token_budget(mode, model_config)
+    available = budget - sum(fixed_fragments.values())
+    history_start = pack_history(message_tokens, available, cfg.CHAT_HISTORY_COMPACTION_STEP)
+    if history_start > 0 and cfg.CONVERSATION_SUMMARY_ENABLED:
+        summary_reserve = cfg.CONVERSATION_SUMMARY_CONFIG["ollama_options"]["num_predict"] + token_counter.count(render_conversation_summary(" "), model_config["name"])
+        history_start = pack_history(message_tokens, available - summary_reserve, cfg.CHAT_HISTORY_COMPACTION_STEP)
+    return {"mode": mode, "model": model_config["name"], "budget": budget, "fixed": fixed_fragments, "message_tokens": message_tokens, "history_start": history_start}
+
+def plan_chat_history(messages, system_prompt_str, mode):
+    model_config = cfg.CHAT_MODEL_CONFIG; model_name = model_config["name"]
+    fixed = {"system": token_counter.count(render_chat_system_block(system_prompt_str), model_name),
+             "latest": token_counter.count(render_chat_latest_turn(messages, mode) + ASSISTANT_HEADER, model_name)}
+    message_tokens = [token_counter.count(render_chat_history([message]), model_name) for message in messages]
+    return plan_history(mode, model_config, fixed, message_tokens)
+
+def finish_prompt_plan(plan, summary_block):
+    """補上摘要的 token 數，記錄指標並回傳放進回應的 token 報告。"""
+    history_start, message_tokens = plan["history_start"], plan["message_tokens"]
+    fragments = dict(plan["fixed"], summary=token_counter.count(summary_block, plan["model"]), history=sum(message_tokens[history_start:]))
+    report = token_report(plan["budget"], token_counter.exact(), fragments, len(message_tokens) - history_start, history_start)
+    observe_prompt_tokens(report, plan["model"], plan["mode"])
+    if report["over_budget"]: logger.warning("Prompt exceeds token budget even without history (mode: %s): %s", plan["mode"], report)
+    return report
+
+def create_chat_prompt_for_ollama(goal, messages, character_info, mode, system_prompt_str=None, summary=None, history_start=None):
+    # Prompt 依「最穩定 → 最不穩定」排列：風格規則 (所有對話共用) → 角色/對象設定 → 目標 → 歷史 → 最新一輪。
+    # 前面越穩定，連續兩輪之間共用的 token 前綴越長，Ollama 需要重新評估的 prompt 就越少。
+    if system_prompt_str is None:
+        system_prompt_str = render_chat_system_prompt(goal, character_info, mode)
+    if history_start is None: history_start = plan_chat_history(messages, system_prompt_str, mode)["history_start"]
+    relevant_messages = messages[history_start:]
+    logger.debug("Using last %d of %d messages for context (token budget %d).", len(relevant_messages), len(messages), cfg.PROMPT_TOKEN_BUDGETS[mode])
+
     final_prompt_content = (
-        f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt_str}<|eot_id|>"
-        f"{conversation_str}"
-        f"<|start_header_id|>assistant<|end_header_id|>\n\n"
+        f"{render_chat_system_block(system_prompt_str)}"
+        f"{render_conversation_summary(summary)}"
+        f"{render_chat_history(relevant_messages)}"
+        f"{render_chat_latest_turn(messages, mode)}"
+        f"{ASSISTANT_HEADER}"
     )
-    logger.debug(f"Mode: {mode} - Char/Partner: {character_info.get('name') if character_info else 'N/A'} - Goal: {goal} - Prompt: {repr(final_prompt_content)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Mode: %s - Char/Partner: %s - Goal: %s - Prompt: %r", mode, character_info.get('name') if character_info else 'N/A', goal, final_prompt_content)
     return final_prompt_content
 
+def build_generate_payload(model_config, prompt):
+    options = dict(model_config["ollama_options"], num_ctx=cfg.OLLAMA_NUM_CTX) if cfg.OLLAMA_NUM_CTX else model_config["ollama_options"]
+    return {"model": model_config["name"], "prompt": prompt, "stream": False, "raw": True, "keep_alive": cfg.OLLAMA_KEEP_ALIVE, "options": options}
+
+def summarize_conversation_turns(previous_summary, new_messages):
+    model_config = cfg.CONVERSATION_SUMMARY_CONFIG; model_name = model_config["name"]
+    new_turns_str = "".join(f"{msg.get('role', '').capitalize()}: {msg.get('content', '').strip()}\n" for msg in new_messages if msg.get("content", "").strip())
+    user_turn_content = f"先前的摘要：\n{previous_summary or '(無)'}\n\n新增的對話：\n{new_turns_str}\n請輸出更新後的完整摘要："
+    prompt = (
+        f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{model_config['system_prompt']}<|eot_id|>"
+        f"<|start_header_id|>user<|end_header_id|>\n\n{user_turn_content}<|eot_id|>"
+        f"<|start_header_id|>assistant<|end_header_id|>\n\n"
+    )
+    summary, _ = call_ollama_api("/api/generate", build_generate_payload(model_config, prompt), f"{model_name} (summary)", mode="summary")
+    logger.info("Conversation summary updated over %d new messages (%d chars)", len(new_messages), len(summary))
+    return summary
+
+summary_cache = RollingSummaryCache(summarize_conversation_turns, store=ConversationStateStore(cfg.CONVERSATION_STATE_SQLITE_PATH, "conversation_summaries", cfg.SESSION_TTL_SECONDS)
+                                    if cfg.CONVERSATION_STATE_SQLITE_PATH else None)
+
+def conversation_memory_key(character_info, data, messages):
+    """與模式無關，讓回饋評估可以沿用聊天過程中已算好的摘要。每段對話各自一個 key：優先用 session_id 或前端產生的 conversation_id，
+    都沒有時以角色、目標與對話的第一則訊息區分 (仍可能撞 key，涵蓋範圍另由快取逐則比對指紋，不會用到別段對話的結果)。"""
+    character_key = (character_info or {}).get('id') or (character_info or {}).get('name') or "generic"
+    conversation_id = data.get('session_id') or data.get('conversation_id')
+    if not conversation_id:
+        conversation_id = f"{data.get('goal', '')}:{message_fingerprint(messages[0]) if messages else '-'}"
+    return f"{character_key}:{conversation_id}"
+
+def conversation_digest(memory_key, messages, upto, offset=0, wait_timeout=None):
+    if not cfg.CONVERSATION_SUMMARY_ENABLED or memory_key is None or upto <= 0: return None
+    summary, _ = summary_cache.get_digest(memory_key, messages, offset + upto, offset=offset, wait_timeout=wait_timeout)
+    return summary or None
+
+class PromptCacheTracker:
+    """依 Ollama 回傳的 prompt_eval_count / prompt_eval_duration 估算每個請求因 KV cache 而省下的 prompt 評估。
+
+    Ollama 只回報實際評估的 token 數，因此以「冷啟動」請求 (與該對話上一個 prompt 沒有共用前綴) 校正每 token 字元數，
+    用來估算完整 prompt 的 token 數；兩者相減即為省下的 token。
+    """
+
+    def __init__(self, default_chars_per_token=1.5, max_conversations=500):
+        self.default_chars_per_token = default_chars_per_token
+        self.max_conversations = max_conversations
+        self._chars_per_token = {}
+        self._last_prompts = OrderedDict()
+        self._totals = {"requests": 0, "prompt_eval_tokens": 0, "prompt_tokens_saved": 0, "prompt_eval_ms_saved": 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, conversation_key, model, prompt, response_data):
+        prompt_eval_count = response_data.get("prompt_eval_count") or 0
+        prompt_eval_duration = response_data.get("prompt_eval_duration") or 0
+        with self._lock:
+            previous_prompt = self._last_prompts.pop(conversation_key, None)
+            self._last_prompts[conversation_key] = prompt
+            if len(self._last_prompts) > self.max_conversations: self._last_prompts.popitem(last=False)
+            shared_prefix_chars = len(os.path.commonprefix([previous_prompt, prompt])) if previous_prompt else 0
+            if shared_prefix_chars == 0 and prompt_eval_count > 0:
+                token_counter.calibrate(model, prompt, prompt_eval_count)
+                observed = len(prompt) / prompt_eval_count
+                current = self._chars_per_token.get(model)
+                self._chars_per_token[model] = observed if current is None else 0.8 * current + 0.2 * observed
+            chars_per_token = self._chars_per_token.get(model, self.default_chars_per_token)
+            estimated_prompt_tokens = int(len(prompt) / chars_per_token)
+            tokens_saved = max(0, estimated_prompt_tokens - prompt_eval_count) if prompt_eval_count else 0
+            ms_per_token = prompt_eval_duration / prompt_eval_count / 1e6 if prompt_eval_count else 0.0
+            report = {"prompt_eval_count": prompt_eval_count, "prompt_eval_ms": round(prompt_eval_duration / 1e6, 1),
+                      "estimated_prompt_tokens": estimated_prompt_tokens, "shared_prefix_chars": shared_prefix_chars,
+                      "prompt_tokens_saved": tokens_saved, "prompt_eval_ms_saved": round(tokens_saved * ms_per_token, 1)}
+            self._totals["requests"] += 1
+            self._totals["prompt_eval_tokens"] += prompt_eval_count
+            self._totals["prompt_tokens_saved"] += tokens_saved
+            self._totals["prompt_eval_ms_saved"] += report["prompt_eval_ms_saved"]
+        logger.info("Prompt cache (%s): evaluated %s tokens, saved ~%s tokens (~%s ms)", conversation_key, prompt_eval_count, tokens_saved, report['prompt_eval_ms_saved'])
+        return report
+
+    def stats(self):
+        with self._lock:
+            return dict(self._totals, chars_per_token={model: round(v, 3) for model, v in self._chars_per_token.items()})
+
+prompt_cache_tracker = PromptCacheTracker()
+
+def record_prompt_cache(affinity_key, model_name, full_prompt, response_data):
+    """合併到其他相同請求的回應沒有自己的 prompt 評估，不重複計入 KV cache 統計。"""
+    if request_field("coalesced"): return None
+    return prompt_cache_tracker.record(affinity_key, model_name, full_prompt, response_data)
+
 def post_process_line_style_reply(raw_ai_reply, mode_log="reply"):
-    logger.debug(f"Pre-processing {mode_log} (LINE style): {repr(raw_ai_reply)}")
-    cleaned_reply = cfg.POST_PROCESS_PREFIX_PATTERN.sub('', raw_ai_reply).strip()
-    cleaned_reply = re.sub(r'^```json\s*\{[\s\S]*?\}\s*```', '', cleaned_reply, flags=re.DOTALL | re.MULTILINE).strip()
-    cleaned_reply = re.sub(r'^\{[\s\S]*?\}$', '', cleaned_reply, flags=re.DOTALL | re.MULTILINE).strip()
-
-    # 此處保留上次的修改：POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE 不再移除逗號和句號
-    temp_reply_chars = [char for char in cleaned_reply if char not in cfg.POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE]
-    cleaned_reply = "".join(temp_reply_chars)
-    cleaned_reply = cleaned_reply.replace('\\n', '\n').replace('\r\n', '\n').replace('\r', '\n')
-    lines = [line.strip() for line in cleaned_reply.split('\n') if line.strip()]
-    final_output = "\n".join(lines)
+    logger.debug("Pre-processing %s (LINE style): %r", mode_log, raw_ai_reply)
+    with stage("post_process"): final_output = POST_PROCESS_PROFILE.clean(raw_ai_reply)
     if not final_output and raw_ai_reply.strip(): 
-        logger.warning(f"Post-processing for {mode_log} resulted in empty string for non-empty raw reply. Raw: {repr(raw_ai_reply)}. Returning original stripped reply.")
+        logger.warning("Post-processing for %s resulted in empty string for non-empty raw reply. Raw: %r. Returning original stripped reply.", mode_log, raw_ai_reply)
         return raw_ai_reply.strip() 
     elif not final_output and not raw_ai_reply.strip(): 
-        logger.info(f"Post-processing for {mode_log}: Raw reply was empty, returning empty.")
+        logger.info("Post-processing for %s: Raw reply was empty, returning empty.", mode_log)
         return "" 
         
-    logger.debug(f"Post-processed {mode_log} (LINE style) - FINAL OUTPUT: {repr(final_output)}")
+    logger.debug("Post-processed %s (LINE style) - FINAL OUTPUT: %r", mode_log, final_output)
     return final_output
 
+def overloaded_response(error, model_name):
+    logger.warning(f"Rejecting request with 503 (model: {model_name}): {error}")
+    return jsonify({"error": str(error), "done": True, "model": model_name}), 503, {"Retry-After": str(error.retry_after)}
+
+def abandoned_response(error, model_name):
+    logger.info("Request abandoned (%s, model: %s): %s", error.reason, model_name, error)
+    return jsonify({"error": str(error), "reason": error.reason, "done": True, "model": model_name}), error.status
+
+class LineStyleStreamProcessor(StreamingPostProcessor):
+    """post_process_line_style_reply 的增量版本：餵入串流片段，每完成一行 (\\n 分隔) 就吐出清理後的短訊息。"""
+
+    def __init__(self):
+        super().__init__(POST_PROCESS_PROFILE)
+
+def chat_response_cache_key(mode, payload, full_prompt):
+    if mode not in cfg.RESPONSE_CACHE_MODES: return None
+    return make_cache_key(payload["model"], payload.get("options"), full_prompt)
+
+def lookup_cached_chat_response(cache_key, mode):
+    """查回應快取；命中時記錄到請求紀錄 (cached=True) 後回傳 {"text", "response_data"}，未命中或不快取的模式回傳 None。"""
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        logger.info("Response cache hit (mode: %s, key: %s)", mode, cache_key[:12])
+        note_request(cached=True)
+    return cached
+
+def store_cached_chat_response(cache_key, raw_reply, response_data):
+    if cache_key is None or not raw_reply: return
+    # context 是數千個 token id，對重播沒有用處，不放進快取
+    response_cache.put(cache_key, {"text": raw_reply, "response_data": {k: v for k, v in response_data.items() if k not in ("context", "early_stop")}})
+
+def generate_chat_reply(payload, model_name, mode, affinity_key, full_prompt):
+    """回傳 (raw_reply, response_data, prompt_cache_report, cached)。命中回應快取時完全不呼叫 Ollama。"""
+    cache_key = chat_response_cache_key(mode, payload, full_prompt)
+    cached = lookup_cached_chat_response(cache_key, mode)
+    if cached is not None:
+        return cached["text"], cached["response_data"], None, True
+    raw_reply, response_data = call_ollama_api("/api/generate", payload, model_name, affinity_key=affinity_key, monitor=chat_stop_monitor())
+    prompt_cache_report = record_prompt_cache(affinity_key, model_name, full_prompt, response_data)
+    store_cached_chat_response(cache_key, raw_reply, response_data)
+    return raw_reply, response_data, prompt_cache_report, False
+
+def resolve_candidate_count(data, mode):
+    """回傳 (候選數, 錯誤訊息)。沒有指定 candidates 時為 1 (原本的單一回覆)。"""
+    count = data.get('candidates', 1)
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= cfg.CHAT_MAX_CANDIDATES:
+        return None, f"candidates 必須是 1 到 {cfg.CHAT_MAX_CANDIDATES} 的整數。"
+    if count > 1 and mode != "assistant": return None, "多個候選建議只適用於聊天助手 (assistant) 模式。"
+    if count > 1 and data.get('stream'): return None, "多個候選建議不支援串流回應。"
+    return count, None
+
+def candidate_payloads(payload, count, base_seed=None):
+    """回傳 [(payload, extra)]：每個候選換一組 temperature 與 seed，extra 會原樣放進回應的候選中。"""
+    base_seed = random.getrandbits(31) if base_seed is None else base_seed
+    variants = []
+    for index in range(count):
+        temperature = cfg.CHAT_CANDIDATE_TEMPERATURES[index % len(cfg.CHAT_CANDIDATE_TEMPERATURES)]
+        extra = {"seed": base_seed + index, "temperature": temperature}
+        variants.append((dict(payload, options=dict(payload["options"], **extra)), extra))
+    return variants
+
+def rank_reply_candidates(results, js_messages):
+    """results 為 [(extra, raw_reply)]，失敗的候選不在其中。"""
+    with stage("candidate_ranking"):
+        cleaned = [(raw_reply, POST_PROCESS_PROFILE.apply(raw_reply), extra) for extra, raw_reply in results]
+        return rank_candidates(cleaned, js_messages[-cfg.CHAT_CANDIDATE_OVERLAP_MESSAGES:], profile=POST_PROCESS_PROFILE)
+
+def generate_reply_candidates(payload, model_name, count, affinity_key, js_messages, base_seed=None):
+    """同時送出 count 個生成 (經由 limiter 分散到 Ollama 的平行槽位)，回傳 (排序後的候選, 最佳候選的 response_data)。
+    部分候選失敗時只回傳成功的；全部失敗才丟出第一個錯誤。"""
+    variants = candidate_payloads(payload, count, base_seed)
+    # 每個候選在目前請求 context 的複本中執行，指標、期限與斷線檢查都跟著這個請求
+    futures = [candidate_executor.submit(contextvars.copy_context().run, call_ollama_api, "/api/generate", variant, model_name, affinity_key=affinity_key, monitor=chat_stop_monitor())
+               for variant, _ in variants]
+    results, response_data_by_seed, errors = [], {}, []
+    for (_, extra), future in zip(variants, futures):
+        try:
+            raw_reply, response_data = future.result()
+        except Exception as e:
+            errors.append(e); continue
+        if response_data.get("early_stop"): extra = dict(extra, early_stop=response_data["early_stop"])
+        results.append((extra, raw_reply)); response_data_by_seed[extra["seed"]] = response_data
+    if not results: raise errors[0]
+    if errors: logger.warning("%d of %d reply candidates failed: %s", len(errors), count, errors[0])
+    ranked = rank_reply_candidates(results, js_messages)
+    note_request(candidates=len(ranked))
+    return ranked, response_data_by_seed[ranked[0]["seed"]]
+
+def stream_chat_reply_events(payload, model_name, mode, affinity_key=None, session=None, full_prompt=None):
+    """以 NDJSON 逐行輸出：每完成一則短訊息送出一個 line 事件，最後送出與非串流回應相同結構的 done 事件。
+    啟用 CHAT_EARLY_STOP 時 line 事件只包含被接受的行，回覆形狀完成 (或開始重複、解說) 就中止生成並直接送出 done。"""
+    processor = LineStyleStreamProcessor()
+    monitor = chat_stop_monitor(processor)
+    feed, finish = (monitor.feed, monitor.finish) if monitor is not None else (processor.feed, processor.finish)
+    line_index = 0
+    final_chunk = {}
+    full_prompt = full_prompt or payload["prompt"]
+    try:
+        cache_key = chat_response_cache_key(mode, payload, full_prompt)
+        cached = lookup_cached_chat_response(cache_key, mode)
+        if cached is not None:
+            chunks = iter([(cached["text"], cached["response_data"])])
+        else:
+            chunks = request_deadline.guard(call_ollama_api_stream("/api/generate", payload, model_name, affinity_key=affinity_key))
+        try:
+            for text_chunk, final_chunk in chunks:
+                for line in feed(text_chunk):
+                    yield json.dumps({"type": "line", "index": line_index, "content": line}, ensure_ascii=False) + "\n"
+                    line_index += 1
+                if monitor is not None and monitor.reason is not None: break
+        finally:
+            stopped_early = monitor is not None and monitor.reason is not None and not final_chunk.get("done")
+            if stopped_early: close_early(chunks, monitor.reason)
+            elif hasattr(chunks, "close"): chunks.close()
+        early_stop = None
+        if stopped_early:
+            early_stop = early_stop_report(monitor, payload, model_name, mode)
+            final_chunk = dict(final_chunk, done=True, done_reason="early_stop")
+        else:
+            for line in finish():
+                yield json.dumps({"type": "line", "index": line_index, "content": line}, ensure_ascii=False) + "\n"
+                line_index += 1
+        if monitor is not None and monitor.reason is not None:
+            raw_reply = final_reply = monitor.text  # 與已送出的 line 事件一致
+        else:
+            raw_reply = processor.raw_text.strip()
+            final_reply = post_process_line_style_reply(raw_reply, mode_log=f"{mode} mode streamed output")
+        prompt_cache_report = None
+        if cached is None:
+            prompt_cache_report = record_prompt_cache(affinity_key, model_name, full_prompt, final_chunk)
+            store_cached_chat_response(cache_key, raw_reply, final_chunk)
+        record_chat_session_turn(session, final_reply, final_chunk)
+        done_event = {"type": "done", "model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": final_reply}, "prompt_cache": prompt_cache_report, "prompt_tokens": request_field("prompt_tokens"), "cached": cached is not None, "early_stop": early_stop, "done": True}
+        if session is not None: done_event["session_id"] = session["session_id"]
+        yield json.dumps(done_event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        logger.error(f"API /api/chat_py (mode: {mode}, stream) error: {e}\n{traceback.format_exc()}")
+        yield json.dumps({"type": "error", "error": str(e), "done": True, "model": model_name}, ensure_ascii=False) + "\n"
+
+def conversation_affinity_key(mode, character_info, data):
+    """同一角色 + 同一對話盡量送到同一個 Ollama 節點，以重用其系統 prompt 的 KV cache。"""
+    character_key = (character_info or {}).get('id') or (character_info or {}).get('name') or "generic"
+    return f"{mode}:{character_key}:{data.get('session_id') or data.get('goal', '')}"
+
+def resolve_chat_session(data):
+    """沒有 session_id 時維持原本的無狀態行為 (前端送完整 messages)。
+    有 session_id 時從 session store 取出歷史，只附加本次的 message / new_messages；若同時送了 messages 則以其覆蓋伺服器端歷史。
+    回傳 (session, character_info, goal, js_messages, mode)，session 為 None 代表無狀態請求。"""
+    session_id = data.get('session_id')
+    if not session_id:
+        return None, data.get('character'), data.get('goal', ""), data.get('messages', []), data.get('mode', "character_play")
+    new_messages = data.get('new_messages') or ([data['message']] if data.get('message') else [])
+    stored = session_store.get(session_id)
+    if stored is None:
+        if 'messages' not in data and not data.get('character') and not data.get('goal'):
+            raise SessionNotFoundError(f"找不到對話 session {session_id}，請重新傳送完整的 goal / character / messages。")
+        session = new_session(session_id, mode=data.get('mode', "character_play"), goal=data.get('goal', ""), character=data.get('character'), messages=data.get('messages', []))
+    else:
+        session = dict(stored, messages=list(data['messages']) if 'messages' in data else list(stored["messages"]))
+        for field in ('mode', 'goal', 'character'):
+            if field in data: session[field] = data[field]
+    session["messages"].extend(new_messages)
+    trim_session_messages(session, cfg.SESSION_MAX_MESSAGES, cfg.CHAT_HISTORY_COMPACTION_STEP)
+    session["_new_message_count"] = len(new_messages) if 'messages' not in data else None
+    return session, session["character"] or None, session["goal"], session["messages"], session["mode"]
+
+def session_system_prompt(session):
+    """同一 session 的系統 prompt 只在 goal / 角色 / 模式改變時重新組裝。"""
+    prompt_key = json.dumps([session["mode"], session["goal"], session["character"]], ensure_ascii=False, sort_keys=True)
+    if session.get("system_prompt_key") != prompt_key:
+        session["system_prompt"] = render_chat_system_prompt(session["goal"], session["character"] or None, session["mode"])
+        session["system_prompt_key"] = prompt_key
+    return session["system_prompt"]
+
+def build_chat_payload(session, goal, js_messages, character_info, mode, memory_key=None):
+    """回傳 (payload, full_prompt)。full_prompt 永遠是完整 prompt (供快取統計)；
+    啟用 SESSION_REUSE_OLLAMA_CONTEXT 且上一輪的 context 仍有效時，payload 只帶本輪新增的訊息與 context。"""
+    model_config = cfg.CHAT_MODEL_CONFIG
+    system_prompt_str = session_system_prompt(session) if session is not None else render_chat_system_prompt(goal, character_info, mode)
+    plan = plan_chat_history(js_messages, system_prompt_str, mode)
+    history_start = plan["history_start"]
+    summary = conversation_digest(memory_key, js_messages, history_start, offset=session.get("message_offset", 0) if session else 0)
+    full_prompt = create_chat_prompt_for_ollama(goal, js_messages, character_info, mode, system_prompt_str=system_prompt_str, summary=summary, history_start=history_start)
+    note_request(prompt_tokens=finish_prompt_plan(plan, render_conversation_summary(summary)))
+    payload = build_generate_payload(model_config, full_prompt)
+    if session is not None: session["_summary"], session["_history_start"] = summary, history_start
+    if session is None or not cfg.SESSION_REUSE_OLLAMA_CONTEXT or mode != "character_play" or not session.get("ollama_context"):
+        return payload, full_prompt
+    new_message_count = session.get("_new_message_count")
+    # 只有在上一輪之後僅附加了新訊息、系統 prompt 與歷史視窗起點都沒變時，context 才與完整 prompt 等價
+    context_still_valid = new_message_count and session.get("context_prompt_key") == session["system_prompt_key"] \
+        and session.get("context_message_count") == len(js_messages) - new_message_count \
+        and session.get("context_history_start") == history_start and session.get("context_summary") == summary
+    if context_still_valid:
+        new_messages = js_messages[-new_message_count:]
+        payload["prompt"] = f"<|eot_id|>{render_chat_history(new_messages)}<|start_header_id|>assistant<|end_header_id|>\n\n"
+        payload["context"] = session["ollama_context"]
+    return payload, full_prompt
+
+def record_chat_session_turn(session, final_reply, response_data):
+    if session is None: return
+    if session["mode"] == "character_play" and final_reply:
+        session["messages"].append({"role": "assistant", "content": final_reply})
+    session["ollama_context"] = response_data.get("context")
+    session["context_prompt_key"] = session.get("system_prompt_key")
+    session["context_message_count"] = len(session["messages"])
+    session["context_history_start"] = session.pop("_history_start", None)
+    session["context_summary"] = session.pop("_summary", None)
+    session.pop("_new_message_count", None)
+    session_store.put(session)
+
+def validate_chat_request(character_info, goal, js_messages, mode):
+    """回傳錯誤訊息 (400)，驗證通過則回傳 None。"""
+    if mode not in cfg.CHAT_MODES:
+        logger.warning(f"/api/chat_py - Unknown mode: {mode!r}")
+        return f"不支援的模式，mode 必須是 {' 或 '.join(cfg.CHAT_MODES)}。"
+    if mode == "character_play" and not character_info:
+        logger.warning(f"/api/chat_py (mode: {mode}) - Character info is missing.")
+        return "角色扮演模式需要角色資訊。"
+    if mode == "assistant":
+        if not goal.strip():
+            logger.warning(f"/api/chat_py (mode: {mode}) - Goal is missing.")
+            return "聊天助手模式需要設定溝通目標。"
+        if not js_messages or js_messages[-1].get("role") != "user": 
+             logger.warning(f"/api/chat_py (mode: {mode}) - Last message is not from user (partner).")
+             return "聊天助手模式需要對方訊息作為最後一條。"
+    return None
+
 @app.route('/api/chat_py', methods=['POST'])
 def chat_py_endpoint():
     try:
         data = request.get_json()
         if not data: logger.warning("/api/chat_py - Request body is not JSON"); return jsonify({"error": "請求主體必須是 JSON"}), 400
         
-        character_info = data.get('character')
-        goal = data.get('goal', "") 
-        js_messages = data.get('messages', [])
-        mode = data.get('mode', "character_play")
-
-        if mode == "character_play" and not character_info:
-            logger.warning(f"/api/chat_py (mode: {mode}) - Character info is missing.")
-            return jsonify({"error": "角色扮演模式需要角色資訊。"}), 400
-        if mode == "assistant":
-            if not goal.strip():
-                logger.warning(f"/api/chat_py (mode: {mode}) - Goal is missing.")
-                return jsonify({"error": "聊天助手模式需要設定溝通目標。"}), 400
-            if not js_messages or js_messages[-1].get("role") != "user": 
-                 logger.warning(f"/api/chat_py (mode: {mode}) - Last message is not from user (partner).")
-                 return jsonify({"error": "聊天助手模式需要對方訊息作為最後一條。"}), 400
+        with stage("validation"):
+            session, character_info, goal, js_messages, mode = resolve_chat_session(data)
+            note_request(mode=mode)
+            validation_error = validate_chat_request(character_info, goal, js_messages, mode)
+        if validation_error: return jsonify({"error": validation_error}), 400
+        observe_user_turn(session, character_info, goal, js_messages, mode, data)
         
         model_config = cfg.CHAT_MODEL_CONFIG; model_name = model_config["name"]
-        full_prompt = create_chat_prompt_for_ollama(goal, js_messages, character_info, mode)
-        payload = {"model": model_name, "prompt": full_prompt, "stream": False, "raw": True, "options": model_config["ollama_options"]}
-        raw_reply, _ = call_ollama_api("/api/generate", payload, model_name)
+        with stage("prompt_build", model_name):
+            payload, full_prompt = build_chat_payload(session, goal, js_messages, character_info, mode, memory_key=conversation_memory_key(character_info, data, js_messages))
+        affinity_key = conversation_affinity_key(mode, character_info, data)
+        candidate_count, candidate_error = resolve_candidate_count(data, mode)
+        if candidate_error: return jsonify({"error": candidate_error}), 400
+        if candidate_count > 1:
+            candidates, response_data = generate_reply_candidates(payload, model_name, candidate_count, affinity_key, js_messages, data.get('seed'))
+            record_chat_session_turn(session, candidates[0]["content"], response_data)
+            response_body = {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": candidates[0]["content"]}, "candidates": candidates, "prompt_tokens": request_field("prompt_tokens"), "done": True}
+            if session is not None: response_body["session_id"] = session["session_id"]
+            return jsonify(response_body), 200
+        if data.get('stream'):
+            return Response(stream_with_context(stream_chat_reply_events(payload, model_name, mode, affinity_key, session, full_prompt)), mimetype="application/x-ndjson")
+        raw_reply, response_data, prompt_cache_report, cached = generate_chat_reply(payload, model_name, mode, affinity_key, full_prompt)
         final_reply = post_process_line_style_reply(raw_reply, mode_log=f"{mode} mode output")
-        return jsonify({"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": final_reply}, "done": True}), 200
+        record_chat_session_turn(session, final_reply, response_data)
+        response_body = {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": final_reply}, "prompt_cache": prompt_cache_report, "prompt_tokens": request_field("prompt_tokens"), "cached": cached, "early_stop": response_data.get("early_stop"), "done": True}
+        if session is not None: response_body["session_id"] = session["session_id"]
+        return jsonify(response_body), 200
+    except SessionNotFoundError as e:
+        logger.warning(f"/api/chat_py - {e}")
+        return jsonify({"error": str(e), "done": True}), 404
+    except OllamaOverloadedError as e:
+        return overloaded_response(e, cfg.CHAT_MODEL_CONFIG.get("name"))
+    except request_deadline.RequestAbandonedError as e:
+        return abandoned_response(e, cfg.CHAT_MODEL_CONFIG.get("name"))
     except Exception as e:
         mode_for_log = data.get('mode', 'N/A') if isinstance(data, dict) else 'N/A'
         logger.error(f"API /api/chat_py (mode: {mode_for_log}) unhandled error: {e}\n{traceback.format_exc()}")
         return jsonify({"error": str(e), "done": True, "model": cfg.CHAT_MODEL_CONFIG.get("name")}), 500
 
 def parse_user_feedback_from_llm(raw_feedback_text):
-    logger.debug(f"Parsing user performance feedback text (length: {len(raw_feedback_text)}):\n{raw_feedback_text[:1500]}...")
-    feedback_data = {
-        "summary": "AI 未能提供整體總結。",
-        "scores": { "clarity": {"score": None, "justification": "AI 未提供"}, "empathy": {"score": None, "justification": "AI 未提供"},
-                    "confidence": {"score": None, "justification": "AI 未提供"}, "appropriateness": {"score": None, "justification": "AI 未提供"},
-                    "goalAchievement": {"score": None, "justification": "AI 未提供"} },
-        "strengths": ["AI 未提供具體優點"], "improvements": ["AI 未提供具體建議"]
-    }
-    try:
-        # --- START MODIFICATION IN parse_user_feedback_from_llm ---
-        # (This section was already modified and validated in previous steps)
+    logger.debug("Parsing user performance feedback text (length: %d):\n%.1500s", len(raw_feedback_text), raw_feedback_text)
+    with stage("feedback_parse"): feedback_data, problems = parse_feedback_text(raw_feedback_text)
+    if problems: logger.warning(f"User feedback fields missing or invalid (placeholders used): {', '.join(problems)}")
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("Final parsed user feedback data: %s", json.dumps(feedback_data, ensure_ascii=False, indent=2))
+    return feedback_data
 
-        # 1. 總結 - 移除方括號 `[]` 以匹配模型輸出，並調整結束匹配符
-        summary_match = re.search(r"1\.?\s*使用者整體表現總結\s*[:：]?\s*(?:\**)?([\s\S]*?)(?=\n*\s*2\.?\s*使用者社交技能評分|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
-        if summary_match and summary_match.group(1).strip():
-            feedback_data["summary"] = summary_match.group(1).strip()
-        else:
-            logger.warning("Could not parse user performance summary.")
+def resolve_feedback_request(data):
+    """有 session_id 且未附 messages 時，直接評估伺服器端保存的對話。"""
+    if data.get('session_id') and 'messages' not in data:
+        session = session_store.get(data['session_id'])
+        if session is None:
+            raise SessionNotFoundError(f"找不到對話 session {data['session_id']}，請重新傳送完整的 messages。")
+        return data.get('goal') or session["goal"] or "一般對話練習", session["messages"], data.get('character') or session["character"] or {}
+    return data.get('goal', "一般對話練習"), data.get('messages', []), data.get('character', {})
 
-        # 2. 評分區塊 - 移除方括號 `[]`，並調整結束匹配符
-        score_categories_map = { 
-            "clarity": "表達清晰度", "empathy": "同理心展現", "confidence": "自信程度",
-            "appropriateness": "言談適當性", "goalAchievement": "目標達成技巧"
-        }
-        scores_block_match = re.search(r"2\.?\s*使用者社交技能評分(?:\s*\(0-100分?\))?\s*[:：]?\s*([\s\S]*?)(?=\n*\s*3\.?\s*使用者本次對話的優點|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
-        if scores_block_match:
-            scores_text = scores_block_match.group(1)
-            logger.debug(f"Scores block found:\n{scores_text[:500]}...")
-            for key, name_ch_template in score_categories_map.items():
-                pattern = r"\*\s*" + re.escape(name_ch_template) + \
-                          r"(?:\s*\(" + re.escape(key) + r"\))?" + \
-                          r"\s*[:：]?\s*(\d{1,3})\s*分?\s*-\s*理由\s*[:：]?\s*([^\n]+)"
-                match = re.search(pattern, scores_text, re.IGNORECASE)
-                
-                if match:
-                    try:
-                        score_val_str = match.group(1)
-                        justification_str = match.group(2).strip()
-                        if score_val_str:
-                            score_val = int(score_val_str)
-                            feedback_data["scores"][key]["score"] = max(0, min(100, score_val))
-                        if justification_str:
-                             feedback_data["scores"][key]["justification"] = justification_str
-                        logger.info(f"Parsed score for '{key}': {score_val_str}, Justification: {justification_str}")
-                    except (ValueError, IndexError) as ve: 
-                        logger.warning(f"Error parsing score/justification for '{key}': {ve}. Matched text part: '{match.group(0)[:100]}'. Groups: {match.groups()}")
-                else: 
-                    # Fallback for "目標達成技巧" or any other score item if it doesn't have a numeric score
-                    # This pattern tries to find the justification even if no score is provided.
-                    # It also specifically allows for cases where "分數 - 理由" part is missing完全
-                    no_score_pattern = r"\*\s*" + re.escape(name_ch_template) + \
-                                       r"(?:\s*\(" + re.escape(key) + r"\))?" + \
-                                       r"\s*[:：]?\s*(?:(?:\d{1,3})\s*分?\s*-\s*)?理由\s*[:：]?\s*([^\n]+)"
-                    no_score_match = re.search(no_score_pattern, scores_text, re.IGNORECASE)
-                    if no_score_match:
-                        justification_str = no_score_match.group(1).strip()
-                        feedback_data["scores"][key]["score"] = None # Set score to None if not numeric
-                        feedback_data["scores"][key]["justification"] = justification_str
-                        logger.warning(f"Found non-numeric/missing score for '{key}': Justification: {justification_str}. Setting score to None.")
-                    else:
-                        logger.warning(f"Could not find score item for: '{key}' ({name_ch_template}) in scores block. (Both numeric and non-numeric patterns failed)")
-        else: 
-            logger.warning("Could not find 使用者社交技能評分 block in raw text.")
-
-        # 3. 優點 - 移除方括號 `[]`，並調整結束匹配符
-        strengths_match = re.search(r"3\.?\s*使用者本次對話的優點\s*[:：]?\s*(?:\([^)]+\)\s*)?([\s\S]*?)(?=\n*\s*4\.?\s*給使用者的具體改進建議|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
-        if strengths_match and strengths_match.group(1).strip():
-            strengths_content = strengths_match.group(1).strip()
-            parsed_strengths = [s.strip() for s in re.findall(r"-\s*([^\r\n]+)", strengths_content) if s.strip()]
-            if parsed_strengths: feedback_data["strengths"] = parsed_strengths
-            else: logger.warning(f"Found strengths block but no list items: {strengths_content[:100]}")
-        else:
-            logger.warning("Could not parse user performance strengths.")
-        
-        # 4. 改進建議 - 移除方括號 `[]`，並調整結束匹配符
-        improvements_match = re.search(r"4\.?\s*給使用者的具體改進建議\s*[:：]?\s*(?:\([^)]+\)\s*)?([\s\S]*?)(?:\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
-        if improvements_match and improvements_match.group(1).strip():
-            improvements_content = improvements_match.group(1).strip()
-            parsed_improvements = [s.strip() for s in re.findall(r"-\s*([^\r\n]+)", improvements_content) if s.strip()]
-            if parsed_improvements: feedback_data["improvements"] = parsed_improvements
-            else: logger.warning(f"Found improvements block but no list items: {improvements_content[:100]}")
+def feedback_message_offset(data):
+    session = session_store.get(data['session_id']) if data.get('session_id') and 'messages' not in data else None
+    return session.get("message_offset", 0) if session else 0
 
-        else:
-            logger.warning("Could not parse user performance improvements.")
+def feedback_wait_timeout(limit_seconds):
+    """背景工作最多等 limit_seconds 秒，且至少留一半的剩餘期限給之後的生成。"""
+    remaining = request_deadline.remaining()
+    return limit_seconds if remaining is None else max(0.0, min(limit_seconds, remaining / 2))
 
-        # --- END MODIFICATION IN parse_user_feedback_from_llm ---
+def feedback_digest(data, js_messages, character, history_start):
+    """回饋只評估 token 預算放得下的最近訊息，更早的部分 (history_start 之前) 以滾動摘要補上 (通常聊天時已在背景算好)。"""
+    return conversation_digest(conversation_memory_key(character, data, js_messages), js_messages, history_start, offset=feedback_message_offset(data),
+                               wait_timeout=feedback_wait_timeout(cfg.CONVERSATION_SUMMARY_FEEDBACK_WAIT_SECONDS))
 
-    except Exception as e: 
-        logger.error(f"Critical error during parsing user feedback: {e}\n{traceback.format_exc()}")
+def validate_feedback_request(js_messages, character):
+    """回傳錯誤訊息 (400)，驗證通過則回傳 None。"""
+    if not js_messages: 
+        logger.warning("/api/feedback - Messages list is empty."); return "缺少 messages 欄位"
+    if not character.get('name') or not character.get('description'):
+        logger.warning("/api/feedback - Character name or description is missing."); return "缺少 character.name 或 character.description 欄位"
+    return None
+
+def render_feedback_message(msg):
+    content = msg.get("content", "").strip()
+    return f"{msg.get('role').capitalize()}: {content}\n" if content else ""
+
+def render_feedback_summary(summary):
+    return f"較早的對話摘要 (以下對話記錄之前)：\n{summary}\n\n" if summary else ""
+
+def render_feedback_frame(goal, character):
+    """回傳 (system 區塊, user 回合中對話記錄之前的開頭, 對話記錄之後的指示與結尾)。"""
+    model_config = cfg.USER_FEEDBACK_MODEL_CONFIG
+    instruction = model_config["user_feedback_json_instruction_template" if cfg.USER_FEEDBACK_STRUCTURED_OUTPUT else "user_feedback_instruction_template"]
+    return render_feedback_system_block(goal, character), "<|start_header_id|>user<|end_header_id|>\n\n", f"\n對話記錄結束。\n\n{instruction}<|eot_id|>{ASSISTANT_HEADER}"
+
+def plan_feedback_history(goal, js_messages, character):
+    model_config = cfg.USER_FEEDBACK_MODEL_CONFIG; model_name = model_config["name"]
+    system_block, user_head, instruction_tail = render_feedback_frame(goal, character)
+    fixed = {"system": token_counter.count(system_block, model_name), "instruction": token_counter.count(user_head + "對話記錄開始：\n" + instruction_tail, model_name)}
+    message_tokens = [token_counter.count(render_feedback_message(message), model_name) for message in js_messages]
+    return plan_history("feedback", model_config, fixed, message_tokens)
+
+def create_feedback_prompt_for_ollama(goal, js_messages, character, summary=None, plan=None):
+    """回傳 (prompt, token 報告)。plan 為 plan_feedback_history 的結果 (摘要要涵蓋的範圍取決於它，呼叫端通常已先算好)。"""
+    if plan is None: plan = plan_feedback_history(goal, js_messages, character)
+    relevant_feedback_messages = js_messages[plan["history_start"]:]
+    conversation_history_str = "".join(render_feedback_message(msg) for msg in relevant_feedback_messages)
+    system_block, user_head, instruction_tail = render_feedback_frame(goal, character)
+    summary_str = render_feedback_summary(summary)
+    full_feedback_prompt = f"{system_block}{user_head}{summary_str}對話記錄開始：\n{conversation_history_str}{instruction_tail}"
     
-    logger.info(f"Final parsed user feedback data: {json.dumps(feedback_data, ensure_ascii=False, indent=2)}")
-    return feedback_data
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("User Feedback full prompt (first 500 chars): %s...", repr(full_feedback_prompt)[:500])
+    logger.debug("Number of messages included in conversation_history_str for feedback: %d", len(relevant_feedback_messages))
+    return full_feedback_prompt, finish_prompt_plan(plan, summary_str)
+
+def evaluate_raw_user_feedback(raw_llm_feedback, model_name):
+    if not raw_llm_feedback or not raw_llm_feedback.strip():
+        logger.warning(f"LLM returned empty or whitespace-only feedback for model {model_name}.")
+        return {
+            "summary": "AI 未能成功產生回饋內容，請稍後再試或調整提示。",
+            "scores": {k: {"score": None, "justification": "AI 未回傳有效評分"} for k in {"clarity", "empathy", "confidence", "appropriateness", "goalAchievement"}}, 
+            "strengths": ["AI 未提供"], "improvements": ["AI 未提供"]
+        }
+    return parse_user_feedback_from_llm(raw_llm_feedback)
+
+def build_feedback_payload(full_feedback_prompt):
+    payload = build_generate_payload(cfg.USER_FEEDBACK_MODEL_CONFIG, full_feedback_prompt)
+    if cfg.USER_FEEDBACK_STRUCTURED_OUTPUT: payload["format"] = FEEDBACK_JSON_SCHEMA
+    return payload
+
+def render_feedback_system_block(goal, character):
+    base_system_prompt = cfg.USER_FEEDBACK_MODEL_CONFIG["base_system_prompt_template"].format(
+        goal=goal, character_name=character.get('name'), character_description=character.get('description'))
+    return f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{base_system_prompt}<|eot_id|>"
+
+def assess_user_turn(context, previous_messages, new_messages):
+    """逐輪評估 (在 turn_assessments 的背景執行緒執行)：只評估 new_messages 中 User 的發言，previous_messages 作為上下文。"""
+    model_config = cfg.FEEDBACK_TURN_ASSESSMENT_CONFIG; model_name = model_config["name"]
+    previous_str = "".join(render_feedback_message(msg) for msg in previous_messages)
+    new_str = "".join(render_feedback_message(msg) for msg in new_messages)
+    user_turn_content = (f"先前的對話：\n{previous_str}\n" if previous_str else "") + f"本輪對話：\n{new_str}\n{model_config['instruction_template']}"
+    # 與回饋評估共用系統 prompt 與節點親和，最後生成總結時這段前綴已在 KV cache 裡
+    prompt = f"{render_feedback_system_block(context['goal'], context['character'])}<|start_header_id|>user<|end_header_id|>\n\n{user_turn_content}<|eot_id|>{ASSISTANT_HEADER}"
+    payload = build_generate_payload(model_config, prompt)
+    payload["format"] = TURN_ASSESSMENT_SCHEMA
+    raw_assessment, _ = call_ollama_api("/api/generate", payload, f"{model_name} (turn assessment)", affinity_key=context["affinity_key"], mode="feedback_turn")
+    assessment, problems = parse_turn_assessment(raw_assessment)
+    if problems: logger.warning(f"Turn assessment fields missing or invalid: {', '.join(problems)}")
+    return assessment
+
+turn_assessments = TurnAssessmentCache(assess_user_turn, max_workers=cfg.FEEDBACK_INCREMENTAL_MAX_WORKERS, context_messages=cfg.FEEDBACK_INCREMENTAL_CONTEXT_MESSAGES,
+                                       store=ConversationStateStore(cfg.CONVERSATION_STATE_SQLITE_PATH, "turn_assessments", cfg.SESSION_TTL_SECONDS)
+                                       if cfg.CONVERSATION_STATE_SQLITE_PATH else None)
+
+def turn_assessment_context(goal, character, data):
+    return {"goal": goal, "character": character, "affinity_key": conversation_affinity_key("feedback", character, data)}
+
+def observe_user_turn(session, character_info, goal, js_messages, mode, data):
+    """角色扮演的每一輪把使用者的新發言交給背景逐輪評估，結束時的回饋只需要合併。"""
+    if not cfg.FEEDBACK_INCREMENTAL_ENABLED or mode != "character_play" or not character_info: return
+    turn_assessments.observe(conversation_memory_key(character_info, data, js_messages), js_messages, offset=session.get("message_offset", 0) if session else 0,
+                             context=turn_assessment_context(goal, character_info, data))
+
+def render_merged_assessment(feedback):
+    lines = [f"* {SCORE_CATEGORIES[key]}: {item['score']} 分 - {item['justification']}" for key, item in feedback["scores"].items() if item["score"] is not None]
+    lines += [f"優點: {item}" for item in feedback["strengths"]] + [f"改進建議: {item}" for item in feedback["improvements"]]
+    return "\n".join(lines)
+
+def plan_incremental_feedback(goal, js_messages, character, data):
+    """回傳 (合併後的 userEvaluation, 總結的 payload, 逐輪評估資訊, token 報告)。
+    聊天時沒有逐輪評估這段對話、或等不到它涵蓋全部使用者發言時回傳 None，呼叫端改做完整評估。"""
+    if not cfg.FEEDBACK_INCREMENTAL_ENABLED: return None
+    turns, complete = turn_assessments.collect(conversation_memory_key(character, data, js_messages), js_messages, offset=feedback_message_offset(data),
+                                               context=turn_assessment_context(goal, character, data),
+                                               wait_timeout=feedback_wait_timeout(cfg.FEEDBACK_INCREMENTAL_WAIT_SECONDS))
+    if not turns or not complete:
+        outcome = "untracked" if turns is None else "incomplete"
+        INCREMENTAL_FEEDBACK.inc(outcome=outcome)
+        logger.info("Per-turn assessments %s for this conversation, evaluating the whole transcript", outcome)
+        return None
+    merged = merge_turn_assessments(turns)
+    model_config = cfg.FEEDBACK_MERGED_SUMMARY_CONFIG; model_name = model_config["name"]
+    system_block = render_feedback_system_block(goal, character)
+    instruction = model_config["instruction_template"].format(assessment=render_merged_assessment(merged))
+    prompt = f"{system_block}<|start_header_id|>user<|end_header_id|>\n\n{instruction}<|eot_id|>{ASSISTANT_HEADER}"
+    report = token_report(prompt_token_budget("feedback", model_config), token_counter.exact(),
+                          {"system": token_counter.count(system_block, model_name), "assessments": token_counter.count(prompt[len(system_block):], model_name)}, 0, 0)
+    observe_prompt_tokens(report, model_name, "feedback")
+    info = {"turns": len(turns), "assessed_user_messages": sum(turn["user_messages"] for turn in turns)}
+    return merged, build_generate_payload(model_config, prompt), info, report
+
+def finish_incremental_feedback(merged, raw_summary, info, prompt_tokens):
+    summary = (raw_summary or "").strip()
+    if summary: merged["summary"] = summary
+    else: logger.warning("LLM returned an empty summary for the merged per-turn assessments.")
+    INCREMENTAL_FEEDBACK.inc(outcome="merged")
+    return {"model": cfg.FEEDBACK_MERGED_SUMMARY_CONFIG["name"], "created_at": datetime.now(timezone.utc).isoformat(), "userEvaluation": merged, "raw_feedback": raw_summary,
+            "prompt_tokens": prompt_tokens, "incremental": info, "done": True}
+
+def run_feedback_evaluation(goal, js_messages, character, data, progress=None):
+    """產生並解析使用者回饋，回傳 /api/feedback 的回應內容。progress 不為 None 時改用串流，每收到一個片段就回報已生成的 token 數。
+    聊天時已在背景逐輪評估過全部使用者發言時，只合併評估並生成一段短的總結。"""
+    model_config = cfg.USER_FEEDBACK_MODEL_CONFIG; model_name = model_config["name"]
+    affinity_key = conversation_affinity_key("feedback", character, data)
+    with stage("assessment_wait", model_name, "feedback"): incremental = plan_incremental_feedback(goal, js_messages, character, data)
+    if incremental is not None:
+        merged, payload, info, prompt_tokens = incremental
+        if progress is not None:
+            progress(generated_tokens=0, num_predict=payload["options"].get("num_predict"), completed_sections=["scores", "strengths", "improvements"])
+        raw_summary, _ = call_ollama_api("/api/generate", payload, model_name, affinity_key=affinity_key, mode="feedback")
+        return finish_incremental_feedback(merged, raw_summary, info, prompt_tokens)
+    with stage("token_count", model_name, "feedback"): plan = plan_feedback_history(goal, js_messages, character)
+    with stage("summary_wait", model_name, "feedback"): summary = feedback_digest(data, js_messages, character, plan["history_start"])
+    with stage("prompt_build", model_name, "feedback"):
+        full_feedback_prompt, prompt_tokens = create_feedback_prompt_for_ollama(goal, js_messages, character, summary=summary, plan=plan)
+        payload = build_feedback_payload(full_feedback_prompt)
+    if progress is None:
+        raw_llm_feedback, _ = call_ollama_api("/api/generate", payload, model_name, affinity_key=affinity_key, mode="feedback")
+    else:
+        text_chunks, structured_stream, completed_sections = [], StructuredFeedbackStream(), []
+        for text_chunk, chunk_data in request_deadline.guard(call_ollama_api_stream("/api/generate", payload, model_name, affinity_key=affinity_key, mode="feedback")):
+            text_chunks.append(text_chunk)
+            if cfg.USER_FEEDBACK_STRUCTURED_OUTPUT: completed_sections.extend(key for key, _ in structured_stream.feed(text_chunk))
+            progress(generated_tokens=chunk_data.get("eval_count") or len(text_chunks), num_predict=model_config["ollama_options"].get("num_predict"),
+                     completed_sections=list(completed_sections))
+        raw_llm_feedback = "".join(text_chunks).strip()
+
+    parsed_user_feedback = evaluate_raw_user_feedback(raw_llm_feedback, model_name)
+    return {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "userEvaluation": parsed_user_feedback, "raw_feedback": raw_llm_feedback, "prompt_tokens": prompt_tokens, "incremental": None, "done": True}
+
+def feedback_job_dedup_key(goal, js_messages, character):
+    material = json.dumps([goal, character, [[m.get("role"), m.get("content", "")] for m in js_messages]], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def run_feedback_job(job, request_data):
+    # 背景工作沒有連線可偵測，只沿用送出時的期限 (前端輪詢的總等待時間)
+    request_deadline.start(deadline=request_data.get("deadline"))
+    try:
+        return run_feedback_evaluation(request_data["goal"], request_data["js_messages"], request_data["character"], request_data["data"],
+                                       progress=lambda **progress: feedback_jobs.report_progress(job, **progress))
+    finally:
+        request_deadline.finish()
+
+feedback_jobs = FeedbackJobManager(run_feedback_job, max_workers=cfg.FEEDBACK_JOB_MAX_WORKERS, max_queued=cfg.FEEDBACK_JOB_MAX_QUEUED,
+                                   retention_seconds=cfg.FEEDBACK_JOB_RETENTION_SECONDS, retry_after=cfg.OLLAMA_RETRY_AFTER_SECONDS,
+                                   sqlite_path=cfg.FEEDBACK_JOB_SQLITE_PATH)
+
+def notify_feedback_job_callback(callback_url):
+    """工作完成後把最終狀態 POST 到 callback_url (webhook)；失敗只記錄，不影響輪詢結果。"""
+    def notify(job_snapshot):
+        try:
+            requests.post(callback_url, json=job_snapshot, timeout=cfg.FEEDBACK_JOB_CALLBACK_TIMEOUT_SECONDS).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Feedback job {job_snapshot['job_id']} callback to {callback_url} failed: {e}")
+    return notify
+
+def feedback_job_response_body(job_snapshot):
+    return dict(job_snapshot, poll_url=f"/api/feedback/jobs/{job_snapshot['job_id']}")
 
 @app.route('/api/feedback', methods=['POST'])
 def feedback_endpoint():
@@ -345,67 +1201,170 @@ def feedback_endpoint():
         data = request.get_json()
         if not data: logger.warning("/api/feedback - Request body is not JSON"); return jsonify({"error": "請求主體必須是 JSON"}), 400
         
-        goal = data.get('goal', "一般對話練習") 
-        js_messages = data.get('messages', [])
-        character = data.get('character', {})
+        note_request(mode="feedback")
+        with stage("validation"):
+            goal, js_messages, character = resolve_feedback_request(data)
+            validation_error = validate_feedback_request(js_messages, character)
+        if validation_error: return jsonify({"error": validation_error}), 400
 
-        if not js_messages: 
-            logger.warning("/api/feedback - Messages list is empty."); return jsonify({"error": "缺少 messages 欄位"}), 400
-        if not character.get('name') or not character.get('description'):
-            logger.warning("/api/feedback - Character name or description is missing."); return jsonify({"error": "缺少 character.name 或 character.description 欄位"}), 400
+        if data.get('async'):
+            callback_url = data.get('callback_url')
+            job_snapshot, deduplicated = feedback_jobs.submit(feedback_job_dedup_key(goal, js_messages, character),
+                                                              {"goal": goal, "js_messages": list(js_messages), "character": character, "data": data,
+                                                               "deadline": request_deadline.current_deadline()},
+                                                              on_finished=notify_feedback_job_callback(callback_url) if callback_url else None)
+            logger.info("/api/feedback - async job %s (%s)", job_snapshot['job_id'], 'deduplicated' if deduplicated else 'queued')
+            return jsonify(dict(feedback_job_response_body(job_snapshot), deduplicated=deduplicated)), 202
 
-        model_config = cfg.USER_FEEDBACK_MODEL_CONFIG; model_name = model_config["name"]
-        
-        feedback_history_limit = 10 
-        relevant_feedback_messages = js_messages[-feedback_history_limit:]
-        
-        conversation_history_str = ""
-        for msg in relevant_feedback_messages:
-            role = msg.get("role")
-            content = msg.get("content", "").strip()
-            if not content: continue 
-            conversation_history_str += f"{role.capitalize()}: {content}\n" 
-        
-        base_system_prompt = model_config["base_system_prompt_template"].format(
-            goal=goal, 
-            character_name=character.get('name'), 
-            character_description=character.get('description')
-        )
-
-        user_turn_content = f"""對話記錄開始：
-{conversation_history_str}
-對話記錄結束。
-
-{model_config["user_feedback_instruction_template"]}""" 
-
-        full_feedback_prompt = (
-            f"<|begin_of_text|>"
-            f"<|start_header_id|>system<|end_header_id|>\n\n{base_system_prompt}<|eot_id|>"
-            f"<|start_header_id|>user<|end_header_id|>\n\n{user_turn_content}<|eot_id|>"
-            f"<|start_header_id|>assistant<|end_header_id|>\n\n"
-        )
-        
-        logger.debug(f"User Feedback full prompt (first 500 chars): {repr(full_feedback_prompt)[:500]}...")
-        logger.debug(f"Number of messages included in conversation_history_str for feedback: {len(relevant_feedback_messages)}")
-
-        payload = {"model": model_name, "prompt": full_feedback_prompt, "stream": False, "raw": True, "options": model_config["ollama_options"]}
-        raw_llm_feedback, _ = call_ollama_api("/api/generate", payload, model_name)
-        
-        if not raw_llm_feedback or not raw_llm_feedback.strip():
-            logger.warning(f"LLM returned empty or whitespace-only feedback for model {model_name}.")
-            parsed_user_feedback = {
-                "summary": "AI 未能成功產生回饋內容，請稍後再試或調整提示。",
-                "scores": {k: {"score": None, "justification": "AI 未回傳有效評分"} for k in {"clarity", "empathy", "confidence", "appropriateness", "goalAchievement"}}, 
-                "strengths": ["AI 未提供"], "improvements": ["AI 未提供"]
-            }
-        else:
-            parsed_user_feedback = parse_user_feedback_from_llm(raw_llm_feedback)
-
-        return jsonify({"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "userEvaluation": parsed_user_feedback, "raw_feedback": raw_llm_feedback, "done": True}), 200
+        return jsonify(run_feedback_evaluation(goal, js_messages, character, data)), 200
+    except SessionNotFoundError as e:
+        logger.warning(f"/api/feedback - {e}")
+        return jsonify({"error": str(e), "done": True}), 404
+    except OllamaOverloadedError as e:
+        return overloaded_response(e, cfg.USER_FEEDBACK_MODEL_CONFIG.get("name"))
+    except request_deadline.RequestAbandonedError as e:
+        return abandoned_response(e, cfg.USER_FEEDBACK_MODEL_CONFIG.get("name"))
     except Exception as e:
         logger.error(f"API /api/feedback (user eval) unhandled error: {e}\n{traceback.format_exc()}")
         return jsonify({"error": str(e), "done": True, "model": cfg.USER_FEEDBACK_MODEL_CONFIG.get("name")}), 500
 
+def evaluate_feedback_record(record):
+    """批次評估的單筆紀錄。每筆用自己的 session_id 當摘要與節點親和的 key，避免同角色同目標的紀錄互相覆蓋摘要。"""
+    data = dict(record, session_id=f"batch:{batch_record_id(record, 0)}")
+    goal, js_messages, character = resolve_feedback_request(data)
+    validation_error = validate_feedback_request(js_messages, character)
+    if validation_error: raise ValueError(validation_error)
+    return run_feedback_evaluation(goal, js_messages, character, data)
+
+def read_feedback_batch_records(req):
+    """接受 {"records": [...]} 的 JSON 或一行一筆紀錄的 NDJSON；格式錯誤時丟出 ValueError。"""
+    return parse_batch_records(req.get_data(as_text=True), req.mimetype in ("application/x-ndjson", "application/jsonl"))
+
+@app.route('/api/feedback/batch', methods=['POST'])
+def feedback_batch_endpoint():
+    """以 NDJSON 串流回傳批次評估結果：每完成一筆輸出一行 {"type": "result", ...}，最後一行為含吞吐量的 {"type": "done", ...}。"""
+    try:
+        records = read_feedback_batch_records(request)
+        concurrency = parse_batch_concurrency(request.args.get('concurrency'), cfg.FEEDBACK_BATCH_MAX_CONCURRENCY)
+    except ValueError as e:
+        logger.warning(f"/api/feedback/batch - invalid request: {e}")
+        return jsonify({"error": str(e)}), 400
+    if not records: return jsonify({"error": "缺少 records 欄位"}), 400
+    runner = BatchFeedbackRunner(evaluate_feedback_record, concurrency=concurrency)
+    logger.info("/api/feedback/batch - %d records, concurrency %d", len(records), runner.concurrency)
+
+    def generate():
+        for result in runner.run(records):
+            yield json.dumps(dict(result, type="result"), ensure_ascii=False) + "\n"
+        stats = runner.stats()
+        logger.info("/api/feedback/batch finished: %s", stats)
+        yield json.dumps(dict(stats, type="done", done=True), ensure_ascii=False) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route('/api/feedback/jobs/<job_id>', methods=['GET'])
+def feedback_job_endpoint(job_id):
+    """?wait=N 時長輪詢最多 N 秒 (上限 FEEDBACK_JOB_MAX_POLL_WAIT_SECONDS)，狀態或進度一有變化就回傳。"""
+    wait_seconds = min(max(request.args.get('wait', 0, type=float), 0.0), cfg.FEEDBACK_JOB_MAX_POLL_WAIT_SECONDS)
+    job_snapshot = feedback_jobs.get(job_id, wait_seconds=wait_seconds)
+    if job_snapshot is None: return jsonify({"error": f"找不到回饋工作 {job_id} (可能已過期)"}), 404
+    return jsonify(feedback_job_response_body(job_snapshot)), 200
+
+@app.route('/api/ollama_client/stats', methods=['GET'])
+def ollama_client_stats_endpoint():
+    return jsonify(dict(ollama_client.pool_stats(), prompt_cache=prompt_cache_tracker.stats(), tokenizer=token_counter.stats(), generation_rates=generation_rates.stats(), warmup=model_warmer.stats(), coalescing=ollama_single_flight.stats(), sessions=session_store.stats(), summaries=summary_cache.stats(), turn_assessments=turn_assessments.stats(), response_cache=response_cache.stats(), feedback_jobs=feedback_jobs.stats(), dropped_log_records=dropped_log_records())), 200
+
+def model_warmup_targets():
+    """每個模型的預熱 payload：各模式共用的系統 prompt 前綴 (不含角色、目標以外的對話內容)，只生成 1 個 token。
+    options 與一般請求相同 (尤其是 num_ctx)，預熱載入的模型才會被之後的請求直接沿用。"""
+    prefixes = [(cfg.CHAT_MODEL_CONFIG, render_chat_system_block(render_chat_system_prompt("", None, mode))) for mode in ("character_play", "assistant")]
+    prefixes.append((cfg.USER_FEEDBACK_MODEL_CONFIG, render_feedback_frame("", {"name": "", "description": ""})[0]))
+    targets = {}
+    for model_config, prefix in prefixes:
+        payload = build_generate_payload(model_config, prefix)
+        targets.setdefault(model_config["name"], []).append(dict(payload, options=dict(payload["options"], num_predict=1)))
+    return targets
+
+def ollama_backend_post(backend_url, endpoint_path, payload):
+    """直接送到指定後端 (不經過路由與 limiter)：預熱要涵蓋每個後端，且在接受流量之前進行。"""
+    response = ollama_client.session.post(f"{backend_url}{endpoint_path}", json=payload, timeout=cfg.MODEL_WARMUP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def ollama_loaded_models(backend_url):
+    response = ollama_client.session.get(f"{backend_url}/api/ps", timeout=(5, 10))
+    response.raise_for_status()
+    return {name for entry in response.json().get("models", []) for name in (entry.get("name"), entry.get("model")) if name}
+
+model_warmer = ModelWarmer([backend.url for backend in ollama_client.router.backends], model_warmup_targets(), ollama_backend_post, ollama_loaded_models,
+                           keep_alive=cfg.OLLAMA_KEEP_ALIVE, heartbeat_seconds=cfg.MODEL_HEARTBEAT_SECONDS, retry_seconds=cfg.MODEL_WARMUP_RETRY_SECONDS)
+
+def readiness():
+    """回傳 (body, status)。WSGI 伺服器不會執行 __main__，第一次被探測時才啟動預熱。"""
+    if not cfg.MODEL_WARMUP_ENABLED: return {"ready": True, "warmup": "disabled"}, 200
+    model_warmer.start()
+    warmup_stats = model_warmer.stats()
+    return warmup_stats, 200 if warmup_stats["ready"] else 503
+
+@app.route('/healthz', methods=['GET'])
+def healthz_endpoint():
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz_endpoint():
+    body, status = readiness()
+    return jsonify(body), status
+
+def limiter_gauge(field):
+    def collect():
+        values = {}
+        for limiter in admission_limiters:
+            for model, model_stats in limiter.stats().items(): values[(model,)] = values.get((model,), 0) + model_stats[field]
+        return values
+    return collect
+
+def admission_class_gauge(field):
+    def collect():
+        values = {}
+        for limiter in admission_limiters:
+            for model, model_stats in limiter.stats().items():
+                for request_class, class_stats in model_stats["classes"].items():
+                    values[(model, request_class)] = values.get((model, request_class), 0) + class_stats[field]
+        return values
+    return collect
+
+METRICS_REGISTRY.register(GaugeCallback("wingchat_ollama_in_flight", "Generations currently running per model.", ("model",), limiter_gauge("in_flight")))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_ollama_waiting", "Requests waiting for a generation slot per model.", ("model",), limiter_gauge("waiting")))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_admission_queue_depth", "Requests waiting for a generation slot per request class.", ("model", "request_class"), admission_class_gauge("waiting")))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_admission_in_flight", "Generations currently running per request class.", ("model", "request_class"), admission_class_gauge("in_flight")))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_coalesced_requests_total", "Requests served by an identical in-flight Ollama generation.", ("kind",),
+                                        lambda: {("call",): ollama_single_flight.stats()["coalesced_calls"], ("stream",): ollama_single_flight.stats()["coalesced_streams"]}, metric_type="counter"))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_cancelled_generations_total", "Shared Ollama generations aborted because every waiting client disconnected.", ("kind",),
+                                        lambda: {("call",): ollama_single_flight.stats()["cancelled_calls"], ("stream",): ollama_single_flight.stats()["cancelled_streams"]}, metric_type="counter"))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_model_ready", "1 when the model has been warmed up on the backend and is kept resident by the keep_alive heartbeat.", ("model", "backend"),
+                                        lambda: {(model, backend_url): int(state["status"] == "ready") for backend_url, models in model_warmer.stats()["backends"].items() for model, state in models.items()}))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_turn_assessments_total", "Per-turn background assessments of the user's newest messages.", ("outcome",),
+                                        lambda: {("completed",): turn_assessments.stats()["assessments_completed"], ("failed",): turn_assessments.stats()["assessments_failed"]}, metric_type="counter"))
+METRICS_REGISTRY.register(GaugeCallback("wingchat_dropped_log_records", "Log records dropped because the log queue was full.", (), lambda: {(): dropped_log_records()}))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(METRICS_REGISTRY.render(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def get_session_endpoint(session_id):
+    session = session_store.get(session_id)
+    if session is None: return jsonify({"error": f"找不到對話 session {session_id}"}), 404
+    return jsonify({key: session[key] for key in ("session_id", "mode", "goal", "character", "messages", "updated_at")}), 200
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session_endpoint(session_id):
+    return jsonify({"session_id": session_id, "deleted": session_store.delete(session_id)}), 200
+
 if __name__ == '__main__':
-    logger.info("Starting Flask application (WingChat Backend)...")
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    # 開發用的單一行程伺服器；正式環境請用 serve.py (pre-fork 多行程、排空後重新啟動)
+    debug = os.environ.get("FLASK_DEBUG") == "1"
+    host, port = os.environ.get("HOST", "0.0.0.0"), int(os.environ.get("PORT", 5001))
+    logger.info("Starting Flask application (WingChat Backend) on http://%s:%d ...", host, port)  # werkzeug 的啟動訊息與存取紀錄已降到 WARNING
+    # debug 模式的 reloader 會在父行程也執行這裡，只在實際服務請求的子行程預熱
+    if cfg.MODEL_WARMUP_ENABLED and (not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"): model_warmer.start()
+    app.run(host=host, port=port, debug=debug, threaded=True)
\ No newline at end of file
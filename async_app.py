@@ -0,0 +1,621 @@
+"""WingChat 後端的 asyncio 服務模式 (aiohttp)。
+
+與 app.py 提供相同的 /api/chat_py 與 /api/feedback JSON 介面，但等待 Ollama 時不佔用執行緒，
+單一行程即可同時掛著數百個等待中的對話。Prompt 組裝、後處理與回饋解析都直接沿用 app.py。
+
+啟動方式: python async_app.py  (需要 pip install aiohttp)
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import traceback
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+import app as wingchat
+import request_deadline
+from early_stop import aclose_early, stop_reason
+from ollama_client import AdmissionQueue, OllamaOverloadedError, OllamaRouter
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY as METRICS_REGISTRY, observe_admission_wait, observe_stage, record_aborted_generation, record_ollama_response, server_timing_header, stage
+from request_logging import current_timings, note_request, request_field
+from session_store import SessionNotFoundError
+from single_flight import AsyncSingleFlight, coalescing_key
+
+cfg = wingchat.cfg
+logger = wingchat.logger
+
+
+class AsyncModelConcurrencyLimiter:
+    """ModelConcurrencyLimiter 的 asyncio 版本：同樣由 AdmissionQueue 決定排隊中的請求誰先取得名額，佇列滿或逾時丟出 OllamaOverloadedError。"""
+
+    def __init__(self, max_in_flight, max_waiting, wait_timeout, retry_after, scheduling=None, max_waiting_per_user=None):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.max_waiting_per_user = max_waiting_per_user or max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.scheduling = scheduling or {"class_weights": {"default": 1}}
+        self._queues = {}
+
+    def _queue(self, model):
+        queue = self._queues.get(model)
+        if queue is None: queue = self._queues[model] = AdmissionQueue(self.max_in_flight, **self.scheduling)
+        return queue
+
+    @staticmethod
+    def _wake(granted):
+        for ticket in granted:
+            if ticket.waiter is not None and not ticket.waiter.done(): ticket.waiter.set_result(None)
+
+    async def acquire(self, model, request_class=None, user=None, cost=None):
+        """回傳 ticket，生成結束後以 release(model, ticket) 歸還名額。"""
+        queue = self._queue(model)
+        ticket = queue.ticket(request_class, user, cost)
+        queue.push(ticket)
+        self._wake(queue.dispatch())
+        if ticket.granted: return ticket
+        if queue.waiting() > self.max_waiting:
+            queue.remove(ticket)
+            raise OllamaOverloadedError(f"模型 {model} 的等待佇列已滿，請稍後再試。", self.retry_after)
+        if ticket.user != "-" and queue.waiting(user=ticket.user) > self.max_waiting_per_user:
+            queue.remove(ticket)
+            raise OllamaOverloadedError(f"同時等待中的請求過多 (模型 {model})，請等前面的回覆完成後再試。", self.retry_after)
+        ticket.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.waiter), timeout=self.wait_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.granted:
+                # 名額剛好在逾時 (或取消) 的同時給了這個請求：逾時就照常使用，取消則立即歸還
+                if isinstance(e, asyncio.TimeoutError): return ticket
+                self.release(model, ticket)
+                raise
+            queue.remove(ticket)
+            if isinstance(e, asyncio.CancelledError): raise
+            raise OllamaOverloadedError(f"模型 {model} 排隊等待超過 {self.wait_timeout} 秒，請稍後再試。", self.retry_after)
+        return ticket
+
+    def release(self, model, ticket):
+        queue = self._queues[model]
+        queue.finish(ticket)
+        self._wake(queue.dispatch())
+
+    def stats(self):
+        return {model: {"in_flight": queue.in_flight, "waiting": queue.waiting(), "max_in_flight": self.max_in_flight, "max_waiting": self.max_waiting,
+                        "classes": queue.class_stats()}
+                for model, queue in self._queues.items()}
+
+
+class AsyncOllamaClient:
+    def __init__(self, router, pool_maxsize, limiter):
+        self.router = router
+        self.pool_maxsize = pool_maxsize
+        self.limiter = limiter
+        self.single_flight = AsyncSingleFlight(counters=wingchat.ollama_single_flight.counters)  # 與 app.py 共用計數，/metrics 只有一份
+        self.session = None
+
+    async def start(self, _app=None):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_maxsize, keepalive_timeout=60))
+
+    async def close(self, _app=None):
+        if self.session is not None: await self.session.close()
+
+    async def generate(self, payload, model_name_for_log, timeout=(25, 120), affinity_key=None, monitor=None, mode=None):
+        """與 wingchat.call_ollama_api 相同的回傳值與錯誤訊息，只是不阻塞事件迴圈。相同 payload 正在生成時共用其結果。
+        用戶端斷線或超過期限時取消等待；沒有其他人在等同一個生成時連同上游請求一起取消。
+        帶 monitor (EarlyStopMonitor) 時改以串流取回，monitor 回報停止原因就中止生成。mode 與 wingchat.call_ollama_api 相同，只用於指標的 label。"""
+        if monitor is not None: return await request_deadline.until_abandoned(self._collect_stream(payload, model_name_for_log, timeout, affinity_key, monitor, mode))
+        payload = budget_payload(payload, model_name_for_log)
+        call = lambda: self._generate(payload, model_name_for_log, timeout, affinity_key)
+        if not cfg.OLLAMA_COALESCE_REQUESTS: return await request_deadline.until_abandoned(call())
+        (generated_text, response_data), shared = await request_deadline.until_abandoned(self.single_flight.do(coalescing_key("/api/generate", payload), call))
+        if not shared: return generated_text, response_data
+        note_request(coalesced=True)
+        return generated_text, dict(response_data)
+
+    async def _collect_stream(self, payload, model_name_for_log, timeout, affinity_key, monitor, mode=None):
+        """wingchat._collect_ollama_stream 的 asyncio 版本 (只用於提前停止)。"""
+        text_chunks, response_data = [], {}
+        chunks = request_deadline.async_guard(self.generate_stream(payload, model_name_for_log, timeout, affinity_key))
+        try:
+            async for text_chunk, response_data in chunks:
+                text_chunks.append(text_chunk)
+                monitor.feed(text_chunk)
+                if monitor.reason is not None: break
+        finally:
+            stopped_early = monitor.reason is not None and not response_data.get("done")
+            if stopped_early: await aclose_early(chunks, monitor.reason)
+            else: await chunks.aclose()
+        if stopped_early:
+            early_stop = wingchat.early_stop_report(monitor, payload, response_data.get("model", model_name_for_log), mode)
+            return monitor.text, dict(response_data, response=monitor.text, done=True, done_reason="early_stop", early_stop=early_stop)
+        generated_text = "".join(text_chunks)
+        return generated_text.strip(), dict(response_data, response=generated_text)
+
+    async def _post(self, payload, model_name_for_log, timeout, affinity_key):
+        """與 OllamaClient.post 相同：挑選後端送出請求，連線失敗時把該後端記為失敗 (連續失敗會被剔除) 並換下一個後端重試。
+        回傳 (backend, response, started)；之後由呼叫端關閉 response 並把請求從該後端的 in-flight 計數移除。"""
+        tried = []
+        while True:
+            backend = self.router.acquire(affinity_key, exclude=tried)
+            ollama_url = f"{backend.url}/api/generate"
+            started = time.monotonic()
+            try:
+                logger.info("Sending async request to Ollama (%s), Model: %s", ollama_url, model_name_for_log)
+                client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=request_deadline.read_timeout(timeout[1]))
+                return backend, await self.session.post(ollama_url, json=payload, timeout=client_timeout), started
+            except aiohttp.ClientConnectionError as e:
+                self.router.release(backend, time.monotonic() - started, ok=False)
+                tried.append(backend)
+                if isinstance(e, asyncio.TimeoutError) and request_deadline.abandoned(): raise
+                if len(tried) >= len(self.router.backends):
+                    logger.error(f"Connection error calling Ollama API ({model_name_for_log}) at {ollama_url}: {e}")
+                    raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {backend.url}") from e
+                logger.warning("Ollama backend %s unreachable (%s); retrying on another backend", backend.url, e)
+            except asyncio.CancelledError:
+                self.router.release(backend, time.monotonic() - started, ok=True)
+                raise
+            except Exception:
+                self.router.release(backend, time.monotonic() - started, ok=False)
+                raise
+
+    async def _generate(self, payload, model_name_for_log, timeout, affinity_key):
+        model = payload.get("model", model_name_for_log)
+        started = time.monotonic()
+        ticket = await self.limiter.acquire(model, **wingchat.admission_options(payload, None))
+        observe_stage("queue_wait", time.monotonic() - started, model)
+        observe_admission_wait(model, ticket)
+        check_after_queue(self.limiter, payload, model, ticket)
+        backend, started, ok = None, time.monotonic(), False
+        try:
+            backend, response, started = await self._post(payload, model_name_for_log, timeout, affinity_key)
+            async with response:
+                ok = response.status < 500
+                if response.status >= 400:
+                    error_detail_str = await response.text()
+                    if response.status == 404 and "not found" in error_detail_str.lower():
+                        raise Exception(f"Ollama API 錯誤: 模型 '{model}' 未找到。")
+                    raise Exception(f"Ollama API ({model_name_for_log}) 請求錯誤: HTTP {response.status} - Details: {error_detail_str}")
+                response_data = await response.json(content_type=None)
+            generated_text = response_data.get("response", "").strip()
+            observe_stage("ollama_http", time.monotonic() - started, model)
+            record_ollama_response(response_data, model)
+            wingchat.generation_rates.observe(model, response_data)
+            note_request(model=model, backend=backend.url, prompt_eval_count=response_data.get("prompt_eval_count"), eval_count=response_data.get("eval_count"))
+            if logger.isEnabledFor(logging.DEBUG): logger.debug("Ollama raw response (Model %s): %s", model_name_for_log, repr(generated_text)[:500])
+            return generated_text, response_data
+        except asyncio.CancelledError:
+            # 所有等待者都已放棄 (斷線或逾期)：離開 async with 時關閉連線，Ollama 停止生成
+            ok = True
+            record_aborted_generation(request_deadline.abandoned() or request_deadline.ClientDisconnectedError.reason, model, None, num_predict_of(payload))
+            raise
+        except asyncio.TimeoutError:
+            ok = False
+            if request_deadline.abandoned() == request_deadline.DeadlineExceededError.reason:
+                record_aborted_generation(request_deadline.DeadlineExceededError.reason, model, None, num_predict_of(payload))
+                raise request_deadline.DeadlineExceededError(f"Ollama API ({model_name_for_log}) 在用戶端期限內沒有回應")
+            logger.error(f"Timeout error calling Ollama API ({model_name_for_log}) at {backend.url if backend else 'the Ollama backends'}")
+            raise Exception(f"Ollama API ({model_name_for_log}) 超時")
+        except aiohttp.ClientConnectionError as e:
+            ok = False
+            logger.error(f"Connection error calling Ollama API ({model_name_for_log}) at {backend.url}: {e}")
+            raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {backend.url}")
+        finally:
+            if backend is not None: self.router.release(backend, time.monotonic() - started, ok=ok)
+            self.limiter.release(model, ticket)
+
+    def generate_stream(self, payload, model_name_for_log, timeout=(25, 120), affinity_key=None):
+        """回傳 async iterator；相同 payload 的串流正在進行時共用它，所有讀取者都 aclose 後才中止上游。"""
+        payload = budget_payload(payload, model_name_for_log)
+        start = lambda: self._generate_stream(payload, model_name_for_log, timeout, affinity_key)
+        if not cfg.OLLAMA_COALESCE_REQUESTS: return start()
+        chunks, shared = self.single_flight.stream(coalescing_key("/api/generate", dict(payload, stream=True)), start)
+        if shared: note_request(coalesced=True)
+        return chunks
+
+    async def _generate_stream(self, payload, model_name_for_log, timeout, affinity_key):
+        model = payload.get("model", model_name_for_log)
+        started = time.monotonic()
+        ticket = await self.limiter.acquire(model, **wingchat.admission_options(payload, None))
+        observe_stage("queue_wait", time.monotonic() - started, model)
+        observe_admission_wait(model, ticket)
+        check_after_queue(self.limiter, payload, model, ticket)
+        backend, started, ok = None, time.monotonic(), False
+        generated_chunks, finished = 0, False
+        note_request(model=model, stream=True)
+        try:
+            backend, response, started = await self._post(dict(payload, stream=True), model_name_for_log, timeout, affinity_key)
+            async with response:
+                ok = response.status < 500
+                if response.status >= 400:
+                    raise Exception(f"Ollama API ({model_name_for_log}) 請求錯誤: HTTP {response.status} - Details: {await response.text()}")
+                async for raw_line in response.content:
+                    if not raw_line.strip(): continue
+                    if generated_chunks == 0: observe_stage("ollama_first_chunk", time.monotonic() - started, model)
+                    generated_chunks += 1
+                    chunk_data = json.loads(raw_line)
+                    if chunk_data.get("error"):
+                        raise Exception(f"Ollama API ({model_name_for_log}) 串流錯誤: {chunk_data['error']}")
+                    if chunk_data.get("done"):
+                        finished = True
+                        observe_stage("ollama_http", time.monotonic() - started, model)
+                        record_ollama_response(chunk_data, model)
+                        wingchat.generation_rates.observe(model, chunk_data)
+                        note_request(backend=backend.url, prompt_eval_count=chunk_data.get("prompt_eval_count"), eval_count=chunk_data.get("eval_count"))
+                    yield chunk_data.get("response", ""), chunk_data
+                    if chunk_data.get("done"): break
+        except (GeneratorExit, asyncio.CancelledError):
+            ok = True
+            if not finished and stop_reason() is None:  # 提前停止由 _collect_stream / stream_chat_reply 另外記錄
+                record_aborted_generation(request_deadline.abandoned() or request_deadline.ClientDisconnectedError.reason, model, None,
+                                          max(0, (num_predict_of(payload) or 0) - generated_chunks))
+            raise
+        except asyncio.TimeoutError:
+            ok = False
+            if request_deadline.abandoned() == request_deadline.DeadlineExceededError.reason:
+                record_aborted_generation(request_deadline.DeadlineExceededError.reason, model, None, max(0, (num_predict_of(payload) or 0) - generated_chunks))
+                raise request_deadline.DeadlineExceededError(f"Ollama API ({model_name_for_log}) 在用戶端期限內沒有回應")
+            raise Exception(f"Ollama API ({model_name_for_log}) 超時")
+        except aiohttp.ClientConnectionError:
+            ok = False
+            raise Exception(f"Ollama API ({model_name_for_log}) 連接錯誤: {backend.url}")
+        finally:
+            if backend is not None: self.router.release(backend, time.monotonic() - started, ok=ok)
+            self.limiter.release(model, ticket)
+
+
+def num_predict_of(payload):
+    return (payload.get("options") or {}).get("num_predict")
+
+
+def budget_payload(payload, model_name_for_log):
+    """送出前檢查期限與斷線並依剩餘時間縮小 num_predict (與 app.py 相同)；在合併之前做，已放棄的請求不會搭上別人的生成。"""
+    model = payload.get("model", model_name_for_log)
+    try:
+        request_deadline.raise_if_abandoned("dispatch")
+        return wingchat.budget_generation_payload(payload, model, None)
+    except request_deadline.RequestAbandonedError as e:
+        record_aborted_generation(f"{e.reason}_before_dispatch", model, None, num_predict_of(payload))
+        raise
+
+
+def check_after_queue(limiter, payload, model, ticket):
+    try:
+        request_deadline.raise_if_abandoned("queue_wait")
+    except request_deadline.RequestAbandonedError as e:
+        limiter.release(model, ticket)
+        record_aborted_generation(f"{e.reason}_in_queue", model, None, num_predict_of(payload))
+        raise
+
+
+def json_response(body, status=200, headers=None):
+    return web.json_response(body, status=status, headers=headers, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+def overloaded_response(error, model_name):
+    logger.warning(f"Rejecting request with 503 (model: {model_name}): {error}")
+    return json_response({"error": str(error), "done": True, "model": model_name}, status=503, headers={"Retry-After": str(error.retry_after)})
+
+
+def abandoned_response(error, model_name):
+    logger.info("Request abandoned (%s, model: %s): %s", error.reason, model_name, error)
+    return json_response({"error": str(error), "reason": error.reason, "done": True, "model": model_name}, status=error.status)
+
+
+async def prompt_token_call(fn, *args, **kwargs):
+    """精確計數 (PROMPT_TOKENIZER=ollama) 時每則新訊息都要同步呼叫 /api/tokenize，放到執行緒 (to_thread 會帶著 contextvars)；估計模式直接在 event loop 上算。"""
+    if wingchat.token_counter.remote: return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+async def read_json_body(request):
+    try:
+        return await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+async def chat_py_handler(request):
+    data = None
+    try:
+        data = await read_json_body(request)
+        if not data: logger.warning("/api/chat_py - Request body is not JSON"); return json_response({"error": "請求主體必須是 JSON"}, status=400)
+
+        with stage("validation"):
+            session, character_info, goal, js_messages, mode = wingchat.resolve_chat_session(data)
+            note_request(mode=mode)
+            validation_error = wingchat.validate_chat_request(character_info, goal, js_messages, mode)
+        if validation_error: return json_response({"error": validation_error}, status=400)
+        wingchat.observe_user_turn(session, character_info, goal, js_messages, mode, data)
+
+        model_config = cfg.CHAT_MODEL_CONFIG; model_name = model_config["name"]
+        with stage("prompt_build", model_name):
+            payload, full_prompt = await prompt_token_call(wingchat.build_chat_payload, session, goal, js_messages, character_info, mode, memory_key=wingchat.conversation_memory_key(character_info, data, js_messages))
+        ollama = request.app["ollama"]
+        affinity_key = wingchat.conversation_affinity_key(mode, character_info, data)
+        candidate_count, candidate_error = wingchat.resolve_candidate_count(data, mode)
+        if candidate_error: return json_response({"error": candidate_error}, status=400)
+        if candidate_count > 1:
+            candidates, response_data = await generate_reply_candidates(ollama, payload, model_name, candidate_count, affinity_key, js_messages, data.get('seed'), mode)
+            wingchat.record_chat_session_turn(session, candidates[0]["content"], response_data)
+            response_body = {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": candidates[0]["content"]}, "candidates": candidates, "prompt_tokens": request_field("prompt_tokens"), "done": True}
+            if session is not None: response_body["session_id"] = session["session_id"]
+            return json_response(response_body)
+        if data.get('stream'):
+            return await stream_chat_reply(request, ollama, payload, model_name, mode, affinity_key, session, full_prompt)
+        cache_key = wingchat.chat_response_cache_key(mode, payload, full_prompt)
+        cached = wingchat.lookup_cached_chat_response(cache_key, mode)
+        if cached is not None:
+            raw_reply, response_data, prompt_cache_report = cached["text"], cached["response_data"], None
+        else:
+            raw_reply, response_data = await ollama.generate(payload, model_name, affinity_key=affinity_key, monitor=wingchat.chat_stop_monitor(), mode=mode)
+            prompt_cache_report = wingchat.record_prompt_cache(affinity_key, model_name, full_prompt, response_data)
+            wingchat.store_cached_chat_response(cache_key, raw_reply, response_data)
+        final_reply = wingchat.post_process_line_style_reply(raw_reply, mode_log=f"{mode} mode output")
+        wingchat.record_chat_session_turn(session, final_reply, response_data)
+        response_body = {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": final_reply}, "prompt_cache": prompt_cache_report, "prompt_tokens": request_field("prompt_tokens"), "cached": cached is not None, "early_stop": response_data.get("early_stop"), "done": True}
+        if session is not None: response_body["session_id"] = session["session_id"]
+        return json_response(response_body)
+    except SessionNotFoundError as e:
+        logger.warning(f"/api/chat_py - {e}")
+        return json_response({"error": str(e), "done": True}, status=404)
+    except OllamaOverloadedError as e:
+        return overloaded_response(e, cfg.CHAT_MODEL_CONFIG.get("name"))
+    except request_deadline.RequestAbandonedError as e:
+        return abandoned_response(e, cfg.CHAT_MODEL_CONFIG.get("name"))
+    except Exception as e:
+        mode_for_log = data.get('mode', 'N/A') if isinstance(data, dict) else 'N/A'
+        logger.error(f"API /api/chat_py (mode: {mode_for_log}, async) unhandled error: {e}\n{traceback.format_exc()}")
+        return json_response({"error": str(e), "done": True, "model": cfg.CHAT_MODEL_CONFIG.get("name")}, status=500)
+
+
+async def generate_reply_candidates(ollama, payload, model_name, count, affinity_key, js_messages, base_seed=None, mode=None):
+    """wingchat.generate_reply_candidates 的 asyncio 版本：count 個生成同時等待，不佔用執行緒。"""
+    variants = wingchat.candidate_payloads(payload, count, base_seed)
+    outcomes = await asyncio.gather(*(ollama.generate(variant, model_name, affinity_key=affinity_key, monitor=wingchat.chat_stop_monitor(), mode=mode)
+                                      for variant, _ in variants), return_exceptions=True)
+    results, response_data_by_seed, errors = [], {}, []
+    for (_, extra), outcome in zip(variants, outcomes):
+        if isinstance(outcome, BaseException):
+            errors.append(outcome); continue
+        raw_reply, response_data = outcome
+        if response_data.get("early_stop"): extra = dict(extra, early_stop=response_data["early_stop"])
+        results.append((extra, raw_reply)); response_data_by_seed[extra["seed"]] = response_data
+    if not results: raise errors[0]
+    if errors: logger.warning("%d of %d reply candidates failed: %s", len(errors), count, errors[0])
+    ranked = wingchat.rank_reply_candidates(results, js_messages)
+    note_request(candidates=len(ranked))
+    return ranked, response_data_by_seed[ranked[0]["seed"]]
+
+
+async def replay_cached_reply(cached):
+    """命中回應快取時以單一片段重播，與 Ollama 串流走同一條逐行處理的路徑。"""
+    yield cached["text"], cached["response_data"]
+
+
+async def stream_chat_reply(request, ollama, payload, model_name, mode, affinity_key=None, session=None, full_prompt=None):
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    processor = wingchat.LineStyleStreamProcessor()
+    monitor = wingchat.chat_stop_monitor(processor)
+    feed, finish = (monitor.feed, monitor.finish) if monitor is not None else (processor.feed, processor.finish)
+    line_index = 0
+    final_chunk = {}
+
+    async def send(event):
+        await response.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    try:
+        full_prompt = full_prompt or payload["prompt"]
+        cache_key = wingchat.chat_response_cache_key(mode, payload, full_prompt)
+        cached = wingchat.lookup_cached_chat_response(cache_key, mode)
+        if cached is not None:
+            chunks = replay_cached_reply(cached)
+        else:
+            chunks = request_deadline.async_guard(ollama.generate_stream(payload, model_name, affinity_key=affinity_key))
+        try:
+            async for text_chunk, final_chunk in chunks:
+                for line in feed(text_chunk):
+                    await send({"type": "line", "index": line_index, "content": line}); line_index += 1
+                if monitor is not None and monitor.reason is not None: break
+        finally:
+            # 斷線時立即退訂，最後一個讀取者離開才會中止共用的生成
+            stopped_early = monitor is not None and monitor.reason is not None and not final_chunk.get("done")
+            if stopped_early: await aclose_early(chunks, monitor.reason)
+            else: await chunks.aclose()
+        early_stop = None
+        if stopped_early:
+            early_stop = wingchat.early_stop_report(monitor, payload, model_name, mode)
+            final_chunk = dict(final_chunk, done=True, done_reason="early_stop")
+        else:
+            for line in finish():
+                await send({"type": "line", "index": line_index, "content": line}); line_index += 1
+        if monitor is not None and monitor.reason is not None:
+            raw_reply = final_reply = monitor.text  # 與已送出的 line 事件一致
+        else:
+            raw_reply = processor.raw_text.strip()
+            final_reply = wingchat.post_process_line_style_reply(raw_reply, mode_log=f"{mode} mode streamed output")
+        prompt_cache_report = None
+        if cached is None:
+            prompt_cache_report = wingchat.record_prompt_cache(affinity_key, model_name, full_prompt, final_chunk)
+            wingchat.store_cached_chat_response(cache_key, raw_reply, final_chunk)
+        wingchat.record_chat_session_turn(session, final_reply, final_chunk)
+        done_event = {"type": "done", "model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "message": {"role": "assistant", "content": final_reply}, "prompt_cache": prompt_cache_report, "prompt_tokens": request_field("prompt_tokens"), "cached": cached is not None, "early_stop": early_stop, "done": True}
+        if session is not None: done_event["session_id"] = session["session_id"]
+        await send(done_event)
+    except (ConnectionResetError, request_deadline.ClientDisconnectedError):
+        logger.info(f"/api/chat_py (mode: {mode}, async stream) client disconnected.")
+        return response
+    except Exception as e:
+        logger.error(f"API /api/chat_py (mode: {mode}, async stream) error: {e}\n{traceback.format_exc()}")
+        await send({"type": "error", "error": str(e), "done": True, "model": model_name})
+    await response.write_eof()
+    return response
+
+
+async def feedback_handler(request):
+    try:
+        data = await read_json_body(request)
+        if not data: logger.warning("/api/feedback - Request body is not JSON"); return json_response({"error": "請求主體必須是 JSON"}, status=400)
+
+        note_request(mode="feedback")
+        with stage("validation"):
+            goal, js_messages, character = wingchat.resolve_feedback_request(data)
+            validation_error = wingchat.validate_feedback_request(js_messages, character)
+        if validation_error: return json_response({"error": validation_error}, status=400)
+
+        if data.get('async'):
+            # 非同步工作與 app.py 共用同一個工作管理器 (背景執行緒池)，這裡只負責排入與回傳 job ID
+            callback_url = data.get('callback_url')
+            job_snapshot, deduplicated = wingchat.feedback_jobs.submit(wingchat.feedback_job_dedup_key(goal, js_messages, character),
+                                                                       {"goal": goal, "js_messages": list(js_messages), "character": character, "data": data,
+                                                                        "deadline": request_deadline.current_deadline()},
+                                                                       on_finished=wingchat.notify_feedback_job_callback(callback_url) if callback_url else None)
+            return json_response(dict(wingchat.feedback_job_response_body(job_snapshot), deduplicated=deduplicated), status=202)
+
+        model_config = cfg.USER_FEEDBACK_MODEL_CONFIG; model_name = model_config["name"]
+        affinity_key = wingchat.conversation_affinity_key("feedback", character, data)
+        # asyncio.to_thread 會帶著目前的 contextvars，執行緒內記錄的階段耗時才會算進這個請求
+        with stage("assessment_wait", model_name):
+            incremental = await asyncio.to_thread(wingchat.plan_incremental_feedback, goal, js_messages, character, data)
+        if incremental is not None:
+            merged, payload, info, prompt_tokens = incremental
+            raw_summary, _ = await request.app["ollama"].generate(payload, model_name, affinity_key=affinity_key)
+            return json_response(wingchat.finish_incremental_feedback(merged, raw_summary, info, prompt_tokens))
+        with stage("token_count", model_name):
+            plan = await prompt_token_call(wingchat.plan_feedback_history, goal, js_messages, character)
+        with stage("summary_wait", model_name):
+            summary = await asyncio.to_thread(wingchat.feedback_digest, data, js_messages, character, plan["history_start"])
+        with stage("prompt_build", model_name):
+            full_feedback_prompt, prompt_tokens = wingchat.create_feedback_prompt_for_ollama(goal, js_messages, character, summary=summary, plan=plan)
+            payload = wingchat.build_feedback_payload(full_feedback_prompt)
+        raw_llm_feedback, _ = await request.app["ollama"].generate(payload, model_name, affinity_key=affinity_key)
+        # 解析是純 CPU 工作，放到執行緒池以免卡住其他等待中的連線
+        parsed_user_feedback = await asyncio.to_thread(wingchat.evaluate_raw_user_feedback, raw_llm_feedback, model_name)
+        return json_response({"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "userEvaluation": parsed_user_feedback, "raw_feedback": raw_llm_feedback, "prompt_tokens": prompt_tokens, "incremental": None, "done": True})
+    except SessionNotFoundError as e:
+        logger.warning(f"/api/feedback - {e}")
+        return json_response({"error": str(e), "done": True}, status=404)
+    except OllamaOverloadedError as e:
+        return overloaded_response(e, cfg.USER_FEEDBACK_MODEL_CONFIG.get("name"))
+    except request_deadline.RequestAbandonedError as e:
+        return abandoned_response(e, cfg.USER_FEEDBACK_MODEL_CONFIG.get("name"))
+    except Exception as e:
+        logger.error(f"API /api/feedback (user eval, async) unhandled error: {e}\n{traceback.format_exc()}")
+        return json_response({"error": str(e), "done": True, "model": cfg.USER_FEEDBACK_MODEL_CONFIG.get("name")}, status=500)
+
+
+async def feedback_batch_handler(request):
+    # 批次評估沿用 app.py 的執行緒式 BatchFeedbackRunner，這裡只把逐筆完成的結果轉成串流輸出
+    try:
+        records = wingchat.parse_batch_records(await request.text(), request.content_type in ("application/x-ndjson", "application/jsonl"))
+        concurrency = wingchat.parse_batch_concurrency(request.query.get("concurrency"), cfg.FEEDBACK_BATCH_MAX_CONCURRENCY)
+    except ValueError as e:
+        logger.warning(f"/api/feedback/batch - invalid request: {e}")
+        return json_response({"error": str(e)}, status=400)
+    if not records: return json_response({"error": "缺少 records 欄位"}, status=400)
+    runner = wingchat.BatchFeedbackRunner(wingchat.evaluate_feedback_record, concurrency=concurrency)
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    loop = asyncio.get_running_loop()
+    results = runner.run(records)
+    while (result := await loop.run_in_executor(None, next, results, None)) is not None:
+        await response.write((json.dumps(dict(result, type="result"), ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write((json.dumps(dict(runner.stats(), type="done", done=True), ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def feedback_job_handler(request):
+    job_id = request.match_info["job_id"]
+    try: wait_seconds = min(max(float(request.query.get("wait", 0)), 0.0), cfg.FEEDBACK_JOB_MAX_POLL_WAIT_SECONDS)
+    except ValueError: wait_seconds = 0.0
+    job_snapshot = await asyncio.get_running_loop().run_in_executor(None, wingchat.feedback_jobs.get, job_id, wait_seconds)
+    if job_snapshot is None: return json_response({"error": f"找不到回饋工作 {job_id} (可能已過期)"}, status=404)
+    return json_response(wingchat.feedback_job_response_body(job_snapshot))
+
+
+async def healthz_handler(_request):
+    return json_response({"status": "ok"})
+
+
+async def readyz_handler(_request):
+    body, status = wingchat.readiness()
+    return json_response(body, status=status)
+
+
+async def start_model_warmer(_app):
+    # 預熱在背景執行緒以同步客戶端進行，不佔用事件迴圈
+    if cfg.MODEL_WARMUP_ENABLED: wingchat.model_warmer.start()
+
+
+async def metrics_handler(_request):
+    return web.Response(body=METRICS_REGISTRY.render().encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+@web.middleware
+async def request_log_middleware(request, handler):
+    # 每個請求是獨立的 task，contextvars 中的 request_id 只在這個請求內可見
+    request_id = wingchat.request_log.start(request.headers.get("X-Request-ID"))
+    note_request(user=wingchat.request_user_key(request.headers, request.remote))
+    request_deadline.start(request_deadline.parse_timeout_header(request.headers.get(cfg.REQUEST_TIMEOUT_HEADER), cfg.REQUEST_DEADLINE_MARGIN_SECONDS, cfg.REQUEST_MAX_TIMEOUT_SECONDS),
+                           disconnect_check=(lambda: request.transport is None or request.transport.is_closing()) if cfg.ABORT_ON_CLIENT_DISCONNECT else None)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if not response.prepared:
+            response.headers["X-Request-ID"] = request_id
+            if cfg.SERVER_TIMING_ENABLED and current_timings(): response.headers["Server-Timing"] = server_timing_header(current_timings())
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        wingchat.request_log.finish(method=request.method, path=request.path, route=resource.canonical if resource is not None else "unmatched", status=status)
+        request_deadline.finish()
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    # 與 flask_cors 的預設行為一致：允許所有來源
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "Content-Type")
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    return response
+
+
+def create_app():
+    limiter = AsyncModelConcurrencyLimiter(cfg.OLLAMA_MAX_IN_FLIGHT_PER_MODEL, cfg.OLLAMA_MAX_QUEUED_PER_MODEL,
+                                           cfg.OLLAMA_QUEUE_TIMEOUT_SECONDS, cfg.OLLAMA_RETRY_AFTER_SECONDS,
+                                           scheduling=cfg.OLLAMA_SCHEDULING, max_waiting_per_user=cfg.OLLAMA_MAX_QUEUED_PER_USER)
+    wingchat.admission_limiters.append(limiter)
+    ollama = AsyncOllamaClient(OllamaRouter(cfg.OLLAMA_BACKEND_URLS, **cfg.OLLAMA_ROUTER_OPTIONS), cfg.OLLAMA_POOL_MAXSIZE, limiter)
+    async_app = web.Application(middlewares=[request_log_middleware, cors_middleware])
+    async_app["ollama"] = ollama
+    async_app.on_startup.append(ollama.start)
+    async_app.on_startup.append(start_model_warmer)
+    async_app.on_cleanup.append(ollama.close)
+    async_app.router.add_post("/api/chat_py", chat_py_handler)
+    async_app.router.add_post("/api/feedback", feedback_handler)
+    async_app.router.add_post("/api/feedback/batch", feedback_batch_handler)
+    async_app.router.add_get("/api/feedback/jobs/{job_id}", feedback_job_handler)
+    async_app.router.add_get("/metrics", metrics_handler)
+    async_app.router.add_get("/healthz", healthz_handler)
+    async_app.router.add_get("/readyz", readyz_handler)
+    return async_app
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get("PORT", 5001))
+    logger.info(f"Starting asyncio application (WingChat Backend, aiohttp) on port {port}...")
+    web.run_app(create_app(), host='0.0.0.0', port=port, print=None)
@@ -0,0 +1,223 @@
+"""本地 Ollama 替身：模擬 /api/generate 與 /api/chat (串流與非串流)，不需要 GPU 或 GGUF 模型即可壓測後端。
+
+延遲與 token 速率可設定分佈 (fixed / uniform / exponential / lognormal)，也可依比例注入失敗：
+HTTP 500、卡住不回應 (hang)、串流中途斷線 (drop)。回饋評估的請求 (payload 帶 format，或 prompt 為評估指令)
+會回傳 feedback_corpus.jsonl 中的樣本，讓解析與完整流程都能跑。
+
+用法: python bench/fake_ollama.py --port 11500 --latency 0.5 --tokens-per-second 30 --latency-distribution lognormal --error-rate 0.01
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REPLY = "好啊\n想去哪\n我都可以"
+DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+FEEDBACK_PROMPT_MARKER = "社交技能教練"
+
+DEFAULT_SETTINGS = {
+    "latency": 0.5, "tokens_per_second": 30.0, "reply": DEFAULT_REPLY,
+    "latency_distribution": "fixed", "jitter": 0.3,  # uniform 為 ±jitter 比例；lognormal 為 sigma；exponential 只用平均值
+    "error_rate": 0.0, "hang_rate": 0.0, "hang_seconds": 60.0, "drop_rate": 0.0, "seed": None,
+}
+
+
+def load_feedback_samples(path=os.path.join(BENCH_DIR, "feedback_corpus.jsonl")):
+    samples = {"json": [], "legacy": []}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip(): sample = json.loads(line); samples[sample["format"]].append(sample["text"])
+    return samples
+
+
+def sample_duration(rng, mean, distribution, jitter):
+    if mean <= 0: return 0.0
+    if distribution == "uniform": return rng.uniform(mean * (1 - jitter), mean * (1 + jitter))
+    if distribution == "exponential": return rng.expovariate(1.0 / mean)
+    if distribution == "lognormal": return mean * rng.lognormvariate(-jitter * jitter / 2, jitter)  # 平均值仍為 mean
+    return mean
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/0.2"
+    disable_nagle_algorithm = True  # 標頭與 body 分兩次寫出，開著 Nagle 會讓每個回應多等一次 delayed ACK (~40ms)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200):
+        encoded = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        try: self.wfile.write(encoded)
+        except (BrokenPipeError, ConnectionResetError): self.server.count("client_aborts")  # 後端放棄了請求 (用戶端斷線或逾期)
+
+    def do_GET(self):
+        if self.path in ("/", "/api/version"):
+            self._send_json({"version": "fake"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": [{"name": "my-custom-llama3:latest"}]})
+        elif self.path == "/api/fake/stats":
+            self._send_json(self.server.stats())
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request_body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path not in ("/api/generate", "/api/chat"):
+            self._send_json({"error": "not found"}, status=404)
+            return
+        server = self.server
+        settings = server.settings
+        failure = server.draw_failure()
+        server.count("requests")
+        if failure == "error":
+            server.count("errors")
+            self._send_json({"error": "fake ollama: injected failure"}, status=500)
+            return
+        if failure == "hang":
+            server.count("hangs")
+            time.sleep(settings["hang_seconds"])
+            self.close_connection = True
+            return
+        reply = server.reply_for(self.path, request_body)
+        tokens_per_second = server.draw_tokens_per_second()
+        token_delay = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+        started = time.monotonic()
+        prompt_seconds = server.draw_latency()
+        time.sleep(prompt_seconds)
+        if request_body.get("stream", self.path == "/api/chat"):  # 與 Ollama 相同：/api/chat 預設串流
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            drop_at = len(reply) // 2 if failure == "drop" else None
+            for index, token in enumerate(reply):
+                if index == drop_at:
+                    server.count("drops")
+                    self.close_connection = True
+                    return
+                time.sleep(token_delay)
+                if not self._write_chunk(self._chunk(request_body, token, done=False)):
+                    return
+            self._write_chunk(dict(self._chunk(request_body, "", done=True), **self._final_fields(request_body, reply, started, prompt_seconds)))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            time.sleep(token_delay * len(reply))
+            if failure == "drop":
+                server.count("drops")
+                self.close_connection = True
+                return
+            self._send_json(dict(self._chunk(request_body, reply, done=True), **self._final_fields(request_body, reply, started, prompt_seconds)))
+
+    def _chunk(self, request_body, text, done):
+        if self.path == "/api/chat":
+            return {"model": request_body.get("model"), "message": {"role": "assistant", "content": text}, "done": done}
+        return {"model": request_body.get("model"), "response": text, "done": done}
+
+    def _write_chunk(self, body):
+        line = (json.dumps(body, ensure_ascii=False) + "\n").encode("utf-8")
+        try:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("client_aborts")
+            return False
+
+    def _final_fields(self, request_body, reply, started, prompt_seconds):
+        total_ns = int((time.monotonic() - started) * 1e9)
+        prompt_text = request_body.get("prompt") or "".join(message.get("content", "") for message in request_body.get("messages", []))
+        return {
+            "done_reason": "stop", "total_duration": total_ns, "load_duration": 0,
+            "prompt_eval_count": len(prompt_text) // 2, "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": len(reply), "eval_duration": max(0, total_ns - int(prompt_seconds * 1e9)),
+        }
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, FakeOllamaHandler)
+        self.settings = settings
+        self._rng = random.Random(settings["seed"])
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._feedback_samples = None
+
+    def count(self, name):
+        with self._lock: self._counters[name] = self._counters.get(name, 0) + 1
+
+    def stats(self):
+        with self._lock: return dict(self._counters)
+
+    def draw_failure(self):
+        settings = self.settings
+        with self._lock: roll = self._rng.random()
+        for failure, rate in (("error", settings["error_rate"]), ("hang", settings["hang_rate"]), ("drop", settings["drop_rate"])):
+            if roll < rate: return failure
+            roll -= rate
+        return None
+
+    def draw_latency(self):
+        with self._lock: return sample_duration(self._rng, self.settings["latency"], self.settings["latency_distribution"], self.settings["jitter"])
+
+    def draw_tokens_per_second(self):
+        tokens_per_second = self.settings["tokens_per_second"]
+        if tokens_per_second <= 0: return 0.0
+        # 以每個 token 的耗時套用同一個分佈，平均速率仍為 tokens_per_second
+        with self._lock: token_seconds = sample_duration(self._rng, 1.0 / tokens_per_second, self.settings["latency_distribution"], self.settings["jitter"])
+        return 1.0 / token_seconds if token_seconds > 0 else 0.0
+
+    def reply_for(self, path, request_body):
+        if path == "/api/generate" and (request_body.get("format") or FEEDBACK_PROMPT_MARKER in request_body.get("prompt", "")):
+            if self._feedback_samples is None: self._feedback_samples = load_feedback_samples()
+            candidates = self._feedback_samples["json" if request_body.get("format") else "legacy"]
+            with self._lock: return self._rng.choice(candidates)
+        return self.settings["reply"]
+
+
+def serve(port=11500, latency=0.5, tokens_per_second=30.0, reply=DEFAULT_REPLY, **options):
+    """options 見 DEFAULT_SETTINGS (latency_distribution、jitter、error_rate、hang_rate、hang_seconds、drop_rate、seed)。"""
+    unknown = set(options) - set(DEFAULT_SETTINGS)
+    if unknown: raise TypeError(f"unknown fake Ollama options: {', '.join(sorted(unknown))}")
+    settings = dict(DEFAULT_SETTINGS, latency=latency, tokens_per_second=tokens_per_second, reply=reply, **options)
+    if settings["latency_distribution"] not in DISTRIBUTIONS: raise ValueError(f"latency_distribution must be one of {DISTRIBUTIONS}")
+    return FakeOllamaServer(("127.0.0.1", port), settings)
+
+
+def add_arguments(parser):
+    """讓其他壓測腳本沿用同一組 Ollama 替身參數。"""
+    parser.add_argument("--latency", type=float, default=DEFAULT_SETTINGS["latency"], help="回應前的平均延遲 (秒)，模擬 prompt 評估")
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_SETTINGS["tokens_per_second"], help="平均生成速率，0 代表一次回完")
+    parser.add_argument("--latency-distribution", choices=DISTRIBUTIONS, default=DEFAULT_SETTINGS["latency_distribution"])
+    parser.add_argument("--jitter", type=float, default=DEFAULT_SETTINGS["jitter"], help="uniform 的 ±比例或 lognormal 的 sigma")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回 HTTP 500 的比例")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="卡住 --hang-seconds 秒後斷線的比例 (觸發逾時)")
+    parser.add_argument("--hang-seconds", type=float, default=DEFAULT_SETTINGS["hang_seconds"])
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="生成到一半斷線的比例")
+    parser.add_argument("--seed", type=int, help="固定亂數種子，讓延遲與失敗可重現")
+
+
+def options_from_args(args):
+    return {"latency_distribution": args.latency_distribution, "jitter": args.jitter, "error_rate": args.error_rate, "hang_rate": args.hang_rate,
+            "hang_seconds": args.hang_seconds, "drop_rate": args.drop_rate, "seed": args.seed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--reply", default=DEFAULT_REPLY)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"Fake Ollama listening on http://127.0.0.1:{args.port}")
+    serve(args.port, args.latency, args.tokens_per_second, args.reply, **options_from_args(args)).serve_forever()
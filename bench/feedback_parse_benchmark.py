@@ -0,0 +1,59 @@
+"""比較回饋解析的耗時：舊版 regex 串接 (legacy_feedback_parser.py) 與 feedback_parser.py 的單次掃描 / 結構化解析。
+
+用法: python bench/feedback_parse_benchmark.py [--corpus bench/feedback_corpus.jsonl] [--iterations 2000]
+語料每行為 {"format": "legacy" | "json", "text": 模型原始輸出}；可換成實際錄下的輸出。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import feedback_parser  # noqa: E402
+import legacy_feedback_parser  # noqa: E402
+
+
+def time_per_call(fn, text, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations): fn(text)
+    return (time.perf_counter() - started) / iterations
+
+
+def stream_parse(text, chunk_size=8):
+    stream = feedback_parser.StructuredFeedbackStream()
+    for start in range(0, len(text), chunk_size): stream.feed(text[start:start + chunk_size])
+    return stream.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "feedback_corpus.jsonl"))
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    # 舊版每次解析都會以 INFO 輸出整份結果；關掉 logging 只比較解析本身
+    logging.disable(logging.CRITICAL)
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    print(f"{len(corpus)} samples, {args.iterations} iterations each")
+    print(f"{'#':>3} {'format':<8}{'chars':>7}{'legacy µs':>11}{'new µs':>9}{'stream µs':>11}{'speedup':>9}  same result")
+    totals = {"legacy": 0.0, "new": 0.0}
+    for index, sample in enumerate(corpus):
+        text = sample["text"]
+        legacy_time = time_per_call(legacy_feedback_parser.parse_user_feedback_from_llm, text, args.iterations)
+        new_time = time_per_call(feedback_parser.parse_feedback_text, text, args.iterations)
+        stream_time = time_per_call(stream_parse, text, args.iterations) if sample["format"] == "json" else None
+        totals["legacy"] += legacy_time; totals["new"] += new_time
+        # 結構化輸出舊版無法解析 (只剩佔位文字)，所以只比對自由文字樣本的結果是否一致
+        same = legacy_feedback_parser.parse_user_feedback_from_llm(text) == feedback_parser.parse_feedback_text(text)[0] if sample["format"] == "legacy" else "-"
+        stream_column = f"{stream_time * 1e6:>11.1f}" if stream_time is not None else f"{'-':>11}"
+        print(f"{index:>3} {sample['format']:<8}{len(text):>7}{legacy_time * 1e6:>11.1f}{new_time * 1e6:>9.1f}{stream_column}{legacy_time / new_time:>8.1f}x  {same}")
+    print(f"total: legacy {totals['legacy'] * 1e6:.1f} µs, new {totals['new'] * 1e6:.1f} µs ({totals['legacy'] / totals['new']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
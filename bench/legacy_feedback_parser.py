@@ -0,0 +1,102 @@
+"""baseline：結構化輸出之前 app.py 的 parse_user_feedback_from_llm (原樣保留)，供 feedback_parse_benchmark.py 比較解析時間與結果。"""
+import json
+import logging
+import re
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def parse_user_feedback_from_llm(raw_feedback_text):
+    logger.debug(f"Parsing user performance feedback text (length: {len(raw_feedback_text)}):\n{raw_feedback_text[:1500]}...")
+    feedback_data = {
+        "summary": "AI 未能提供整體總結。",
+        "scores": { "clarity": {"score": None, "justification": "AI 未提供"}, "empathy": {"score": None, "justification": "AI 未提供"},
+                    "confidence": {"score": None, "justification": "AI 未提供"}, "appropriateness": {"score": None, "justification": "AI 未提供"},
+                    "goalAchievement": {"score": None, "justification": "AI 未提供"} },
+        "strengths": ["AI 未提供具體優點"], "improvements": ["AI 未提供具體建議"]
+    }
+    try:
+        # --- START MODIFICATION IN parse_user_feedback_from_llm ---
+        # (This section was already modified and validated in previous steps)
+
+        # 1. 總結 - 移除方括號 `[]` 以匹配模型輸出，並調整結束匹配符
+        summary_match = re.search(r"1\.?\s*使用者整體表現總結\s*[:：]?\s*(?:\**)?([\s\S]*?)(?=\n*\s*2\.?\s*使用者社交技能評分|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
+        if summary_match and summary_match.group(1).strip():
+            feedback_data["summary"] = summary_match.group(1).strip()
+        else:
+            logger.warning("Could not parse user performance summary.")
+
+        # 2. 評分區塊 - 移除方括號 `[]`，並調整結束匹配符
+        score_categories_map = { 
+            "clarity": "表達清晰度", "empathy": "同理心展現", "confidence": "自信程度",
+            "appropriateness": "言談適當性", "goalAchievement": "目標達成技巧"
+        }
+        scores_block_match = re.search(r"2\.?\s*使用者社交技能評分(?:\s*\(0-100分?\))?\s*[:：]?\s*([\s\S]*?)(?=\n*\s*3\.?\s*使用者本次對話的優點|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
+        if scores_block_match:
+            scores_text = scores_block_match.group(1)
+            logger.debug(f"Scores block found:\n{scores_text[:500]}...")
+            for key, name_ch_template in score_categories_map.items():
+                pattern = r"\*\s*" + re.escape(name_ch_template) + \
+                          r"(?:\s*\(" + re.escape(key) + r"\))?" + \
+                          r"\s*[:：]?\s*(\d{1,3})\s*分?\s*-\s*理由\s*[:：]?\s*([^\n]+)"
+                match = re.search(pattern, scores_text, re.IGNORECASE)
+                
+                if match:
+                    try:
+                        score_val_str = match.group(1)
+                        justification_str = match.group(2).strip()
+                        if score_val_str:
+                            score_val = int(score_val_str)
+                            feedback_data["scores"][key]["score"] = max(0, min(100, score_val))
+                        if justification_str:
+                             feedback_data["scores"][key]["justification"] = justification_str
+                        logger.info(f"Parsed score for '{key}': {score_val_str}, Justification: {justification_str}")
+                    except (ValueError, IndexError) as ve: 
+                        logger.warning(f"Error parsing score/justification for '{key}': {ve}. Matched text part: '{match.group(0)[:100]}'. Groups: {match.groups()}")
+                else: 
+                    # Fallback for "目標達成技巧" or any other score item if it doesn't have a numeric score
+                    # This pattern tries to find the justification even if no score is provided.
+                    # It also specifically allows for cases where "分數 - 理由" part is missing完全
+                    no_score_pattern = r"\*\s*" + re.escape(name_ch_template) + \
+                                       r"(?:\s*\(" + re.escape(key) + r"\))?" + \
+                                       r"\s*[:：]?\s*(?:(?:\d{1,3})\s*分?\s*-\s*)?理由\s*[:：]?\s*([^\n]+)"
+                    no_score_match = re.search(no_score_pattern, scores_text, re.IGNORECASE)
+                    if no_score_match:
+                        justification_str = no_score_match.group(1).strip()
+                        feedback_data["scores"][key]["score"] = None # Set score to None if not numeric
+                        feedback_data["scores"][key]["justification"] = justification_str
+                        logger.warning(f"Found non-numeric/missing score for '{key}': Justification: {justification_str}. Setting score to None.")
+                    else:
+                        logger.warning(f"Could not find score item for: '{key}' ({name_ch_template}) in scores block. (Both numeric and non-numeric patterns failed)")
+        else: 
+            logger.warning("Could not find 使用者社交技能評分 block in raw text.")
+
+        # 3. 優點 - 移除方括號 `[]`，並調整結束匹配符
+        strengths_match = re.search(r"3\.?\s*使用者本次對話的優點\s*[:：]?\s*(?:\([^)]+\)\s*)?([\s\S]*?)(?=\n*\s*4\.?\s*給使用者的具體改進建議|\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
+        if strengths_match and strengths_match.group(1).strip():
+            strengths_content = strengths_match.group(1).strip()
+            parsed_strengths = [s.strip() for s in re.findall(r"-\s*([^\r\n]+)", strengths_content) if s.strip()]
+            if parsed_strengths: feedback_data["strengths"] = parsed_strengths
+            else: logger.warning(f"Found strengths block but no list items: {strengths_content[:100]}")
+        else:
+            logger.warning("Could not parse user performance strengths.")
+        
+        # 4. 改進建議 - 移除方括號 `[]`，並調整結束匹配符
+        improvements_match = re.search(r"4\.?\s*給使用者的具體改進建議\s*[:：]?\s*(?:\([^)]+\)\s*)?([\s\S]*?)(?:\Z)", raw_feedback_text, re.DOTALL | re.IGNORECASE)
+        if improvements_match and improvements_match.group(1).strip():
+            improvements_content = improvements_match.group(1).strip()
+            parsed_improvements = [s.strip() for s in re.findall(r"-\s*([^\r\n]+)", improvements_content) if s.strip()]
+            if parsed_improvements: feedback_data["improvements"] = parsed_improvements
+            else: logger.warning(f"Found improvements block but no list items: {improvements_content[:100]}")
+
+        else:
+            logger.warning("Could not parse user performance improvements.")
+
+        # --- END MODIFICATION IN parse_user_feedback_from_llm ---
+
+    except Exception as e: 
+        logger.error(f"Critical error during parsing user feedback: {e}\n{traceback.format_exc()}")
+    
+    logger.info(f"Final parsed user feedback data: {json.dumps(feedback_data, ensure_ascii=False, indent=2)}")
+    return feedback_data
@@ -0,0 +1,65 @@
+"""baseline：共用後處理模組之前的兩個版本 (app.py 的 post_process_line_style_reply 與 model/ollama_api_chat.py 的 post_process_reply，原樣保留)，
+供 postprocess_benchmark.py 比較每則回覆的處理成本與結果。"""
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+POST_PROCESS_PREFIX_PATTERN = re.compile(
+    r'^\s*(?:好的[,，]?這是我(?:的|建議的)回覆：|你可以(?:這麼|這樣)說：|我建議你回覆：|(?:Okay|Ok|Alright|Sure)[,.]?\s*(?:here(?: is|\'s)\s*(?:a|my|the)?\s*(?:suggestion|reply)|I suggest|you could say)[:：]?|話翼|AI|Assistant|模型|回答|建議|助手|WingChat)\s*[:：]?\s*',
+    re.IGNORECASE | re.DOTALL
+)
+POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE = "、；：「」『』（）《》\"'();:"
+
+
+def post_process_line_style_reply(raw_ai_reply, mode_log="reply"):
+    logger.debug(f"Pre-processing {mode_log} (LINE style): {repr(raw_ai_reply)}")
+    cleaned_reply = POST_PROCESS_PREFIX_PATTERN.sub('', raw_ai_reply).strip()
+    cleaned_reply = re.sub(r'^```json\s*\{[\s\S]*?\}\s*```', '', cleaned_reply, flags=re.DOTALL | re.MULTILINE).strip()
+    cleaned_reply = re.sub(r'^\{[\s\S]*?\}$', '', cleaned_reply, flags=re.DOTALL | re.MULTILINE).strip()
+
+    # 此處保留上次的修改：POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE 不再移除逗號和句號
+    temp_reply_chars = [char for char in cleaned_reply if char not in POST_PROCESS_PUNCTUATION_TO_REMOVE_FOR_LINE_STYLE]
+    cleaned_reply = "".join(temp_reply_chars)
+    cleaned_reply = cleaned_reply.replace('\\n', '\n').replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line.strip() for line in cleaned_reply.split('\n') if line.strip()]
+    final_output = "\n".join(lines)
+    if not final_output and raw_ai_reply.strip(): 
+        logger.warning(f"Post-processing for {mode_log} resulted in empty string for non-empty raw reply. Raw: {repr(raw_ai_reply)}. Returning original stripped reply.")
+        return raw_ai_reply.strip() 
+    elif not final_output and not raw_ai_reply.strip(): 
+        logger.info(f"Post-processing for {mode_log}: Raw reply was empty, returning empty.")
+        return "" 
+        
+    logger.debug(f"Post-processed {mode_log} (LINE style) - FINAL OUTPUT: {repr(final_output)}")
+    return final_output
+
+
+prefix_pattern = re.compile(r'^\s*(?:話翼|AI|Assistant|模型|回答|建議|你|You|assistant)\s*[:：]?\s*', re.IGNORECASE) # 增加了 "你", "You", "assistant"
+punctuation_to_remove = ".。、；：「」『』（）《》\"'();:" # 逗號已由此處移除 (冒號仍在此處，移除如 10:30 的冒號)
+
+def post_process_reply(raw_ai_reply):
+    if not raw_ai_reply or raw_ai_reply.isspace(): # 修改: 提早返回如果輸入為空
+        return ""
+
+    cleaned_reply_step1 = prefix_pattern.sub('', raw_ai_reply).strip()
+
+    # 替換半形和全形逗號為空格
+    cleaned_reply_step2 = cleaned_reply_step1.replace(',', ' ').replace('，', ' ')
+
+    # 移除其他禁止的標點符號
+    cleaned_reply_step3 = cleaned_reply_step2
+    for punc in punctuation_to_remove:
+        cleaned_reply_step3 = cleaned_reply_step3.replace(punc, '')
+
+    # 將字串中的 '\\n' 轉換為實際的換行符 '\n'
+    # 模型被指示輸出 '\\n' (兩個字符的字串)
+    cleaned_reply_step4 = cleaned_reply_step3.replace('\\n', '\n')
+
+    processed_reply = cleaned_reply_step4.strip() # 再次 strip 確保首尾無多餘空白或換行
+    lines = processed_reply.split('\n')
+    # 清理每行首尾空格，並移除空行
+    cleaned_lines = [line.strip() for line in lines if line.strip()]
+
+    final_reply = "\n".join(cleaned_lines)
+    return final_reply
@@ -0,0 +1,225 @@
+"""重播錄下的對話壓測 /api/chat_py 與 /api/feedback，並附上熱點函式的微基準；可與先前的報告比較，超過門檻時以非零結束碼失敗。
+
+用法:
+    python bench/load_test.py --concurrency 32 --requests 500 --latency 0.3 --latency-distribution lognormal --error-rate 0.01
+    python bench/load_test.py --json report.json                                  # 存下基準
+    python bench/load_test.py --baseline report.json --max-regression 0.2         # 部署前比較 (p95 與微基準變慢超過 20% 就失敗)
+    python bench/load_test.py --url http://127.0.0.1:5001 --skip-micro            # 打已經在跑的後端 (此時不會啟動 Ollama 替身)
+    python bench/load_test.py --endpoints /api/chat_py --background-feedback 4    # 背景持續跑回饋評估時，聊天的 p95 應維持不變
+
+對話檔每行為 {"endpoint": "/api/chat_py" | "/api/feedback", "body": 請求內容}；預設使用 bench/conversations.jsonl，依序循環重播。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+import fake_ollama  # noqa: E402
+from postprocess_benchmark import SAMPLE_REPLIES  # noqa: E402
+from serving_benchmark import SERVERS, percentile, wait_until_listening  # noqa: E402
+
+SERVER_CHOICES = {"threaded": "threaded (app.run)", "async": "asyncio (async_app.py)", "prefork": "pre-fork (serve.py)"}
+
+
+def read_conversations(path, endpoints=None):
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if endpoints: records = [record for record in records if record["endpoint"] in endpoints]
+    if not records: raise SystemExit(f"{path} 中沒有可重播的請求")
+    return records
+
+
+def request_label(record):
+    return record["endpoint"] + (" (stream)" if record["body"].get("stream") else "")
+
+
+async def send_one(session, base_url, record):
+    """回傳 (latency, 首個位元組的時間, 錯誤種類或 None)。串流回應中的 {"type": "error"} 事件也算錯誤。"""
+    started = time.perf_counter()
+    first_byte = None
+    try:
+        async with session.post(base_url + record["endpoint"], json=record["body"]) as response:
+            body = b""
+            async for chunk in response.content.iter_any():
+                if first_byte is None: first_byte = time.perf_counter() - started
+                body += chunk
+            if response.status != 200: return time.perf_counter() - started, first_byte, f"http_{response.status}"
+            if record["body"].get("stream") and b'"type": "error"' in body: return time.perf_counter() - started, first_byte, "stream_error"
+    except asyncio.TimeoutError:
+        return time.perf_counter() - started, first_byte, "client_timeout"
+    except aiohttp.ClientError as e:
+        return time.perf_counter() - started, first_byte, type(e).__name__
+    return time.perf_counter() - started, first_byte, None
+
+
+async def run_load(base_url, records, total_requests, concurrency, timeout, background_records=(), background_concurrency=0):
+    """background_records 由另外 background_concurrency 個 worker 持續重播，直到前景的請求跑完為止 (結果標上 [background])。"""
+    results = {}
+    next_index = 0
+    foreground_done = False
+    connector = aiohttp.TCPConnector(limit=concurrency + background_concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def worker():
+            nonlocal next_index
+            while next_index < total_requests:
+                record = records[next_index % len(records)]; next_index += 1
+                results.setdefault(request_label(record), []).append(await send_one(session, base_url, record))
+
+        async def background_worker(offset):
+            index = offset
+            while not foreground_done:
+                record = background_records[index % len(background_records)]; index += background_concurrency
+                results.setdefault(request_label(record) + " [background]", []).append(await send_one(session, base_url, record))
+
+        background = [asyncio.ensure_future(background_worker(offset)) for offset in range(background_concurrency if background_records else 0)]
+        if background: await asyncio.sleep(0.5)  # 讓背景工作先佔住名額，前景請求才是在競爭下量測
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        foreground_done = True
+        await asyncio.gather(*background)
+    foreground = [sample for label, samples in results.items() if not label.endswith("[background]") for sample in samples]
+    return {label: summarize(samples, elapsed) for label, samples in sorted(results.items())} | {"all": summarize(foreground, elapsed)}
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for latency, _, error in samples if error is None)
+    first_bytes = sorted(first_byte for _, first_byte, error in samples if error is None and first_byte is not None)
+    errors = {}
+    for _, _, error in samples:
+        if error is not None: errors[error] = errors.get(error, 0) + 1
+    return {"requests": len(samples), "ok": len(latencies), "throughput": len(latencies) / elapsed, "error_rate": (len(samples) - len(latencies)) / len(samples),
+            "errors": errors, "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99),
+            "mean": statistics.fmean(latencies) if latencies else 0.0, "first_byte_p50": percentile(first_bytes, 0.50)}
+
+
+def time_per_call(fn, args_list, iterations, repeats=5):
+    """取 repeats 輪中最快的一輪，降低其他行程干擾。"""
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for args in args_list: fn(*args)
+        elapsed = (time.perf_counter() - started) / (iterations * len(args_list))
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_microbenchmarks(records, iterations):
+    import app  # 延遲匯入：只打外部後端時不需要載入 app 的設定
+    logging.disable(logging.CRITICAL)
+    chat_args = [(body.get("goal", ""), body.get("messages", []), body.get("character"), body.get("mode", "character_play"))
+                 for body in (record["body"] for record in records if record["endpoint"] == "/api/chat_py")]
+    with open(os.path.join(BENCH_DIR, "feedback_corpus.jsonl"), encoding="utf-8") as f:
+        feedback_texts = [(json.loads(line)["text"],) for line in f if line.strip()]
+    benchmarks = {
+        "create_chat_prompt_for_ollama": (app.create_chat_prompt_for_ollama, chat_args),
+        "post_process_line_style_reply": (app.post_process_line_style_reply, [(reply,) for reply in SAMPLE_REPLIES]),
+        "parse_user_feedback_from_llm": (app.parse_user_feedback_from_llm, feedback_texts),
+    }
+    try:
+        return {name: time_per_call(fn, args_list, iterations) * 1e6 for name, (fn, args_list) in benchmarks.items() if args_list}
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def compare_with_baseline(report, baseline, max_regression):
+    """回傳超過門檻的項目；負載比較 p95，微基準比較每次呼叫的耗時。"""
+    regressions = []
+    for label, current in report.get("load", {}).items():
+        previous = baseline.get("load", {}).get(label)
+        if previous and previous["p95"] > 0 and current["p95"] > previous["p95"] * (1 + max_regression):
+            regressions.append(f"{label} p95 {previous['p95'] * 1000:.0f}ms -> {current['p95'] * 1000:.0f}ms")
+        if previous and current["error_rate"] > previous["error_rate"] + max_regression * 0.1:
+            regressions.append(f"{label} error rate {previous['error_rate']:.1%} -> {current['error_rate']:.1%}")
+    for name, current_us in report.get("micro", {}).items():
+        previous_us = baseline.get("micro", {}).get(name)
+        if previous_us and current_us > previous_us * (1 + max_regression):
+            regressions.append(f"{name} {previous_us:.1f}µs -> {current_us:.1f}µs")
+    return regressions
+
+
+def print_report(report):
+    if report.get("load"):
+        print(f"{'endpoint':<32}{'reqs':>6}{'req/s':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'ttfb p50':>10}{'errors':>8}  error kinds")
+        for label, row in report["load"].items():
+            print(f"{label:<32}{row['requests']:>6}{row['throughput']:>8.1f}{row['p50']:>8.2f}{row['p95']:>8.2f}{row['p99']:>8.2f}"
+                  f"{row['first_byte_p50']:>10.2f}{row['error_rate']:>8.1%}  {', '.join(f'{kind}={count}' for kind, count in row['errors'].items())}")
+    if report.get("micro"):
+        print(f"\n{'microbenchmark':<34}{'µs/call':>10}")
+        for name, per_call_us in report["micro"].items(): print(f"{name:<34}{per_call_us:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", default=os.path.join(BENCH_DIR, "conversations.jsonl"))
+    parser.add_argument("--endpoints", nargs="*", choices=("/api/chat_py", "/api/feedback"), help="只重播這些端點")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--background-feedback", type=int, default=0, metavar="N", help="同時以 N 個 worker 持續重播對話檔中的 /api/feedback 請求")
+    parser.add_argument("--timeout", type=float, default=180.0, help="單一請求的用戶端逾時 (秒)")
+    parser.add_argument("--url", help="已在執行的後端 (例如 http://127.0.0.1:5001)；未指定時啟動本地後端與 Ollama 替身")
+    parser.add_argument("--server", choices=tuple(SERVER_CHOICES), default="threaded")
+    parser.add_argument("--app-port", type=int, default=5102)
+    parser.add_argument("--ollama-port", type=int, default=11501)
+    parser.add_argument("--max-in-flight", type=int, default=4, help="後端的 OLLAMA_MAX_IN_FLIGHT_PER_MODEL")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--micro-iterations", type=int, default=500)
+    parser.add_argument("--json", help="把報告寫成 JSON，之後可當 --baseline")
+    parser.add_argument("--baseline", help="先前以 --json 存下的報告")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="p95 / 微基準允許變慢的比例")
+    fake_ollama.add_arguments(parser)
+    args = parser.parse_args()
+
+    records = read_conversations(args.conversations, args.endpoints)
+    report = {"config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")}}
+    if not args.skip_load:
+        ollama_server = process = None
+        base_url = args.url
+        if base_url is None:
+            ollama_server = fake_ollama.serve(args.ollama_port, args.latency, args.tokens_per_second, **fake_ollama.options_from_args(args))
+            threading.Thread(target=ollama_server.serve_forever, daemon=True).start()
+            env = dict(os.environ, OLLAMA_BASE_API_URL=f"http://127.0.0.1:{args.ollama_port}", PORT=str(args.app_port),
+                       OLLAMA_MAX_IN_FLIGHT_PER_MODEL=str(args.max_in_flight), OLLAMA_MAX_QUEUED_PER_MODEL=str(args.requests + args.background_feedback),
+                       OLLAMA_MAX_QUEUED_PER_USER=str(args.requests + args.background_feedback),
+                       OLLAMA_POOL_MAXSIZE=str(max(args.max_in_flight, 16)), LOG_LEVEL="WARNING")
+            process = subprocess.Popen(SERVERS[SERVER_CHOICES[args.server]], cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            base_url = f"http://127.0.0.1:{args.app_port}"
+        try:
+            asyncio.run(wait_until_listening(base_url + "/api/chat_py"))
+            print(f"{args.requests} requests from {len(records)} recorded conversations, concurrency {args.concurrency}, against {base_url}")
+            background_records = read_conversations(args.conversations, ["/api/feedback"]) if args.background_feedback else ()
+            report["load"] = asyncio.run(run_load(base_url, records, args.requests, args.concurrency, args.timeout, background_records, args.background_feedback))
+            if ollama_server is not None: report["fake_ollama"] = ollama_server.stats()
+        finally:
+            if process is not None: process.terminate(); process.wait()
+            if ollama_server is not None: ollama_server.shutdown()
+    if not args.skip_micro:
+        report["micro"] = run_microbenchmarks(records, args.micro_iterations)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: regressions = compare_with_baseline(report, json.load(f), args.max_regression)
+        if regressions:
+            print(f"\nRegressions beyond {args.max_regression:.0%}:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.max_regression:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""量測每個 /api/chat_py 請求的 CPU 時間與 log 輸出量 (Ollama 以零延遲的替身取代，只剩服務本身的成本)。
+
+用法:
+    python bench/logging_benchmark.py --requests 2000
+    # 與舊版比較：把舊的 commit checkout 到另一個目錄後指定 --app-dir
+    git worktree add /tmp/wingchat-before <commit> && python bench/logging_benchmark.py --app-dir /tmp/wingchat-before
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+import fake_ollama  # noqa: E402
+
+# 子行程：在 app 目錄中以 Flask test client 連續送出請求，回報 CPU 時間 (含 log 背景執行緒)
+WORKER = """
+import json, sys, time
+import app
+client = app.app.test_client()
+body = {"goal": "約對方週末出去玩", "character": {"id": "bench", "name": "小美", "description": "活潑的大學生，喜歡看電影"},
+        "messages": [{"role": "user" if i % 2 == 0 else "assistant", "content": "你週末有空嗎 我們可以去看電影" * 3} for i in range(9)], "mode": "character_play"}
+for _ in range(20): client.post("/api/chat_py", json=body)
+started_cpu, started_wall = time.process_time(), time.perf_counter()
+for _ in range(int(sys.argv[1])): client.post("/api/chat_py", json=body)
+cpu, wall = time.process_time() - started_cpu, time.perf_counter() - started_wall
+time.sleep(0.5)  # 讓背景 log 執行緒寫完
+print(json.dumps({"cpu": cpu, "wall": wall}), file=sys.__stdout__)
+"""
+
+CONFIGS = {
+    "INFO, text": {"LOG_LEVEL": "INFO", "LOG_FORMAT": "text"},
+    "INFO, json, 1% sampled": {"LOG_LEVEL": "INFO", "LOG_FORMAT": "json", "REQUEST_LOG_SAMPLE_RATE": "0.01"},
+    "WARNING": {"LOG_LEVEL": "WARNING"},
+    "DEBUG": {"LOG_LEVEL": "DEBUG"},
+}
+
+
+def run_config(app_dir, env_overrides, requests_count, ollama_port):
+    env = dict(os.environ, OLLAMA_BASE_API_URL=f"http://127.0.0.1:{ollama_port}", OLLAMA_MAX_QUEUED_PER_MODEL="1000", **env_overrides)
+    with tempfile.TemporaryFile() as log_file:
+        result = subprocess.run([sys.executable, "-c", WORKER, str(requests_count)], cwd=app_dir, env=env, stdout=subprocess.PIPE, stderr=log_file, text=True, check=True)
+        log_bytes = log_file.tell()
+    import json
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings["cpu"] / requests_count * 1e6, timings["wall"] / requests_count * 1e6, log_bytes / requests_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--app-dir", default=ROOT_DIR, help="要量測的 app.py 所在目錄 (可指向舊版 checkout)")
+    parser.add_argument("--ollama-port", type=int, default=11510)
+    args = parser.parse_args()
+
+    server = fake_ollama.serve(args.ollama_port, latency=0.0, tokens_per_second=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{args.requests} requests against {args.app_dir}")
+    print(f"{'config':<26}{'CPU µs/req':>12}{'wall µs/req':>13}{'log bytes/req':>15}")
+    for label, overrides in CONFIGS.items():
+        cpu_us, wall_us, log_bytes = run_config(args.app_dir, overrides, args.requests, args.ollama_port)
+        print(f"{label:<26}{cpu_us:>12.0f}{wall_us:>13.0f}{log_bytes:>15.0f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
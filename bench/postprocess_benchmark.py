@@ -0,0 +1,74 @@
+"""比較每則回覆的後處理成本：舊版 (legacy_postprocess.py) 與 reply_postprocess.py 的預先編譯 profile。
+
+用法: python bench/postprocess_benchmark.py [--iterations 20000] [--replies replies.jsonl]
+--replies 可指定實際錄下的模型原始回覆 (每行一個 JSON 字串或 {"text": ...})，未指定時使用內建樣本。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import legacy_postprocess  # noqa: E402
+import reply_postprocess  # noqa: E402
+
+SAMPLE_REPLIES = [
+    "好啊\\n想去哪\\n我都可以",
+    "AI：欸\\n你在幹嘛啦\\n我剛下課「超累」",
+    "你可以這樣說：真的齁\n我就說很讚啊\n那你還有想看什麼嗎？",
+    "Sure, here's my suggestion: 哈哈，真的假的。\\n笑死\\n下次一起去（如果你有空）",
+    "嗯嗯\r\n好啊\r\n等等喔；我看一下時間：10:30可以嗎",
+    "```json\n{\"reply\": \"好啊\"}\n```\n好啊\\n那就這樣說定囉！",
+    "  \n\n話翼: 沒幹嘛啊\\n耍廢中\\n你勒\\n\\n",
+    "喔喔原來是這樣，那你週末有空嗎？我們可以去看那部電影，聽說評價很好，而且附近還有一家很好吃的拉麵店",
+]
+
+
+def time_per_call(fn, replies, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for reply in replies: fn(reply)
+    return (time.perf_counter() - started) / (iterations * len(replies))
+
+
+def stream_apply(profile):
+    def run(reply):
+        processor = reply_postprocess.StreamingPostProcessor(profile)
+        lines = []
+        for start in range(0, len(reply), 4): lines.extend(processor.feed(reply[start:start + 4]))
+        return lines + processor.finish()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--replies", help="JSONL 檔，每行一則模型原始回覆")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    replies = SAMPLE_REPLIES
+    if args.replies:
+        with open(args.replies, encoding="utf-8") as f:
+            replies = [(lambda value: value["text"] if isinstance(value, dict) else value)(json.loads(line)) for line in f if line.strip()]
+
+    comparisons = [
+        ("line_style", legacy_postprocess.post_process_line_style_reply, reply_postprocess.LINE_STYLE),
+        ("strict_line_style", legacy_postprocess.post_process_reply, reply_postprocess.STRICT_LINE_STYLE),
+    ]
+    print(f"{len(replies)} replies x {args.iterations} iterations")
+    print(f"{'profile':<20}{'legacy µs':>11}{'new µs':>9}{'stream µs':>11}{'speedup':>9}  same result")
+    for name, legacy_fn, profile in comparisons:
+        same = all(legacy_fn(reply) == profile.apply(reply) for reply in replies)
+        legacy_time = time_per_call(legacy_fn, replies, args.iterations)
+        new_time = time_per_call(profile.apply, replies, args.iterations)
+        stream_time = time_per_call(stream_apply(profile), replies, max(1, args.iterations // 10))
+        print(f"{name:<20}{legacy_time * 1e6:>11.2f}{new_time * 1e6:>9.2f}{stream_time * 1e6:>11.2f}{legacy_time / new_time:>8.1f}x  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""比較執行緒式 app.run(...)、async_app.py 與 pre-fork 多行程的 serve.py 在同一個 Ollama 替身下的吞吐量與延遲。
+
+用法: python bench/serving_benchmark.py --concurrency 200 --requests 1000 --latency 1.0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_ollama  # noqa: E402
+
+CHAT_REQUEST = {
+    "goal": "約對方週末出去玩",
+    "character": {"id": "bench", "name": "小美", "description": "活潑的大學生，喜歡看電影"},
+    "messages": [{"role": "user", "content": "你週末有空嗎"}],
+    "mode": "character_play",
+}
+
+SERVERS = {
+    "threaded (app.run)": [sys.executable, "-c", "import os, app; app.app.run(host='127.0.0.1', port=int(os.environ['PORT']), threaded=True)"],
+    "asyncio (async_app.py)": [sys.executable, "async_app.py"],
+    "pre-fork (serve.py)": [sys.executable, "serve.py"],  # WEB_CONCURRENCY 預設為 CPU 核心數
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def wait_until_listening(url, deadline=20.0):
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - started < deadline:
+            try:
+                async with session.post(url, json={}) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {deadline}s")
+
+
+async def run_load(url, total_requests, concurrency):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=CHAT_REQUEST) as response:
+                        await response.read()
+                        if response.status != 200: errors += 1; return
+                except aiohttp.ClientError:
+                    errors += 1; return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(total_requests)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {"requests_per_second": len(latencies) / elapsed, "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99), "mean": statistics.fmean(latencies) if latencies else 0.0, "errors": errors, "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=1.0, help="Ollama 替身每個請求的延遲 (秒)")
+    parser.add_argument("--ollama-port", type=int, default=11500)
+    parser.add_argument("--app-port", type=int, default=5101)
+    args = parser.parse_args()
+
+    ollama_server = fake_ollama.serve(args.ollama_port, latency=args.latency, tokens_per_second=0)
+    threading.Thread(target=ollama_server.serve_forever, daemon=True).start()
+
+    env = dict(os.environ, OLLAMA_BASE_API_URL=f"http://127.0.0.1:{args.ollama_port}", PORT=str(args.app_port),
+               # 兩種模式都放寬並行上限，只比較服務模型本身
+               OLLAMA_MAX_IN_FLIGHT_PER_MODEL=str(args.concurrency), OLLAMA_MAX_QUEUED_PER_MODEL=str(args.requests),
+               OLLAMA_POOL_MAXSIZE=str(args.concurrency))
+    url = f"http://127.0.0.1:{args.app_port}/api/chat_py"
+    print(f"{args.requests} requests, concurrency {args.concurrency}, fake Ollama latency {args.latency}s")
+    print(f"{'mode':<24}{'req/s':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'errors':>8}")
+    for label, command in SERVERS.items():
+        process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_until_listening(url))
+            result = asyncio.run(run_load(url, args.requests, args.concurrency))
+        finally:
+            process.terminate(); process.wait()
+        print(f"{label:<24}{result['requests_per_second']:>8.1f}{result['p50']:>8.2f}{result['p95']:>8.2f}{result['p99']:>8.2f}{result['errors']:>8}")
+    ollama_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""助手模式多個候選建議的去重與排序。
+
+一次請求以不同 seed / temperature 生成 N 個候選，取代使用者一次次按「重新產生」。排序只用便宜的本地規則，
+不再呼叫模型：風格規則違反 (禁用標點、前綴、emoji)、行數與每行長度是否符合 LINE 風格、與最近對話及候選內部的重複程度。
+分數越高越好；每個候選附上扣分原因，方便調整權重。
+"""
+import re
+
+from reply_postprocess import LINE_STYLE
+
+EMOJI_PATTERN = re.compile("[\U0001F300-\U0001FAFF☀-➿]")
+NORMALIZE_PATTERN = re.compile(r"[\s,，.。!！?？~～]+")
+
+DEFAULT_WEIGHTS = {
+    "empty": 100.0,
+    "prefix": 3.0,            # 「你可以這樣說：」之類的前綴
+    "forbidden_char": 0.5,    # 每個會被後處理刪掉的標點
+    "emoji": 1.0,
+    "line_count": 1.5,        # 每超出 (或不足) 建議行數一行
+    "long_line": 0.1,         # 每行超出 max_line_chars 的每個字
+    "history_overlap": 6.0,   # 與最近訊息的最高 bigram 相似度 (0~1)
+    "duplicate_lines": 1.0,   # 候選內重複的行
+}
+
+
+def normalize(text):
+    return NORMALIZE_PATTERN.sub("", text)
+
+
+def char_bigrams(text):
+    text = normalize(text)
+    return {text[i:i + 2] for i in range(len(text) - 1)} if len(text) > 1 else {text} if text else set()
+
+
+def similarity(a_bigrams, b_bigrams):
+    if not a_bigrams or not b_bigrams: return 0.0
+    return len(a_bigrams & b_bigrams) / len(a_bigrams | b_bigrams)
+
+
+def score_candidate(raw_reply, cleaned_reply, recent_bigrams, profile=LINE_STYLE, weights=DEFAULT_WEIGHTS, min_lines=2, max_lines=5, max_line_chars=25):
+    """回傳 (分數, 扣分原因)。raw_reply 用來數風格違反，cleaned_reply (後處理後) 用來看行數、長度與重複。"""
+    if not cleaned_reply.strip(): return -weights["empty"], {"empty": 1}
+    issues = {}
+    if profile.prefix_pattern.match(raw_reply.strip()): issues["prefix"] = 1
+    forbidden = profile.count_punctuation(raw_reply)
+    if forbidden: issues["forbidden_char"] = forbidden
+    emoji = len(EMOJI_PATTERN.findall(raw_reply))
+    if emoji: issues["emoji"] = emoji
+    lines = cleaned_reply.split("\n")
+    line_count_off = max(0, min_lines - len(lines), len(lines) - max_lines)
+    if line_count_off: issues["line_count"] = line_count_off
+    long_chars = sum(max(0, len(line) - max_line_chars) for line in lines)
+    if long_chars: issues["long_line"] = long_chars
+    duplicate_lines = len(lines) - len({normalize(line) for line in lines})
+    if duplicate_lines: issues["duplicate_lines"] = duplicate_lines
+    candidate_bigrams = char_bigrams(cleaned_reply)
+    overlap = max((similarity(candidate_bigrams, bigrams) for bigrams in recent_bigrams), default=0.0)
+    if overlap >= 0.2: issues["history_overlap"] = round(overlap, 2)
+    return -sum(weights[name] * value for name, value in issues.items()), issues
+
+
+def rank_candidates(candidates, recent_messages=(), profile=LINE_STYLE, weights=DEFAULT_WEIGHTS, near_duplicate_threshold=0.8, **limits):
+    """candidates 為 [(raw_reply, cleaned_reply, extra), ...]；回傳依分數排序並去重的 dict 列表 (分數相同時保留生成順序)。
+    extra 是呼叫端要原樣帶回的欄位 (例如 seed、temperature)。"""
+    recent_bigrams = [char_bigrams(message.get("content", "")) for message in recent_messages if message.get("content")]
+    scored = []
+    for index, (raw_reply, cleaned_reply, extra) in enumerate(candidates):
+        score, issues = score_candidate(raw_reply, cleaned_reply, recent_bigrams, profile, weights, **limits)
+        scored.append(dict(extra, content=cleaned_reply, score=round(score, 2), issues=issues, _bigrams=char_bigrams(cleaned_reply), _index=index))
+    scored.sort(key=lambda candidate: (-candidate["score"], candidate["_index"]))
+    # 先排序再去重：幾乎相同的候選只留分數較高的那個
+    kept = []
+    for candidate in scored:
+        if not any(similarity(candidate["_bigrams"], other["_bigrams"]) >= near_duplicate_threshold for other in kept): kept.append(candidate)
+    return [{key: value for key, value in candidate.items() if not key.startswith("_")} for candidate in kept]
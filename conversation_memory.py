@@ -0,0 +1,130 @@
+"""滾動摘要：歷史超出視窗的舊訊息在背景增量摘要成一段精簡的 digest，每個對話各自快取。
+
+每次只把「上次摘要之後新被擠出視窗的訊息」連同舊摘要交給模型，所以摘要成本與對話總長度無關，
+prompt 長度也維持在 系統 prompt + 摘要 + 最近視窗 的上限內。
+設定 ConversationStateStore 時每次摘要完成都寫入 SQLite，同一台主機上的其他 worker 行程 (serve.py) 處理同一段對話時直接沿用。
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def message_fingerprint(message):
+    return hashlib.sha1(json.dumps([message.get("role"), message.get("content", "")], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def covered_prefix_matches(fingerprints, messages, offset):
+    """fingerprints[i] 是已涵蓋的第 i 則 (絕對位置) 訊息的指紋，None 表示當時不在請求中 (session 已裁切)。
+    請求的對話比涵蓋範圍短，或重疊部分有任何一則不同 (另一段同 key 的對話、被編輯過) 時回傳 False。"""
+    if len(fingerprints) > offset + len(messages): return False
+    return all(fingerprints[index] is None or fingerprints[index] == message_fingerprint(messages[index - offset])
+               for index in range(offset, len(fingerprints)))
+
+
+def extend_fingerprints(fingerprints, start, new_messages):
+    """把 new_messages (從絕對位置 start 開始) 的指紋接到 fingerprints 後面，中間缺的部分補 None。"""
+    return fingerprints[:start] + [None] * (start - len(fingerprints)) + [message_fingerprint(message) for message in new_messages]
+
+
+class ConversationStateStore:
+    """每個對話一筆 JSON (摘要或逐輪評估，不含執行中的 future)，讓多個 worker 行程與重啟後的行程共用；過期資料在寫入時順便清除。"""
+
+    def __init__(self, path, table, ttl_seconds=6 * 3600):
+        self.path = path
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, key, newer_than=0.0):
+        """回傳 updated_at 晚於 newer_than 的項目 (含 updated_at)，沒有或已過期時回傳 None。"""
+        row = self._connection().execute(f"SELECT data, updated_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= newer_than or time.time() - row[1] > self.ttl_seconds: return None
+        return dict(json.loads(row[0]), updated_at=row[1])
+
+    def save(self, key, state, updated_at):
+        with self._connection() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, data, updated_at) VALUES (?, ?, ?)", (key, json.dumps(state, ensure_ascii=False), updated_at))
+            conn.execute(f"DELETE FROM {self.table} WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+
+
+class RollingSummaryCache:
+    """messages 的索引一律是「絕對位置」：offset 為 messages[0] 在整段對話中的位置 (session 裁切過的歷史 offset > 0)。"""
+
+    def __init__(self, summarize_fn, max_conversations=1000, max_workers=1, store=None):
+        self.summarize_fn = summarize_fn  # (previous_summary, new_messages) -> summary 文字
+        self.max_conversations = max_conversations
+        self.store = store  # ConversationStateStore 或 None (只在本行程的記憶體中)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        self._counters = {"summaries_started": 0, "summaries_completed": 0, "summaries_failed": 0, "summarized_messages": 0}
+
+    def _entry(self, key, messages, offset):
+        entry = self._entries.get(key)
+        if self.store is not None and (entry is None or entry["future"] is None):
+            # 別的 worker 可能已經把這段對話摘要得更新
+            stored = self.store.load(key, newer_than=entry["updated_at"] if entry else 0.0)
+            if stored is not None: entry = self._entries[key] = dict(stored, future=None)
+        # 對話被編輯、比摘要涵蓋的範圍短，或換成另一段同 key 的對話時，舊摘要作廢 (絕不能把別段對話的摘要放進 prompt)
+        if entry is not None and not covered_prefix_matches(entry["fingerprints"], messages, offset):
+            entry = None
+        if entry is None:
+            entry = {"summary": "", "covered": 0, "fingerprints": [], "updated_at": 0.0, "future": None}
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_conversations:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get_digest(self, key, messages, upto, offset=0, wait_timeout=None):
+        """回傳涵蓋 messages[:upto] 的摘要 (可能尚未追上，只涵蓋較早的部分)。
+        有尚未摘要的舊訊息時在背景排程一次增量摘要；wait_timeout 不為 None 時等待其完成。"""
+        with self._lock:
+            entry = self._entry(key, messages, offset)
+            start = max(entry["covered"], offset)
+            if upto > start and entry["future"] is None:
+                entry["future"] = self._executor.submit(self._summarize, key, entry, list(messages[start - offset:upto - offset]), start, upto)
+                self._counters["summaries_started"] += 1
+            future = entry["future"]
+        if future is not None and wait_timeout is not None:
+            try: future.result(timeout=wait_timeout)
+            except Exception: pass
+        with self._lock:
+            return entry["summary"], entry["covered"]
+
+    def _summarize(self, key, entry, new_messages, start, upto):
+        try:
+            summary = self.summarize_fn(entry["summary"], new_messages)
+            with self._lock:
+                if summary:
+                    entry["summary"] = summary.strip()
+                    entry["covered"] = upto
+                    entry["fingerprints"] = extend_fingerprints(entry["fingerprints"], start, new_messages)
+                    entry["updated_at"] = time.time()
+                    self._counters["summaries_completed"] += 1
+                    self._counters["summarized_messages"] += len(new_messages)
+                    state = {field: entry[field] for field in ("summary", "covered", "fingerprints")}
+            if summary and self.store is not None: self.store.save(key, state, entry["updated_at"])
+        except Exception:
+            with self._lock: self._counters["summaries_failed"] += 1
+            raise
+        finally:
+            with self._lock: entry["future"] = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, conversations=len(self._entries), persistent=self.store is not None)
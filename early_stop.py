@@ -0,0 +1,99 @@
+"""LINE 風格回覆的提前停止。
+
+風格規則要求 2~5 則短訊息，但 num_predict 讓模型可以一直寫下去；多寫的行、重複的行或「你可以這樣說：」之類的解說
+原本都在生成完之後才被後處理丟掉，等於白白生成。EarlyStopMonitor 逐片段看著串流輸出，形狀已滿足或開始離題時回報停止原因，
+呼叫端關閉串流 (Ollama 隨即停止生成)，省下的 token 記在 wingchat_tokens_saved_total{reason="early_stop"}。
+
+關閉串流在上游看起來和用戶端斷線一樣；close_early / aclose_early 在關閉期間標記原因，上游據此不把它算成中止。
+"""
+import contextvars
+import re
+
+from reply_postprocess import StreamingPostProcessor
+
+_stopping = contextvars.ContextVar("early_stopping", default=None)
+
+# 第二行之後才出現的解說、角色標籤或重新開始的回覆；第一行的前綴由後處理的 prefix_pattern 處理
+META_COMMENTARY_PATTERN = re.compile(
+    r'^\s*(?:[(（]?(?:註|備註|說明|解釋|Note)\s*[:：]|你可以(?:這麼|這樣)說|我建議你回|(?:好的[,，]?\s*)?這是我(?:的|建議的)回覆|希望(?:這些|這個)建議|以上(?:是|為)'
+    r'|(?:User|Assistant|Human|System|使用者|對方|AI|話翼|WingChat)\s*[:：]|(?:Okay|Ok|Alright|Sure)[,.]?\s*here)',
+    re.IGNORECASE)
+RUNAWAY_PATTERN = re.compile(r"(.{1,4}?)\1{15,}")  # 不換行地把同一個字或短語重複十幾次 (哈哈哈… 停不下來)
+NORMALIZE_PATTERN = re.compile(r"[\s,，.。!！?？~～]+")
+
+
+def stop_reason():
+    """目前是否正在因提前停止而關閉串流 (上游的 GeneratorExit / CancelledError 處理用來區分用戶端斷線)。"""
+    return _stopping.get()
+
+
+def close_early(chunks, reason):
+    token = _stopping.set(reason)
+    try: chunks.close()
+    finally: _stopping.reset(token)
+
+
+async def aclose_early(chunks, reason):
+    token = _stopping.set(reason)
+    try: await chunks.aclose()
+    finally: _stopping.reset(token)
+
+
+class EarlyStopMonitor:
+    """包住 StreamingPostProcessor：feed() 回傳這個片段新完成且被接受的行；reason 不為 None 時呼叫端應停止讀取。
+    停止原因: max_lines (已完成 max_lines 行)、repetition (與前面的行相同，或不換行地一直重複同一片段)、meta (開始解說或出現角色標籤)。"""
+
+    def __init__(self, processor=None, max_lines=5, max_pending_chars=80):
+        self.processor = processor or StreamingPostProcessor()
+        self.max_lines = max_lines
+        self.max_pending_chars = max_pending_chars  # 還沒換行的片段超過這個長度才檢查是否在無限重複
+        self.lines = []
+        self.reason = None
+        self.chunks = 0
+        self._seen = set()
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+    def feed(self, text_chunk):
+        if self.reason is not None: return []
+        self.chunks += 1
+        accepted = self._accept(self.processor.feed_lines(text_chunk))
+        if self.reason is None: self._check_pending(self.processor.pending)
+        return accepted
+
+    def finish(self):
+        if self.reason is not None: return []
+        return self._accept(self.processor.finish_lines())
+
+    def _accept(self, lines):
+        accepted = []
+        for raw_line, line in lines:
+            if not line: continue
+            reason = self._check_line(raw_line, line)
+            if reason is not None:
+                self.reason = reason
+                break
+            self.lines.append(line); accepted.append(line)
+            self._seen.add(NORMALIZE_PATTERN.sub("", line))
+            if len(self.lines) >= self.max_lines:
+                self.reason = "max_lines"
+                break
+        return accepted
+
+    def _check_line(self, raw_line, line):
+        # 解說與角色標籤看原始行 (清理後冒號、括號已被刪掉)
+        if self.lines and META_COMMENTARY_PATTERN.match(raw_line): return "meta"
+        normalized = NORMALIZE_PATTERN.sub("", line)
+        if normalized and normalized in self._seen: return "repetition"
+        return None
+
+    def _check_pending(self, pending):
+        stripped = pending.strip()
+        if self.lines and stripped and META_COMMENTARY_PATTERN.match(stripped): self.reason = "meta"
+        elif len(stripped) > self.max_pending_chars and RUNAWAY_PATTERN.search(stripped): self.reason = "repetition"
+
+    def tokens_saved(self, num_predict):
+        """上限估計：num_predict 減去已收到的片段數 (Ollama 串流一個片段約一個 token)，模型也可能本來就快結束了。"""
+        return max(0, (num_predict or 0) - self.chunks)
@@ -0,0 +1,149 @@
+"""批次回饋評估：把大量 (goal, character, messages) 紀錄並行排入 Ollama，完成一筆就輸出一筆 JSONL 結果。
+
+CLI 用法 (中斷後以相同指令重跑，會依 checkpoint 略過已完成的紀錄):
+    python feedback_batch.py transcripts.jsonl -o evaluations.jsonl --concurrency 4
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ollama_client import OllamaOverloadedError
+
+
+def batch_record_id(record, index):
+    """紀錄自帶 id 時沿用；否則以內容雜湊當作 id，重跑時同一筆紀錄得到相同 id。"""
+    if record.get("id") is not None: return str(record["id"])
+    material = json.dumps([record.get("goal"), record.get("character"), record.get("messages")], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(material.encode("utf-8")).hexdigest()[:16] + f"-{index}"
+
+
+def parse_batch_records(body, ndjson):
+    """把 /api/feedback/batch 的請求主體 ({"records": [...]} 的 JSON 或一行一筆的 NDJSON) 轉成 [(record_id, index, record)]。
+    格式錯誤時丟出 ValueError，訊息指出是哪一行 (NDJSON) 或哪一筆 (records[i])，由呼叫端回 400。"""
+    records = []
+    if ndjson:
+        for line_number, line in enumerate(body.splitlines(), 1):
+            if not line.strip(): continue
+            try: record = json.loads(line)
+            except ValueError as e: raise ValueError(f"第 {line_number} 行不是有效的 JSON: {e}") from e
+            if not isinstance(record, dict): raise ValueError(f"第 {line_number} 行必須是一筆 JSON 物件紀錄")
+            records.append(record)
+    else:
+        try: document = json.loads(body) if body.strip() else {}
+        except json.JSONDecodeError as e: raise ValueError(f"請求主體第 {e.lineno} 行不是有效的 JSON: {e.msg}") from e
+        if not isinstance(document, dict): raise ValueError('請求主體必須是 {"records": [...]} 的 JSON 物件')
+        records = document.get("records") or []
+        if not isinstance(records, list): raise ValueError("records 必須是陣列")
+        for index, record in enumerate(records):
+            if not isinstance(record, dict): raise ValueError(f"records[{index}] 必須是 JSON 物件")
+    return [(batch_record_id(record, index), index, record) for index, record in enumerate(records)]
+
+
+def parse_batch_concurrency(value, maximum):
+    """?concurrency= 的值 (未指定時為 None)，上限為 maximum；不是整數時丟出 ValueError。"""
+    if value is None: return maximum
+    try: return min(int(value), maximum)
+    except ValueError: raise ValueError(f"concurrency 必須是整數，收到 {value!r}") from None
+
+
+class BatchFeedbackRunner:
+    """最多 concurrency 筆同時評估，依完成順序 yield 結果；遇到 503 (OllamaOverloadedError) 時等 retry_after 秒後重試。"""
+
+    def __init__(self, evaluate_fn, concurrency=4, max_overload_retries=5):
+        self.evaluate_fn = evaluate_fn  # record -> 與 /api/feedback 相同的回應內容
+        self.concurrency = max(1, concurrency)
+        self.max_overload_retries = max_overload_retries
+        self.completed = 0
+        self.failed = 0
+        self.started_at = None
+
+    def _evaluate(self, record_id, index, record):
+        started = time.monotonic()
+        for attempt in range(self.max_overload_retries + 1):
+            try:
+                result = self.evaluate_fn(record)
+                return {"id": record_id, "index": index, "ok": True, "elapsed_seconds": round(time.monotonic() - started, 3), **result}
+            except OllamaOverloadedError as e:
+                if attempt == self.max_overload_retries:
+                    return {"id": record_id, "index": index, "ok": False, "error": str(e), "elapsed_seconds": round(time.monotonic() - started, 3)}
+                time.sleep(e.retry_after)
+            except Exception as e:
+                return {"id": record_id, "index": index, "ok": False, "error": str(e), "elapsed_seconds": round(time.monotonic() - started, 3)}
+
+    def run(self, records):
+        """records 為 (record_id, index, record) 的 iterable，只會預先讀取 concurrency 筆，適合很大的輸入檔。"""
+        self.started_at = time.monotonic()
+        pending = set()
+        record_iter = iter(records)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="feedback-batch") as executor:
+            while True:
+                for record_id, index, record in record_iter:
+                    pending.add(executor.submit(self._evaluate, record_id, index, record))
+                    if len(pending) >= self.concurrency: break
+                if not pending: return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result["ok"]: self.completed += 1
+                    else: self.failed += 1
+                    yield result
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        finished = self.completed + self.failed
+        return {"completed": self.completed, "failed": self.failed, "elapsed_seconds": round(elapsed, 2), "concurrency": self.concurrency,
+                "conversations_per_minute": round(finished / elapsed * 60, 2) if elapsed else 0.0}
+
+
+def read_jsonl_records(path, skip_ids=()):
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if not line.strip(): continue
+            record = json.loads(line)
+            record_id = batch_record_id(record, index)
+            if record_id in skip_ids: continue
+            yield record_id, index, record
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次評估 JSONL 對話紀錄 (每行一個 {goal, character, messages[, id]})")
+    parser.add_argument("input", help="輸入的 JSONL 檔")
+    parser.add_argument("-o", "--output", required=True, help="結果 JSONL 檔 (附加寫入)")
+    parser.add_argument("--checkpoint", help="已完成紀錄 id 的檔案，預設為 <output>.checkpoint")
+    parser.add_argument("--concurrency", type=int, help="同時評估的紀錄數，預設為 Ollama 後端數 × 每個模型的並行上限")
+    parser.add_argument("--report-every", type=int, default=10, help="每完成幾筆印出一次吞吐量")
+    args = parser.parse_args()
+
+    import app as wingchat  # 延後載入：只有真的執行 CLI 時才建立 Ollama 連線池等全域物件
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    done_ids = load_checkpoint(checkpoint_path)
+    concurrency = args.concurrency or wingchat.cfg.OLLAMA_MAX_IN_FLIGHT_PER_MODEL * len(wingchat.cfg.OLLAMA_BACKEND_URLS)
+    runner = BatchFeedbackRunner(wingchat.evaluate_feedback_record, concurrency=concurrency)
+    print(f"Skipping {len(done_ids)} records already in {checkpoint_path}; concurrency {concurrency}", file=sys.stderr)
+
+    with open(args.output, "a", encoding="utf-8") as output, open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        for result in runner.run(read_jsonl_records(args.input, skip_ids=done_ids)):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n"); output.flush()
+            # 失敗的紀錄不寫入 checkpoint，下次重跑會再試一次
+            if result["ok"]: checkpoint.write(result["id"] + "\n"); checkpoint.flush()
+            finished = runner.completed + runner.failed
+            if finished % args.report_every == 0:
+                stats = runner.stats()
+                print(f"{finished} done ({stats['failed']} failed), {stats['conversations_per_minute']} conversations/min", file=sys.stderr)
+    print(json.dumps(runner.stats(), ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""非同步回饋評估工作：有界的 worker pool 與等待佇列、相同對話重複送出時共用同一個 job、完成結果保留一段時間後過期。
+
+設定 sqlite_path 時工作狀態同時寫入 SQLite：同一台主機上的其他 worker 行程 (serve.py) 也能輪詢、去重，
+執行工作的行程結束 (重新啟動、被 kill) 時，其未完成的工作會被標記為失敗，而不是讓輪詢得到 404 或永遠停在 running。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ollama_client import OllamaOverloadedError
+
+OWNER_GONE_ERROR = "執行此回饋工作的伺服器行程已結束 (可能已重新啟動)，請重新送出。"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FeedbackJobManager:
+    def __init__(self, run_fn, max_workers=2, max_queued=32, retention_seconds=600, retry_after=10, sqlite_path=None,
+                 poll_interval=0.25, progress_write_interval=0.5):
+        self.run_fn = run_fn  # (job, request_data) -> 回應 body；可更新 job["progress"]
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.retention_seconds = retention_seconds
+        self.retry_after = retry_after
+        self.sqlite_path = sqlite_path
+        self.poll_interval = poll_interval  # 輪詢別的行程的工作時，多久讀一次 SQLite
+        self.progress_write_interval = progress_write_interval  # 進度每個 chunk 都會更新，寫入 SQLite 則限制頻率
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="feedback-job")
+        self._jobs = OrderedDict()  # 只有本行程執行的工作
+        self._by_dedup_key = {}
+        self._progress_written_at = {}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._counters = {"submitted": 0, "deduplicated": 0, "rejected": 0, "completed": 0, "failed": 0, "orphaned": 0}
+        if sqlite_path:
+            with self._connection() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS feedback_jobs (job_id TEXT PRIMARY KEY, dedup_key TEXT NOT NULL, status TEXT NOT NULL, "
+                             "data TEXT NOT NULL, owner_pid INTEGER NOT NULL, finished_at REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS feedback_jobs_dedup_key ON feedback_jobs (dedup_key)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _persist(self, job):
+        if not self.sqlite_path: return
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO feedback_jobs (job_id, dedup_key, status, data, owner_pid, finished_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job["job_id"], job["dedup_key"], job["status"], json.dumps(self._snapshot(job), ensure_ascii=False), os.getpid(), job["finished_at"]))
+
+    def _load(self, job_id=None, dedup_key=None):
+        """從 SQLite 讀出別的行程的工作快照；執行它的行程已經不在時先把它標成失敗。"""
+        if job_id is not None:
+            row = self._connection().execute("SELECT data, owner_pid FROM feedback_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        else:
+            row = self._connection().execute("SELECT data, owner_pid FROM feedback_jobs WHERE dedup_key = ? AND status != 'failed' "
+                                             "ORDER BY rowid DESC LIMIT 1", (dedup_key,)).fetchone()
+        if row is None: return None
+        snapshot, owner_pid = json.loads(row[0]), row[1]
+        if snapshot["status"] in ("queued", "running") and snapshot["job_id"] not in self._jobs and (owner_pid == os.getpid() or not process_alive(owner_pid)):
+            snapshot.update(status="failed", error=OWNER_GONE_ERROR, finished_at=time.time())
+            with self._connection() as conn:
+                conn.execute("UPDATE feedback_jobs SET status = 'failed', data = ?, finished_at = ? WHERE job_id = ?",
+                             (json.dumps(snapshot, ensure_ascii=False), snapshot["finished_at"], snapshot["job_id"]))
+            with self._cond: self._counters["orphaned"] += 1
+        return snapshot
+
+    def _purge_expired(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items() if job["finished_at"] and now - job["finished_at"] > self.retention_seconds]:
+            job = self._jobs.pop(job_id)
+            self._progress_written_at.pop(job_id, None)
+            if self._by_dedup_key.get(job["dedup_key"]) == job_id: del self._by_dedup_key[job["dedup_key"]]
+        if self.sqlite_path:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM feedback_jobs WHERE finished_at < ?", (now - self.retention_seconds,))
+
+    def submit(self, dedup_key, request_data, on_finished=None):
+        """回傳 (job 快照, 是否為既有的 job)。等待中的工作超過 max_queued 時丟出 OllamaOverloadedError。"""
+        with self._cond:
+            self._purge_expired()
+            existing_id = self._by_dedup_key.get(dedup_key)
+            if existing_id is not None and self._jobs[existing_id]["status"] != "failed":
+                self._counters["deduplicated"] += 1
+                return self._snapshot(self._jobs[existing_id]), True
+            existing = self._load(dedup_key=dedup_key) if self.sqlite_path else None
+            if existing is not None and existing["status"] != "failed":
+                self._counters["deduplicated"] += 1
+                return existing, True
+            if sum(1 for job in self._jobs.values() if job["status"] == "queued") >= self.max_queued:
+                self._counters["rejected"] += 1
+                raise OllamaOverloadedError("回饋評估佇列已滿，請稍後再試。", self.retry_after)
+            job = {"job_id": uuid.uuid4().hex, "dedup_key": dedup_key, "status": "queued", "progress": {},
+                   "created_at": time.time(), "started_at": None, "finished_at": None, "result": None, "error": None}
+            self._jobs[job["job_id"]] = job
+            self._by_dedup_key[dedup_key] = job["job_id"]
+            self._counters["submitted"] += 1
+            self._persist(job)
+        self._executor.submit(self._run, job, request_data, on_finished)
+        return self._snapshot(job), False
+
+    def _run(self, job, request_data, on_finished):
+        self._update(job, status="running", started_at=time.time())
+        try:
+            result = self.run_fn(job, request_data)
+            self._update(job, status="done", result=result, finished_at=time.time())
+            with self._cond: self._counters["completed"] += 1
+        except Exception as e:
+            self._update(job, status="failed", error=str(e), finished_at=time.time())
+            with self._cond: self._counters["failed"] += 1
+        if on_finished is not None: on_finished(self._snapshot(job))
+
+    def _update(self, job, **fields):
+        with self._cond:
+            job.update(fields)
+            self._persist(job)
+            self._cond.notify_all()
+
+    def report_progress(self, job, **progress):
+        with self._cond:
+            job["progress"].update(progress)
+            now = time.monotonic()
+            if now - self._progress_written_at.get(job["job_id"], 0.0) >= self.progress_write_interval:
+                self._progress_written_at[job["job_id"]] = now
+                self._persist(job)
+            self._cond.notify_all()
+
+    def _snapshot(self, job):
+        return {key: (dict(value) if isinstance(value, dict) else value) for key, value in job.items() if key != "dedup_key"}
+
+    def get(self, job_id, wait_seconds=0.0):
+        """wait_seconds > 0 時長輪詢：等到工作狀態或進度有變化 (或完成) 才回傳。"""
+        deadline = time.monotonic() + wait_seconds
+        with self._cond:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is None: return self._get_shared(job_id, deadline) if self.sqlite_path else None
+            last_seen = (job["status"], job["progress"].get("generated_tokens"))
+            while job["status"] in ("queued", "running") and (job["status"], job["progress"].get("generated_tokens")) == last_seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+            return self._snapshot(job)
+
+    def _get_shared(self, job_id, deadline):
+        """別的行程執行的工作：每 poll_interval 秒讀一次 SQLite，直到狀態或進度有變化。呼叫時持有 self._cond。"""
+        snapshot = self._load(job_id=job_id)
+        if snapshot is None: return None
+        last_seen = (snapshot["status"], snapshot["progress"].get("generated_tokens"))
+        while snapshot["status"] in ("queued", "running") and (snapshot["status"], snapshot["progress"].get("generated_tokens")) == last_seen:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            self._cond.wait(min(remaining, self.poll_interval))
+            snapshot = self._load(job_id=job_id) or snapshot
+        return snapshot
+
+    def stats(self):
+        with self._cond:
+            by_status = {}
+            for job in self._jobs.values(): by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+            return dict(self._counters, jobs_by_status=by_status, max_workers=self.max_workers, max_queued=self.max_queued, persistent=bool(self.sqlite_path))
@@ -0,0 +1,215 @@
+"""使用者回饋評估的解析。
+
+結構化模式下以 Ollama 的 `format` (JSON schema) 限制模型輸出，解析只需一次 json 解碼與欄位驗證；
+StructuredFeedbackStream 可在串流途中逐一取出已完成的頂層欄位。逐輪評估 (incremental_feedback) 的輸出同樣以 TURN_ASSESSMENT_SCHEMA 限制。舊版自由文字輸出改由單次掃描的解析器處理，
+所有 regex 都在載入模組時預先編譯，不再每個請求、每個評分項重新組合與編譯。
+"""
+import json
+import re
+
+SCORE_CATEGORIES = {
+    "clarity": "表達清晰度", "empathy": "同理心展現", "confidence": "自信程度",
+    "appropriateness": "言談適當性", "goalAchievement": "目標達成技巧",
+}
+
+FEEDBACK_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "scores": {
+            "type": "object",
+            "properties": {
+                key: {
+                    "type": "object",
+                    "properties": {"score": {"type": "integer", "minimum": 0, "maximum": 100}, "justification": {"type": "string"}},
+                    "required": ["score", "justification"],
+                }
+                for key in SCORE_CATEGORIES
+            },
+            "required": list(SCORE_CATEGORIES),
+        },
+        "strengths": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 3},
+        "improvements": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 3},
+    },
+    "required": ["summary", "scores", "strengths", "improvements"],
+}
+
+# 逐輪評估只看使用者最新的幾則發言：沒有總結，優點與建議可以從缺 (這一輪沒有值得一提的就不寫)
+TURN_ASSESSMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scores": FEEDBACK_JSON_SCHEMA["properties"]["scores"],
+        "strengths": {"type": "array", "items": {"type": "string"}, "maxItems": 2},
+        "improvements": {"type": "array", "items": {"type": "string"}, "maxItems": 2},
+    },
+    "required": ["scores", "strengths", "improvements"],
+}
+
+
+def empty_feedback():
+    return {
+        "summary": "AI 未能提供整體總結。",
+        "scores": {key: {"score": None, "justification": "AI 未提供"} for key in SCORE_CATEGORIES},
+        "strengths": ["AI 未提供具體優點"], "improvements": ["AI 未提供具體建議"],
+    }
+
+
+def _clamp_score(value):
+    if isinstance(value, bool): return None
+    if isinstance(value, str) and value.strip().isdigit(): value = int(value.strip())
+    if isinstance(value, (int, float)): return max(0, min(100, int(value)))
+    return None
+
+
+def _string_list(value):
+    if isinstance(value, str): value = [value]
+    if not isinstance(value, list): return []
+    return [item.strip() for item in value if isinstance(item, str) and item.strip()]
+
+
+def validate_structured_feedback(data):
+    """把模型輸出的 JSON 物件整理成前端使用的格式；回傳 (feedback, problems)，problems 列出缺漏或不合法的欄位。"""
+    feedback, problems = empty_feedback(), []
+    if not isinstance(data, dict): return feedback, ["top-level value is not an object"]
+    if isinstance(data.get("summary"), str) and data["summary"].strip(): feedback["summary"] = data["summary"].strip()
+    else: problems.append("summary")
+    scores = data.get("scores") if isinstance(data.get("scores"), dict) else {}
+    for key in SCORE_CATEGORIES:
+        item = scores.get(key)
+        if not isinstance(item, dict): problems.append(f"scores.{key}"); continue
+        feedback["scores"][key]["score"] = _clamp_score(item.get("score"))
+        if feedback["scores"][key]["score"] is None: problems.append(f"scores.{key}.score")
+        if isinstance(item.get("justification"), str) and item["justification"].strip():
+            feedback["scores"][key]["justification"] = item["justification"].strip()
+    for field in ("strengths", "improvements"):
+        items = _string_list(data.get(field))
+        if items: feedback[field] = items
+        else: problems.append(field)
+    return feedback, problems
+
+
+def parse_turn_assessment(raw_text):
+    """解析逐輪評估的 JSON；回傳 (assessment, problems)。沒有任何有效分數時 assessment 為 None。"""
+    try: data = json.loads(raw_text.strip())
+    except json.JSONDecodeError: return None, ["not valid JSON"]
+    if not isinstance(data, dict): return None, ["top-level value is not an object"]
+    scores, problems = {}, []
+    raw_scores = data.get("scores") if isinstance(data.get("scores"), dict) else {}
+    for key in SCORE_CATEGORIES:
+        item = raw_scores.get(key) if isinstance(raw_scores.get(key), dict) else {}
+        score = _clamp_score(item.get("score"))
+        if score is None: problems.append(f"scores.{key}"); continue
+        justification = item.get("justification").strip() if isinstance(item.get("justification"), str) else ""
+        scores[key] = {"score": score, "justification": justification}
+    if not scores: return None, problems
+    return {"scores": scores, "strengths": _string_list(data.get("strengths")), "improvements": _string_list(data.get("improvements"))}, problems
+
+
+class StructuredFeedbackStream:
+    """逐片段餵入結構化輸出的 JSON 文字，每當一個頂層欄位 (summary、scores…) 完整出現就回傳 (key, value)。
+    只追蹤巢狀深度與字串狀態，每個字元只掃描一次。"""
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._field_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        text = self.text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+            if self._in_string:
+                if self._escape: self._escape = False
+                elif char == "\\": self._escape = True
+                elif char == '"': self._in_string = False
+                continue
+            if char == '"': self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1: self._field_start = pos + 1
+            elif char in "}]" or (char == "," and self._depth == 1):
+                if self._depth == 1 and self._field_start is not None:
+                    completed.extend(self._complete_field(text[self._field_start:pos]))
+                    self._field_start = pos + 1
+                if char != ",": self._depth -= 1
+        self._pos = len(text)
+        return completed
+
+    def _complete_field(self, segment):
+        if not segment.strip(): return []
+        try: field = json.loads("{" + segment + "}")
+        except json.JSONDecodeError: return []
+        self.fields.update(field)
+        return list(field.items())
+
+    def finish(self):
+        """回傳 (feedback, problems)。整段不是合法 JSON 時退回舊版自由文字解析。"""
+        try: data = json.loads(self.text)
+        except json.JSONDecodeError:
+            if self.fields: return validate_structured_feedback(self.fields)
+            return parse_legacy_feedback(self.text)
+        return validate_structured_feedback(data)
+
+
+_SECTION_HEADER = re.compile(
+    r"([1-4])\.?\s*(使用者整體表現總結|使用者社交技能評分(?:\s*\(0-100分?\))?|使用者本次對話的優點|給使用者的具體改進建議)\s*[:：]?\s*(?:\([^)]+\)\s*)?",
+    re.IGNORECASE)
+_SECTION_KEYS = {"使用者整體表現總結": "summary", "使用者社交技能評分": "scores", "使用者本次對話的優點": "strengths", "給使用者的具體改進建議": "improvements"}
+_SCORE_NAME_TO_KEY = {name: key for key, name in SCORE_CATEGORIES.items()}
+_SCORE_LINE = re.compile(
+    r"\*\s*(" + "|".join(map(re.escape, SCORE_CATEGORIES.values())) + r")(?:\s*\([A-Za-z]+\))?"
+    r"\s*[:：]?\s*(?:(\d{1,3})\s*分?\s*-\s*)?理由\s*[:：]?\s*([^\n]+)",
+    re.IGNORECASE)
+_LIST_ITEM = re.compile(r"-\s*([^\r\n]+)")
+
+
+def parse_legacy_feedback(raw_feedback_text):
+    """舊版「1. 使用者整體表現總結: …」自由文字格式。回傳 (feedback, problems)。"""
+    feedback, problems = empty_feedback(), []
+    sections = {}
+    headers = list(_SECTION_HEADER.finditer(raw_feedback_text))
+    for index, header in enumerate(headers):
+        section_key = _SECTION_KEYS[header.group(2).split("(")[0].strip()]
+        end = headers[index + 1].start() if index + 1 < len(headers) else len(raw_feedback_text)
+        sections.setdefault(section_key, raw_feedback_text[header.end():end])
+
+    summary = sections.get("summary", "").lstrip("*").strip()
+    if summary: feedback["summary"] = summary
+    else: problems.append("summary")
+
+    if "scores" in sections:
+        found = {}
+        for match in _SCORE_LINE.finditer(sections["scores"]):
+            key = _SCORE_NAME_TO_KEY[match.group(1)]
+            # 與舊版相同：優先採用第一個有數字分數的項目，否則採用第一個只有理由的項目
+            if key in found and (found[key][0] is not None or match.group(2) is None): continue
+            found[key] = (match.group(2), match.group(3).strip())
+        for key in SCORE_CATEGORIES:
+            if key not in found: problems.append(f"scores.{key}"); continue
+            score_str, justification = found[key]
+            if score_str is not None: feedback["scores"][key]["score"] = max(0, min(100, int(score_str)))
+            else: problems.append(f"scores.{key}.score")
+            if justification: feedback["scores"][key]["justification"] = justification
+    else:
+        problems.append("scores")
+
+    for field in ("strengths", "improvements"):
+        items = [item.strip() for item in _LIST_ITEM.findall(sections.get(field, "").strip()) if item.strip()]
+        if items: feedback[field] = items
+        else: problems.append(field)
+    return feedback, problems
+
+
+def parse_feedback_text(raw_feedback_text):
+    """依內容自動判斷：JSON 物件走結構化驗證，其餘走舊版自由文字解析。回傳 (feedback, problems)。"""
+    stripped = raw_feedback_text.strip()
+    if stripped.startswith("{"):
+        try: return validate_structured_feedback(json.loads(stripped))
+        except json.JSONDecodeError: pass
+    return parse_legacy_feedback(raw_feedback_text)
@@ -0,0 +1,143 @@
+"""逐輪的背景評估：聊天進行中就先評估使用者的新發言，結束時的回饋只需要合併。
+
+原本回饋要等對話結束後才從頭讀完整段對話，一次生成約 1500 個 token，使用者得等上數十秒。
+TurnAssessmentCache 在每一輪聊天請求進來時，於背景 (低優先的批次類別) 只評估上次評估之後新增的使用者發言，
+每個對話各自快取逐輪的分數、優點與建議；請求回饋時以 merge_turn_assessments 合併成原本的 userEvaluation 格式，
+只剩整體總結需要一次短的生成。索引、失效判斷與跨行程共用 (ConversationStateStore) 都與 conversation_memory.RollingSummaryCache 相同
+(絕對位置 + 已涵蓋的每一則訊息的指紋)。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from conversation_memory import covered_prefix_matches, extend_fingerprints
+from feedback_parser import SCORE_CATEGORIES, empty_feedback
+
+NORMALIZE_PATTERN = re.compile(r"[\s,，.。!！?？、;；:：]+")
+
+
+class TurnAssessmentCache:
+    """messages 的索引一律是「絕對位置」：offset 為 messages[0] 在整段對話中的位置。
+    assess_fn(context, previous_messages, new_messages) 回傳 {"scores", "strengths", "improvements"} 或 None；
+    previous_messages 是新發言之前的幾則訊息，只作為上下文。"""
+
+    def __init__(self, assess_fn, max_conversations=1000, max_workers=1, context_messages=4, store=None):
+        self.assess_fn = assess_fn
+        self.max_conversations = max_conversations
+        self.store = store  # conversation_memory.ConversationStateStore 或 None
+        self.context_messages = context_messages
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn-assessment")
+        self._counters = {"assessments_started": 0, "assessments_completed": 0, "assessments_failed": 0, "assessed_user_messages": 0}
+
+    def _entry(self, key, messages, offset, create):
+        entry = self._entries.get(key)
+        if self.store is not None and (entry is None or entry["future"] is None):
+            # 同一段對話的前幾輪可能由別的 worker 評估過
+            stored = self.store.load(key, newer_than=entry["updated_at"] if entry else 0.0)
+            if stored is not None: entry = self._entries[key] = dict(stored, future=None)
+        # 對話被編輯、比已評估的範圍短，或換成另一段同 key 的對話時，舊的評估作廢 (絕不能合併到別人的回饋裡)
+        if entry is not None and not covered_prefix_matches(entry["fingerprints"], messages, offset):
+            entry = None
+            if not create: del self._entries[key]
+        if entry is None:
+            if not create: return None
+            entry = {"turns": [], "covered": 0, "fingerprints": [], "updated_at": 0.0, "future": None}
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_conversations:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _schedule(self, key, entry, messages, offset, context):
+        """呼叫時須持有 self._lock。新訊息中沒有使用者發言時直接推進 covered，不必生成。"""
+        start, upto = max(entry["covered"], offset), offset + len(messages)
+        if upto <= start or entry["future"] is not None: return
+        new_messages = list(messages[start - offset:])
+        if not any(message.get("role") == "user" and message.get("content", "").strip() for message in new_messages):
+            entry["covered"], entry["fingerprints"] = upto, extend_fingerprints(entry["fingerprints"], start, new_messages)
+            return
+        previous_messages = list(messages[max(0, start - offset - self.context_messages):start - offset])
+        entry["future"] = self._executor.submit(self._assess, key, entry, context, previous_messages, new_messages, start, upto)
+        self._counters["assessments_started"] += 1
+
+    def observe(self, key, messages, offset=0, context=None):
+        """聊天的每一輪呼叫：有尚未評估的使用者發言時在背景排程一次評估 (同一對話同時最多一個)。"""
+        with self._lock:
+            self._schedule(key, self._entry(key, messages, offset, create=True), messages, offset, context)
+
+    def collect(self, key, messages, offset=0, context=None, wait_timeout=None):
+        """回傳 (逐輪評估, 是否已涵蓋 messages 中所有的使用者發言)；聊天時沒追蹤過這段對話則回傳 (None, False)。
+        尚有進行中的評估時最多等待 wait_timeout 秒，之後再把剩下的發言排程並等待一次。"""
+        deadline = None if wait_timeout is None else time.monotonic() + wait_timeout
+        for _ in range(2):
+            with self._lock:
+                entry = self._entry(key, messages, offset, create=False)
+                if entry is None: return None, False
+                self._schedule(key, entry, messages, offset, context)
+                future = entry["future"]
+            if future is None: break
+            try: future.result(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except Exception: break
+        with self._lock:
+            return [dict(turn) for turn in entry["turns"]], entry["covered"] >= offset + len(messages) and entry["future"] is None
+
+    def _assess(self, key, entry, context, previous_messages, new_messages, start, upto):
+        try:
+            assessment = self.assess_fn(context, previous_messages, new_messages)
+            with self._lock:
+                if assessment:
+                    user_messages = sum(1 for message in new_messages if message.get("role") == "user" and message.get("content", "").strip())
+                    entry["turns"].append(dict(assessment, start=start, end=upto, user_messages=user_messages))
+                    entry["covered"] = upto
+                    entry["fingerprints"] = extend_fingerprints(entry["fingerprints"], start, new_messages)
+                    entry["updated_at"] = time.time()
+                    self._counters["assessments_completed"] += 1
+                    self._counters["assessed_user_messages"] += user_messages
+                    state = {field: entry[field] for field in ("turns", "covered", "fingerprints")}
+                else:
+                    self._counters["assessments_failed"] += 1
+            if assessment and self.store is not None: self.store.save(key, state, entry["updated_at"])
+        except Exception:
+            with self._lock: self._counters["assessments_failed"] += 1
+            raise
+        finally:
+            with self._lock: entry["future"] = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, conversations=len(self._entries), persistent=self.store is not None)
+
+
+def _merge_items(turns, field, max_items):
+    # 越近的輪次越能代表使用者最後的狀態，由新到舊挑，內容相同的只留一次
+    items, seen = [], set()
+    for turn in reversed(turns):
+        for item in turn.get(field) or []:
+            normalized = NORMALIZE_PATTERN.sub("", item)
+            if not normalized or normalized in seen: continue
+            seen.add(normalized); items.append(item)
+            if len(items) >= max_items: return items
+    return items
+
+
+def merge_turn_assessments(turns, max_items=3):
+    """把逐輪評估合併成 userEvaluation 格式 (summary 留待呼叫端生成)。
+    分數以各輪評估的使用者發言數加權平均，理由取最近一輪的；優點與建議由新到舊去重後各取 max_items 點。"""
+    feedback = empty_feedback()
+    for key in SCORE_CATEGORIES:
+        weighted, weight, justification = 0, 0, None
+        for turn in turns:
+            item = (turn.get("scores") or {}).get(key)
+            if not item or item.get("score") is None: continue
+            turn_weight = max(1, turn.get("user_messages") or 1)
+            weighted += item["score"] * turn_weight; weight += turn_weight
+            justification = item.get("justification") or justification
+        if weight: feedback["scores"][key] = {"score": round(weighted / weight), "justification": justification or "AI 未提供"}
+    for field in ("strengths", "improvements"):
+        items = _merge_items(turns, field, max_items)
+        if items: feedback[field] = items
+    return feedback
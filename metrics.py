@@ -0,0 +1,197 @@
+"""Prometheus 文字格式的指標 (不依賴 prometheus_client)：每個請求階段的耗時直方圖、Ollama 回傳的各段耗時、
+token 數與 tokens/s。stage() 同時把耗時記到目前請求的摘要紀錄 (request_logging)，供 log 與 Server-Timing 使用。
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from request_logging import note_timing, request_field
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 5000)
+PROMPT_TOKEN_BUCKETS = (32, 64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 8192)
+
+
+def _label_key(label_names, labels):
+    return tuple(str(labels.get(name, "-")) for name in label_names)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs: return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.label_names, self.buckets = name, help_text, tuple(label_names), tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None: series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets): series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock: series_items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in series_items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name, self.help_text, self.label_names = name, help_text, tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock: items = list(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items)
+        return lines
+
+
+class GaugeCallback:
+    """讀取時才向 callback 取值的 gauge；callback 回傳 {(label 值...): 數值}。
+    值來自其他元件自己維護的累計計數時，以 metric_type="counter" 輸出。"""
+
+    def __init__(self, name, help_text, label_names, callback, metric_type="gauge"):
+        self.name, self.help_text, self.label_names, self.callback = name, help_text, tuple(label_names), callback
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in self.callback().items())
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics: lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+REQUEST_SECONDS = REGISTRY.register(Histogram("wingchat_request_seconds", "End-to-end request latency.", ("route", "mode", "status")))
+STAGE_SECONDS = REGISTRY.register(Histogram("wingchat_stage_seconds", "Latency of each request stage (validation, prompt_build, queue_wait, ollama_http, post_process, ...).", ("stage", "model", "mode")))
+OLLAMA_SECONDS = REGISTRY.register(Histogram("wingchat_ollama_seconds", "Durations reported by Ollama (total, load, prompt_eval, eval).", ("phase", "model", "mode")))
+OLLAMA_TOKENS = REGISTRY.register(Counter("wingchat_ollama_tokens_total", "Tokens processed by Ollama.", ("kind", "model", "mode")))
+OLLAMA_TOKENS_PER_SECOND = REGISTRY.register(Histogram("wingchat_ollama_tokens_per_second", "Ollama throughput per request (prompt evaluation and generation).", ("kind", "model", "mode"), TOKENS_PER_SECOND_BUCKETS))
+ABORTED_GENERATIONS = REGISTRY.register(Counter("wingchat_aborted_generations_total", "Ollama generations not started or stopped early because the client gave up (deadline or disconnect).", ("reason", "model", "mode")))
+TOKENS_SAVED = REGISTRY.register(Counter("wingchat_tokens_saved_total", "Upper-bound estimate of tokens not generated thanks to deadlines, disconnect aborts, early stopping and num_predict budgeting.", ("reason", "model", "mode")))
+EARLY_STOPPED_GENERATIONS = REGISTRY.register(Counter("wingchat_early_stopped_generations_total", "Chat generations stopped once the reply had enough lines or started repeating itself or commenting on the reply.", ("reason", "model", "mode")))
+INCREMENTAL_FEEDBACK = REGISTRY.register(Counter("wingchat_incremental_feedback_total", "Feedback requests answered by merging per-turn background assessments (merged) or evaluated from scratch because they were missing or incomplete.", ("outcome",)))
+PROMPT_TOKENS = REGISTRY.register(Histogram("wingchat_prompt_tokens", "Prompt size per request by fragment (system, instruction, summary, history, latest) and in total.", ("fragment", "model", "mode"), PROMPT_TOKEN_BUCKETS))
+PROMPT_HISTORY_DROPPED = REGISTRY.register(Counter("wingchat_prompt_history_dropped_messages_total", "History messages left out of the prompt by the token budget (covered by the rolling summary).", ("model", "mode")))
+ADMISSION_WAIT_SECONDS = REGISTRY.register(Histogram("wingchat_admission_wait_seconds", "Time spent queued for a generation slot per request class.", ("model", "request_class")))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+KNOWN_MODES = frozenset(("character_play", "assistant", "feedback", "summary", "feedback_turn"))
+
+
+def mode_label(mode):
+    """mode 來自請求內容，不在已知集合內的一律記成 "other"，避免任意字串讓序列數無限增長。"""
+    if mode is None or mode == "-": return "-"
+    return mode if isinstance(mode, str) and mode in KNOWN_MODES else "other"
+
+
+def current_labels(model=None, mode=None):
+    return {"model": model or request_field("model", "-"), "mode": mode_label(mode or request_field("mode", "-"))}
+
+
+@contextmanager
+def stage(name, model=None, mode=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        note_timing(name, elapsed * 1000)
+        STAGE_SECONDS.observe(elapsed, stage=name, **current_labels(model, mode))
+
+
+def observe_stage(name, seconds, model=None, mode=None):
+    note_timing(name, seconds * 1000)
+    STAGE_SECONDS.observe(seconds, stage=name, **current_labels(model, mode))
+
+
+def record_ollama_response(response_data, model, mode=None):
+    """Ollama 最後一個回應 (或非串流回應) 中的 *_duration 單位是奈秒。"""
+    labels = current_labels(model, mode)
+    for phase in ("total", "load", "prompt_eval", "eval"):
+        duration_ns = response_data.get(f"{phase}_duration")
+        if duration_ns:
+            OLLAMA_SECONDS.observe(duration_ns / 1e9, phase=phase, **labels)
+            note_timing(f"ollama_{phase}", duration_ns / 1e6)
+    for kind, count_field, duration_field in (("prompt", "prompt_eval_count", "prompt_eval_duration"), ("generated", "eval_count", "eval_duration")):
+        count = response_data.get(count_field)
+        if not count: continue
+        OLLAMA_TOKENS.inc(count, kind=kind, **labels)
+        if response_data.get(duration_field):
+            OLLAMA_TOKENS_PER_SECOND.observe(count / (response_data[duration_field] / 1e9), kind=kind, **labels)
+
+
+def observe_prompt_tokens(report, model, mode=None):
+    """report 為 prompt_budget.token_report 的結果。"""
+    labels = current_labels(model, mode)
+    for fragment, tokens in report["fragments"].items(): PROMPT_TOKENS.observe(tokens, fragment=fragment, **labels)
+    PROMPT_TOKENS.observe(report["total"], fragment="total", **labels)
+    if report["dropped_messages"]: PROMPT_HISTORY_DROPPED.inc(report["dropped_messages"], **labels)
+
+
+def observe_admission_wait(model, ticket):
+    ADMISSION_WAIT_SECONDS.observe(time.monotonic() - ticket.enqueued, model=model, request_class=ticket.request_class)
+
+
+def record_aborted_generation(reason, model, mode=None, tokens_saved=None):
+    """tokens_saved 是上限估計：num_predict 減去已生成的片段數 (模型也可能更早自行結束)。"""
+    labels = current_labels(model, mode)
+    ABORTED_GENERATIONS.inc(reason=reason, **labels)
+    if tokens_saved: TOKENS_SAVED.inc(tokens_saved, reason=reason, **labels)
+
+
+def record_early_stop(reason, model, mode=None, tokens_saved=None):
+    """reason 為 max_lines / repetition / meta；省下的 token 一律記在 reason="early_stop" 之下。"""
+    labels = current_labels(model, mode)
+    EARLY_STOPPED_GENERATIONS.inc(reason=reason, **labels)
+    if tokens_saved: TOKENS_SAVED.inc(tokens_saved, reason="early_stop", **labels)
+
+
+def observe_request(fields):
+    """RequestLogSampler 的 on_finish callback。以路由樣板 (route) 而非實際路徑當 label，避免 job_id / session_id 讓序列數無限增長。"""
+    if fields.get("duration_ms") is None: return
+    REQUEST_SECONDS.observe(fields["duration_ms"] / 1000, route=fields.get("route", "-"), mode=mode_label(fields.get("mode", "-")), status=fields.get("status", "-"))
+
+
+def server_timing_header(timings_ms):
+    return ", ".join(f"{name};dur={duration}" for name, duration in timings_ms.items())
@@ -1,24 +1,54 @@
-import requests
+"""微調模型的對話重播評估：從 JSONL 讀入腳本化的對話，以有限的併發數同時重播，逐輪記錄延遲、token 數與風格違反。
+
+每行一個對話: {"id": "...", "persona": "...", "goal": "...", "messages": ["對方第一句", "對方第二句", ...]}
+同一對話內的各輪依序進行 (下一輪的 prompt 需要上一輪的回覆)，不同對話之間併發。每完成一輪就寫出一行結果 (JSONL)，
+中途中斷也不會遺失已完成的輪次；結束時印出延遲百分位數、生成速率與風格違反的摘要。
+
+用法:
+    python model/ollama_api_chat.py --dialogues model/replay_dialogues.jsonl --concurrency 4 --output results.jsonl
+    python model/ollama_api_chat.py --fake-ollama --latency 0.2        # 不需要 GPU：改打 bench/fake_ollama.py 的替身
+"""
+import argparse
+import asyncio
 import json
-import re
 import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+import aiohttp
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(MODEL_DIR)
+sys.path.insert(0, ROOT_DIR)  # 專案根目錄 (reply_postprocess.py)
+sys.path.insert(0, os.path.join(ROOT_DIR, "bench"))
+import fake_ollama  # noqa: E402
+from reply_postprocess import STRICT_LINE_STYLE  # noqa: E402
 
 # --- 配置日誌 ---
-# 與 Flask app 使用的 logger 實例分開，或者如果這是在 Flask app 內部，則使用 app.logger
-# 為了本地測試，我們獨立配置
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 logger = logging.getLogger(__name__) # 使用 __name__ 使日誌來源更清晰
 
 # --- 配置 ---
 OLLAMA_API_URL = "http://localhost:11434/api/generate"
 MODEL_NAME_IN_OLLAMA = "my-custom-llama3"
-
-# --- 推理函數 (強化風格指令 v5.8 - 加入避免重複提示) ---
-def create_inference_prompt(persona, goal, conversation_history, last_message):
-    """根據輸入創建推理用的 Prompt, 加入對話歷史, 極端強調風格 (v5.8 - 加入避免重複提示)"""
-    prompt_parts = []
-    # --- 使用與訓練 v6 一致的風格指令 (已強化) ---
-    style_instruction = """### **[絕對規則] 目標輸出風格 (MUST FOLLOW RULES):**
+DEFAULT_DIALOGUES = os.path.join(MODEL_DIR, "replay_dialogues.jsonl")
+HISTORY_LIMIT = 4 # prompt 中最多放幾則歷史訊息 (不含「對方剛說」)
+
+GENERATION_OPTIONS = {
+    "temperature": 0.3,
+    "top_p": 0.8,
+    "repeat_penalty": 1.2,
+    "num_predict": 60,      # 限制生成長度，避免過長
+    "stop": ["<|eot_id|>", "<|end_of_text|>", "對方：", "User:", "Context:"]
+}
+
+# --- 推理 Prompt (強化風格指令 v5.8 - 加入避免重複提示) ---
+# 與訓練 v6 一致的風格指令是固定的，只在載入時組一次；每輪只格式化 persona / goal / 對話紀錄。
+# 固定內容放在 prompt 最前面，同一對話的每一輪共用相同前綴，Ollama 可沿用已評估的 KV cache。
+STYLE_INSTRUCTION = """### **[絕對規則] 目標輸出風格 (MUST FOLLOW RULES):**
 *   **核心要求 (Core Requirement)**: 100% 模仿台灣大學生用 LINE 聊天。輸出**必須極度簡短**！每個概念、**甚至每個短語或語氣詞**都必須拆成獨立的短訊息，並且**只能**使用換行符 `\\n` 來分隔這些短訊息。**單行文字必須非常短！**
 *   **絕對禁止 (ABSOLUTELY FORBIDDEN - DO NOT USE):**
     *   **任何 Emoji**。 *   **逗號** `,`。 *   **句號** `.` 或 `。`。 *   **引號** `"` `'` 「」 『』。
@@ -40,215 +70,171 @@ def create_inference_prompt(persona, goal, conversation_history, last_message):
         *   壞範例 2: 欸那你想去哪我看看時間 (應拆成 "欸\\n那你想去哪\\n我看看時間")
         *   壞範例 3: 我也還沒睡醒啦正在滑手機你呢 (應拆成 "我也還沒睡醒啦\\n正在滑手機\\n你呢")
         *   壞範例 4: 抱歉我沒想到你會那麼認真還是太早了點呢 (應拆成 "抱歉\\n我沒想到你會那麼認真\\n還是太早了點呢")"""
-    prompt_parts.append(style_instruction)
-
-    if persona: prompt_parts.append(f"### 對方資訊 (Persona):\n{persona}") # 假設 persona 是從 Flask 傳來的角色描述
-    if goal: prompt_parts.append(f"### 你的對話目標 (Your Goal):\n{goal}")
-
-    context_str = ""
-    if conversation_history and isinstance(conversation_history, list):
-        history_limit = 4 # 修改: 減少歷史記錄長度 (原為 6)
-        limited_history = conversation_history[-history_limit:]
-        formatted_history = []
-        for entry in limited_history:
-            # 假設 Flask app 傳來的 history 格式是 ['對方：訊息1', '你：回覆1', ...]
-            # '你：回覆1' 中的回覆1 應該是單行文本 (換行符已被空格替代)
-            if isinstance(entry, str): # 確保 entry 是字串
-                 # 日誌顯示 history 格式: ['對方：我喜歡你', '你：嗯嗯 謝謝你的讚美 不過我們還是朋友就好吧']
-                 # 這個格式是正確的，不需要再處理 entry 內的換行符，因為它們已經被處理了。
-                formatted_history.append(entry)
-            else:
-                logger.warning(f"History entry is not a string: {entry}")
-
-        context_str += "\n".join(formatted_history)
-
-    if last_message:
-        last_msg_clean = str(last_message).replace('\n', ' ') # 用戶輸入中的換行符也替換掉
-        if context_str:
-            context_str += f"\n對方剛說：{last_msg_clean}"
-        else:
-            context_str = f"對方剛說：{last_msg_clean}"
-
-    if context_str:
-        prompt_parts.append(f"### 對話紀錄 (Context):\n{context_str}")
-
-    prompt_content = "\n\n".join(prompt_parts)
-
-    final_user_content = (
-        f"參考下方所有資訊，並**嚴格遵守**上面列出的**所有絕對規則**，生成一個建議回覆。\n\n"
-        f"{prompt_content}\n\n"
-        f"**嚴格依照所有規則，特別是避免重複你之前說過的話，直接生成**極度簡短且用 `\\n` 分隔的建議回覆：" # 修改: 強調避免重複
-    )
-
-    ollama_full_prompt = (
-        f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n"
-        f"{final_user_content}"
-        f"<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
-    )
-    return ollama_full_prompt
-
-
-# --- Ollama API 調用函數 ---
-def generate_with_ollama(full_prompt_str):
-    """使用 Ollama API 生成回覆"""
-    payload = {
-        "model": MODEL_NAME_IN_OLLAMA,
-        "prompt": full_prompt_str,
-        "stream": False,
-        "raw": True,
-        "options": {
-            "temperature": 0.3,     # 修改: 稍微提高溫度 (原為 0.2)
-            "top_p": 0.8,           # 修改: 配合溫度調整 (原為 0.7)
-            "repeat_penalty": 1.2,  # 修改: 稍微提高重複懲罰 (原為 1.15)
-            "num_predict": 60,      # 限制生成長度，避免過長
-            "stop": ["<|eot_id|>", "<|end_of_text|>", "對方：", "User:", "Context:"] # 增加停止詞
-        }
-    }
-    try:
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=60) # 增加 timeout
-        response.raise_for_status()
-        response_data = response.json()
-        generated_text = response_data.get("response", "").strip()
-        return generated_text
-    except requests.exceptions.Timeout:
-        logger.error(f"調用 Ollama API 時超時 ({OLLAMA_API_URL})")
-        return "[Ollama API 超時]"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"調用 Ollama API 時出錯: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                logger.error(f"錯誤詳情 (Ollama): {e.response.json()}")
-            except json.JSONDecodeError:
-                logger.error(f"錯誤詳情 (Ollama, 非JSON): {e.response.text}")
-        return "[Ollama API 錯誤]"
+PROMPT_HEAD = (
+    "<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n"
+    "參考下方所有資訊，並**嚴格遵守**上面列出的**所有絕對規則**，生成一個建議回覆。\n\n"
+    + STYLE_INSTRUCTION
+)
+PROMPT_TAIL = (
+    "\n\n**嚴格依照所有規則，特別是避免重複你之前說過的話，直接生成**極度簡短且用 `\\n` 分隔的建議回覆："
+    "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+)
+SPEAKER_LABELS = {"partner": "對方", "you": "你"}
+
+
+def single_line(text):
+    return str(text).replace("\n", " ")
+
+
+def create_inference_prompt(persona, goal, history, last_message, history_limit=HISTORY_LIMIT):
+    """history 為 [(speaker, text), ...]，speaker 是 "partner" 或 "you"；訊息在這裡才轉成單行並加上「對方：」/「你：」。"""
+    parts = [PROMPT_HEAD]
+    if persona: parts.append(f"### 對方資訊 (Persona):\n{persona}")
+    if goal: parts.append(f"### 你的對話目標 (Your Goal):\n{goal}")
+    context = [f"{SPEAKER_LABELS[speaker]}：{single_line(text)}" for speaker, text in history[-history_limit:]]
+    if last_message: context.append(f"對方剛說：{single_line(last_message)}")
+    if context: parts.append("### 對話紀錄 (Context):\n" + "\n".join(context))
+    return "\n\n".join(parts) + PROMPT_TAIL
 
-# --- 後處理函數 ---
-prefix_pattern = re.compile(r'^\s*(?:話翼|AI|Assistant|模型|回答|建議|你|You|assistant)\s*[:：]?\s*', re.IGNORECASE) # 增加了 "你", "You", "assistant"
-punctuation_to_remove = ".。、；：「」『』（）《》\"'();:" # 逗號已由此處移除 (冒號仍在此處，移除如 10:30 的冒號)
 
+# --- 後處理函數 ---
+# 與 app.py 共用 reply_postprocess 的預先編譯 profile；這個微調模型用較嚴格的版本 (逗號改為空格，句號也移除)
 def post_process_reply(raw_ai_reply):
-    if not raw_ai_reply or raw_ai_reply.isspace(): # 修改: 提早返回如果輸入為空
-        return ""
+    return STRICT_LINE_STYLE.apply(raw_ai_reply)
+
+
+def style_report(raw_reply, reply):
+    lines = reply.split("\n") if reply else []
+    return {"forbidden_chars": STRICT_LINE_STYLE.count_punctuation(raw_reply), "prefix": bool(STRICT_LINE_STYLE.prefix_pattern.match(raw_reply.strip())),
+            "lines": len(lines), "max_line_chars": max((len(line) for line in lines), default=0), "empty": not reply}
+
+
+# --- Ollama API 調用 ---
+async def generate_with_ollama(session, api_url, model, full_prompt, options=GENERATION_OPTIONS):
+    """回傳 Ollama 的完整回應 (response 與 prompt_eval_count、eval_count、各階段耗時等欄位)。"""
+    payload = {"model": model, "prompt": full_prompt, "stream": False, "raw": True, "options": options}
+    async with session.post(api_url, json=payload) as response:
+        if response.status != 200:
+            detail = await response.text()
+            raise RuntimeError(f"Ollama HTTP {response.status}: {detail[:200]}")
+        return await response.json(content_type=None)
+
+
+def turn_metrics(response_data, latency):
+    eval_count, eval_duration = response_data.get("eval_count"), response_data.get("eval_duration")
+    return {
+        "latency_seconds": round(latency, 4),
+        "prompt_eval_count": response_data.get("prompt_eval_count"), "eval_count": eval_count,
+        "prompt_eval_seconds": round(response_data.get("prompt_eval_duration", 0) / 1e9, 4),
+        "load_seconds": round(response_data.get("load_duration", 0) / 1e9, 4),
+        "total_seconds": round(response_data.get("total_duration", 0) / 1e9, 4),
+        "tokens_per_second": round(eval_count / (eval_duration / 1e9), 2) if eval_count and eval_duration else None,
+    }
+
 
-    cleaned_reply_step1 = prefix_pattern.sub('', raw_ai_reply).strip()
+class ResultWriter:
+    """每完成一輪就寫出一行並 flush；同一 event loop 內不需要鎖。"""
 
-    # 替換半形和全形逗號為空格
-    cleaned_reply_step2 = cleaned_reply_step1.replace(',', ' ').replace('，', ' ')
+    def __init__(self, stream):
+        self.stream = stream
+        self.rows = []
 
-    # 移除其他禁止的標點符號
-    cleaned_reply_step3 = cleaned_reply_step2
-    for punc in punctuation_to_remove:
-        cleaned_reply_step3 = cleaned_reply_step3.replace(punc, '')
+    def write(self, row):
+        self.rows.append(row)
+        if self.stream is not None:
+            self.stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.stream.flush()
 
-    # 將字串中的 '\\n' 轉換為實際的換行符 '\n'
-    # 模型被指示輸出 '\\n' (兩個字符的字串)
-    cleaned_reply_step4 = cleaned_reply_step3.replace('\\n', '\n')
 
-    processed_reply = cleaned_reply_step4.strip() # 再次 strip 確保首尾無多餘空白或換行
-    lines = processed_reply.split('\n')
-    # 清理每行首尾空格，並移除空行
-    cleaned_lines = [line.strip() for line in lines if line.strip()]
+async def replay_dialogue(session, args, dialogue, writer):
+    history = []
+    for turn, message in enumerate(dialogue["messages"]):
+        prompt = create_inference_prompt(dialogue.get("persona"), dialogue.get("goal"), history, message)
+        row = {"dialogue_id": dialogue["id"], "turn": turn, "message": message, "prompt_chars": len(prompt)}
+        started = time.perf_counter()
+        try:
+            response_data = await generate_with_ollama(session, args.url, args.model, prompt)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            # 這一輪沒有回覆，後面的輪次少了上下文也沒有比較意義，結束這個對話
+            writer.write(dict(row, latency_seconds=round(time.perf_counter() - started, 4), error=str(e) or type(e).__name__))
+            logger.warning(f"對話 {dialogue['id']} 第 {turn} 輪失敗: {e!r}")
+            return
+        raw_reply = response_data.get("response", "").strip()
+        reply = post_process_reply(raw_reply)
+        writer.write(dict(row, raw_reply=raw_reply, reply=reply, style=style_report(raw_reply, reply), **turn_metrics(response_data, time.perf_counter() - started)))
+        history += [("partner", message), ("you", reply or "[過濾後為空]")]
+
+
+async def replay(args, dialogues, writer):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=args.timeout)) as session:
+        async def run(dialogue):
+            async with semaphore: await replay_dialogue(session, args, dialogue, writer)
+        await asyncio.gather(*(run(dialogue) for dialogue in dialogues))
+
+
+def read_dialogues(path, repeat=1):
+    with open(path, encoding="utf-8") as f:
+        dialogues = [json.loads(line) for line in f if line.strip()]
+    for index, dialogue in enumerate(dialogues):
+        dialogue.setdefault("id", str(index))
+        if not dialogue.get("messages"): raise SystemExit(f"{path} 第 {index + 1} 個對話沒有 messages")
+    if repeat > 1: dialogues = [dict(dialogue, id=f"{dialogue['id']}#{copy}") for copy in range(repeat) for dialogue in dialogues]
+    return dialogues
+
+
+def summarize(rows, elapsed):
+    def percentile(values, fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+    ok = [row for row in rows if "error" not in row]
+    latencies = sorted(row["latency_seconds"] for row in ok)
+    rates = [row["tokens_per_second"] for row in ok if row.get("tokens_per_second")]
+    return {
+        "turns": len(rows), "errors": len(rows) - len(ok), "elapsed_seconds": round(elapsed, 2),
+        "turns_per_second": round(len(rows) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.50), "latency_p95": percentile(latencies, 0.95), "latency_max": latencies[-1] if latencies else 0.0,
+        "mean_tokens_per_second": round(statistics.fmean(rates), 1) if rates else None,
+        "mean_eval_count": round(statistics.fmean(row["eval_count"] for row in ok if row.get("eval_count")), 1) if any(row.get("eval_count") for row in ok) else None,
+        "empty_replies": sum(row["style"]["empty"] for row in ok),
+        "replies_with_forbidden_chars": sum(1 for row in ok if row["style"]["forbidden_chars"]),
+        "replies_with_prefix": sum(row["style"]["prefix"] for row in ok),
+        "replies_over_5_lines": sum(1 for row in ok if row["style"]["lines"] > 5),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dialogues", default=DEFAULT_DIALOGUES, help="對話 JSONL (預設 model/replay_dialogues.jsonl)")
+    parser.add_argument("--output", help="逐輪結果的 JSONL 路徑，'-' 代表 stdout；省略時只印摘要")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時重播的對話數")
+    parser.add_argument("--repeat", type=int, default=1, help="每個對話重播幾次")
+    parser.add_argument("--timeout", type=float, default=60.0, help="每一輪的逾時秒數")
+    parser.add_argument("--url", default=OLLAMA_API_URL)
+    parser.add_argument("--model", default=MODEL_NAME_IN_OLLAMA)
+    parser.add_argument("--fake-ollama", action="store_true", help="在背景啟動 bench/fake_ollama.py 的替身並改打它")
+    parser.add_argument("--fake-port", type=int, default=11501)
+    fake_ollama.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.fake_ollama:
+        server = fake_ollama.serve(args.fake_port, args.latency, args.tokens_per_second, **fake_ollama.options_from_args(args))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = f"http://127.0.0.1:{args.fake_port}/api/generate"
+
+    dialogues = read_dialogues(args.dialogues, args.repeat)
+    logger.info(f"重播 {len(dialogues)} 個對話 ({sum(len(d['messages']) for d in dialogues)} 輪)，併發 {args.concurrency}，模型 {args.model} @ {args.url}")
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8") if args.output else None
+    writer = ResultWriter(output)
+    started = time.perf_counter()
+    try:
+        asyncio.run(replay(args, dialogues, writer))
+    except KeyboardInterrupt:
+        logger.info("中斷；已完成的輪次都已寫出")
+    finally:
+        if output not in (None, sys.stdout): output.close()
+    print(json.dumps(summarize(writer.rows, time.perf_counter() - started), ensure_ascii=False, indent=2), file=sys.stderr)
 
-    final_reply = "\n".join(cleaned_lines)
-    return final_reply
 
-# --- 主交互邏輯 (用於本地測試) ---
 if __name__ == "__main__":
-    # conversation_history 的格式應與 Flask app 中傳給 create_inference_prompt 的一致
-    # 即: ['對方：訊息1', '你：回覆1 (單行)', '對方：訊息2', '你：回覆2 (單行)', ...]
-    conversation_history_for_test = []
-
-    # 來自你日誌的 persona 和 goal
-    current_persona_from_log = "我是 WingChat，一個友善且樂於助人的 AI 社交教練。"
-    current_goal_from_log = "早安"
-
-    logger.info("\n=========================================")
-    logger.info(f"  話翼 AI 社交教練 - Ollama API 模式 (本地測試)")
-    logger.info(f"  (模型: {MODEL_NAME_IN_OLLAMA} @ {OLLAMA_API_URL})")
-    logger.info("=========================================")
-    logger.info("\n輸入 'quit' 退出。")
-    logger.info("-" * 40)
-
-    # 模擬日誌中的對話流程
-    test_dialogue = [
-        "我喜歡你",
-        "為甚麼 我是真心的",
-        "你明天幾點要上課"
-    ]
-    
-    current_input_index = 0
-
-    while True:
-        try:
-            if current_input_index < len(test_dialogue):
-                user_input = test_dialogue[current_input_index]
-                logger.info(f"\n>>> 你 (對方剛說的話) (模擬): {user_input}")
-                current_input_index += 1
-            else:
-                user_input = input(">>> 你 (對方剛說的話) (手動輸入，或 'quit'): ").strip()
-
-            if user_input.lower() == 'quit':
-                logger.info("\n正在退出...")
-                break
-            if not user_input:
-                if current_input_index >= len(test_dialogue): # 如果是手動輸入階段的空輸入則跳過
-                    continue
-                else: # 模擬輸入結束
-                    logger.info("\n模擬對話結束，進入手動輸入模式。")
-                    continue
-
-
-            prompt_for_ollama = create_inference_prompt(
-                persona=current_persona_from_log,
-                goal=current_goal_from_log,
-                conversation_history=conversation_history_for_test,
-                last_message=user_input
-            )
-            logger.info(f"\n[DEBUG] 發送給 Ollama 的完整 Prompt (前500字符):\n {prompt_for_ollama[:500]}...")
-            # logger.info(f"\n[DEBUG] 完整 Prompt:\n{prompt_for_ollama}") # 如果需要看完整 prompt
-            logger.info("-" * 20)
-
-            logger.info("話翼思考中...")
-            raw_ollama_reply = generate_with_ollama(prompt_for_ollama)
-            logger.info(f"[DEBUG] Ollama 原始回覆: {repr(raw_ollama_reply)}")
-            logger.info("-" * 20)
-
-            final_reply = post_process_reply(raw_ollama_reply)
-
-            logger.info(f"✨ 話翼建議:")
-            if not final_reply:
-                logger.info("(模型未生成有效回覆 或 回覆被過濾)")
-                final_reply_for_history_storage = "[過濾後為空]"
-            else:
-                print(final_reply) # final_reply 已經是處理好 \n 的
-                final_reply_for_history_storage = final_reply
-
-            # 更新歷史記錄
-            # 1. 對方說的話
-            conversation_history_for_test.append(f"對方：{user_input.replace('\n', ' ')}") # 用戶輸入也確保單行
-
-            # 2. 你的回覆 (AI的回覆)
-            #    存入歷史時，AI 的多行回覆應轉換為單行（用空格分隔），以符合 prompt 中歷史的格式
-            #    你的日誌顯示 '你：嗯嗯 謝謝你的讚美 不過我們還是朋友就好吧'，這是單行的。
-            #    post_process_reply 返回的 final_reply 可能包含 '\n'
-            ai_reply_single_line_for_history = final_reply_for_history_storage.replace('\n', ' ')
-            conversation_history_for_test.append(f"你：{ai_reply_single_line_for_history}")
-
-            # 管理歷史記錄長度 (與 create_inference_prompt 中的 history_limit 保持一致或略大)
-            # create_inference_prompt 內部會取最後 history_limit (目前是4)
-            # 所以這裡可以稍微多保留一些，比如 8 條 (4輪對話)
-            max_history_entries_for_storage = 8
-            if len(conversation_history_for_test) > max_history_entries_for_storage:
-                conversation_history_for_test = conversation_history_for_test[-max_history_entries_for_storage:]
-            
-            logger.info(f"[DEBUG] 更新後的 history (用於下一輪 prompt): {conversation_history_for_test}")
-            logger.info("-" * 40)
-
-        except KeyboardInterrupt:
-            logger.info("\n檢測到退出信號...")
-            break
-        except Exception as e:
-            logger.error(f"\n交互循環中發生錯誤: {e}", exc_info=True)
-            break # 發生錯誤時也退出循環，避免無限錯誤
-
-    logger.info("\n對話結束！")
\ No newline at end of file
+    main()
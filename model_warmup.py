@@ -0,0 +1,124 @@
+"""啟動時預載模型、以 keep_alive 心跳讓模型常駐，並提供 readiness 狀態。
+
+重新啟動後 (或 Ollama 因閒置卸載模型後) 的第一個使用者請求要付出整個 GGUF 的載入時間 (load_duration) 加上系統 prompt 的評估，
+有時甚至撞上讀取逾時。ModelWarmer 在背景對每個後端、每個模型送出預熱請求：先載入模型，再以各模式共用的系統 prompt 前綴
+生成 1 個 token，讓 KV cache 裡已經有這段前綴。之後每 heartbeat_seconds 秒確認模型仍在記憶體中 (/api/ps)，
+還在就送出不生成的 keep_alive 請求延長常駐時間，已被卸載就重新預熱。
+
+每個模型至少在一個後端上預熱完成前 ready() 為 False (/readyz 回 503)，負載平衡器只會把流量送到已預熱的實例。
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ModelWarmer:
+    """targets 為 {model: [預熱 payload, ...]}；send(backend_url, endpoint_path, payload) 回傳 Ollama 的 JSON，
+    loaded_models(backend_url) 回傳該後端目前載入的模型名稱集合 (後端不支援 /api/ps 時丟出例外，改為一律送心跳)。"""
+
+    def __init__(self, backend_urls, targets, send, loaded_models=None, keep_alive="30m", heartbeat_seconds=600.0, retry_seconds=15.0):
+        self.backend_urls = list(backend_urls)
+        self.targets = targets
+        self.send = send
+        self.loaded_models = loaded_models
+        self.keep_alive = keep_alive
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retry_seconds = retry_seconds
+        self._states = {(backend_url, model): {"status": "pending", "warmed_at": None, "load_seconds": None, "prime_seconds": None, "error": None}
+                        for backend_url in self.backend_urls for model in targets}
+        self._counters = dict.fromkeys(("warmups", "heartbeats", "reloads", "failures"), 0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """啟動背景執行緒 (重複呼叫沒有作用)。"""
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = threading.Thread(target=self._run, name="model-warmer", daemon=True)
+        self._thread.start()
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def stop(self):
+        self._stop.set()
+
+    def ready(self):
+        with self._lock: return self._ready()
+
+    def _ready(self):
+        return self.started and all(any(self._states[(backend_url, model)]["status"] == "ready" for backend_url in self.backend_urls) for model in self.targets)
+
+    def _run(self):
+        while not self._stop.is_set():
+            for backend_url in self.backend_urls:
+                loaded = self._loaded(backend_url)
+                for model in self.targets:
+                    if self._stop.is_set(): return
+                    self._maintain(backend_url, model, loaded)
+            # 還有沒預熱成功的模型時較快重試
+            self._stop.wait(self.heartbeat_seconds if self._all_ready() else self.retry_seconds)
+
+    def _all_ready(self):
+        with self._lock: return all(state["status"] == "ready" for state in self._states.values())
+
+    def _loaded(self, backend_url):
+        if self.loaded_models is None: return None
+        try:
+            return self.loaded_models(backend_url)
+        except Exception as e:
+            logger.debug("Could not list loaded models on %s: %s", backend_url, e)
+            return None
+
+    def _maintain(self, backend_url, model, loaded):
+        state = self._states[(backend_url, model)]
+        if state["status"] == "ready" and (loaded is None or model in loaded):
+            try:
+                self.send(backend_url, "/api/generate", self._heartbeat_payload(model))
+                with self._lock: self._counters["heartbeats"] += 1
+            except Exception as e:
+                self._fail(backend_url, model, e)
+            return
+        if state["status"] == "ready":
+            logger.warning("Model %s was unloaded from %s, warming it up again", model, backend_url)
+            with self._lock: self._counters["reloads"] += 1
+        self._warm(backend_url, model)
+
+    def _heartbeat_payload(self, model):
+        # 沒有 prompt：只載入 / 延長常駐，不生成。num_ctx 必須與一般請求相同，否則 Ollama 會以新的 context 大小重新載入模型
+        options = {key: value for key, value in (self.targets[model][0].get("options") or {}).items() if key == "num_ctx"}
+        return dict({"model": model, "keep_alive": self.keep_alive}, **({"options": options} if options else {}))
+
+    def _warm(self, backend_url, model):
+        with self._lock: self._states[(backend_url, model)]["status"] = "warming"
+        started = time.monotonic()
+        load_seconds = None
+        try:
+            for payload in self.targets[model]:
+                response_data = self.send(backend_url, "/api/generate", payload)
+                if load_seconds is None: load_seconds = (response_data.get("load_duration") or 0) / 1e9
+        except Exception as e:
+            self._fail(backend_url, model, e)
+            return
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._states[(backend_url, model)].update(status="ready", warmed_at=time.time(), load_seconds=round(load_seconds or 0.0, 3),
+                                                      prime_seconds=round(max(0.0, elapsed - (load_seconds or 0.0)), 3), error=None)
+            self._counters["warmups"] += 1
+        logger.info("Warmed up %s on %s in %.1fs (load %.1fs, %d prefixes primed)", model, backend_url, elapsed, load_seconds or 0.0, len(self.targets[model]))
+
+    def _fail(self, backend_url, model, error):
+        logger.warning("Warm-up / keep-alive for %s on %s failed: %s", model, backend_url, error)
+        with self._lock:
+            self._states[(backend_url, model)].update(status="failed", error=str(error))
+            self._counters["failures"] += 1
+
+    def stats(self):
+        with self._lock:
+            backends = {}
+            for (backend_url, model), state in self._states.items(): backends.setdefault(backend_url, {})[model] = dict(state)
+            return dict(self._counters, started=self.started, ready=self._ready(), keep_alive=self.keep_alive, heartbeat_seconds=self.heartbeat_seconds, backends=backends)
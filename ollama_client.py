@@ -0,0 +1,330 @@
+"""共用的 Ollama HTTP 客戶端：連線池 + keep-alive、多後端路由，並限制每個模型同時進行中的生成數量。"""
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OllamaOverloadedError(Exception):
+    """等待佇列已滿或排隊逾時，呼叫端應回傳 503 並附上 Retry-After。"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """一個等待 (或已取得) 生成名額的請求。cost 是預估的工作量 (約等於生成的 token 數)，用於短工作優先與加權公平。"""
+
+    def __init__(self, request_class, user, cost, seq):
+        self.request_class = request_class
+        self.user = user
+        self.cost = cost
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.waiter = None  # asyncio 版本放 future
+
+
+class AdmissionQueue:
+    """單一模型的准入排程 (本身不加鎖，由 limiter 在自己的鎖內呼叫)。
+
+    - 依請求類別 (character_play / assistant / feedback) 分開排隊，以 stride scheduling 按權重分配名額：
+      每取得一個名額，該類別的 pass 前進 cost / weight，下一個名額給 pass 最小且有人在等的類別。
+    - 類別可設同時進行中的上限 (例如 feedback 最多佔一半名額)，保留名額給互動請求，長評估不會把名額全部佔滿。
+    - 同一類別內先給目前進行中最少的使用者，再挑預估工作量最小的 (等越久工作量打越多折扣，避免長工作餓死)，最後依到達順序。
+    """
+
+    def __init__(self, max_in_flight, class_weights, class_max_in_flight=None, default_class=None, class_aliases=None, aging_seconds=10.0):
+        self.max_in_flight = max_in_flight
+        self.class_weights = class_weights
+        self.class_max_in_flight = class_max_in_flight or {}
+        self.default_class = default_class or next(iter(class_weights))
+        self.class_aliases = class_aliases or {}
+        self.aging_seconds = aging_seconds
+        self.in_flight = 0
+        self._waiting = []
+        self._seq = 0
+        self._pass = dict.fromkeys(class_weights, 0.0)
+        self._virtual_time = 0.0
+        self._class_in_flight = dict.fromkeys(class_weights, 0)
+        self._user_in_flight = {}
+        self._class_counters = {request_class: {"admitted": 0, "wait_seconds_total": 0.0} for request_class in class_weights}
+
+    def ticket(self, request_class, user=None, cost=None):
+        request_class = self.class_aliases.get(request_class, request_class)
+        if request_class not in self.class_weights: request_class = self.default_class
+        self._seq += 1
+        return AdmissionTicket(request_class, user or "-", cost or 1.0, self._seq)
+
+    def waiting(self, request_class=None, user=None):
+        return sum(1 for ticket in self._waiting if (request_class is None or ticket.request_class == request_class) and (user is None or ticket.user == user))
+
+    def push(self, ticket):
+        # 閒置過的類別從目前的虛擬時間起算，不能把閒置期間累積成一次爆量
+        if not self.waiting(ticket.request_class) and not self._class_in_flight[ticket.request_class]:
+            self._pass[ticket.request_class] = max(self._pass[ticket.request_class], self._virtual_time)
+        self._waiting.append(ticket)
+
+    def remove(self, ticket):
+        if ticket in self._waiting: self._waiting.remove(ticket)
+
+    def _eligible(self, request_class):
+        limit = self.class_max_in_flight.get(request_class)
+        return limit is None or self._class_in_flight[request_class] < limit
+
+    def _ticket_key(self, ticket, now):
+        aged_cost = ticket.cost / (1 + (now - ticket.enqueued) / self.aging_seconds)
+        return self._user_in_flight.get(ticket.user, 0), aged_cost, ticket.seq
+
+    def dispatch(self):
+        """把空出的名額分給排隊中的請求，回傳這次取得名額的 ticket。"""
+        granted = []
+        now = time.monotonic()
+        while self.in_flight < self.max_in_flight:
+            classes = {ticket.request_class for ticket in self._waiting if self._eligible(ticket.request_class)}
+            if not classes: break
+            request_class = min(classes, key=lambda name: (self._pass[name], -self.class_weights[name]))
+            ticket = min((t for t in self._waiting if t.request_class == request_class), key=lambda t: self._ticket_key(t, now))
+            self._waiting.remove(ticket)
+            self._start(ticket, now)
+            granted.append(ticket)
+        return granted
+
+    def _start(self, ticket, now):
+        ticket.granted = True
+        self.in_flight += 1
+        self._class_in_flight[ticket.request_class] += 1
+        self._user_in_flight[ticket.user] = self._user_in_flight.get(ticket.user, 0) + 1
+        self._virtual_time = self._pass[ticket.request_class]
+        self._pass[ticket.request_class] += ticket.cost / self.class_weights[ticket.request_class]
+        counters = self._class_counters[ticket.request_class]
+        counters["admitted"] += 1
+        counters["wait_seconds_total"] += now - ticket.enqueued
+
+    def finish(self, ticket):
+        self.in_flight -= 1
+        self._class_in_flight[ticket.request_class] -= 1
+        self._user_in_flight[ticket.user] -= 1
+        if not self._user_in_flight[ticket.user]: del self._user_in_flight[ticket.user]
+
+    def class_stats(self):
+        return {request_class: dict(counters, in_flight=self._class_in_flight[request_class], waiting=self.waiting(request_class),
+                                    weight=self.class_weights[request_class], max_in_flight=self.class_max_in_flight.get(request_class))
+                for request_class, counters in self._class_counters.items()}
+
+
+class ModelConcurrencyLimiter:
+    """每個模型最多 max_in_flight 個生成同時進行，最多 max_waiting 個請求排隊等待 (每個使用者最多 max_waiting_per_user 個)。
+    排隊中的請求不是先進先出，而是由 AdmissionQueue 依類別權重、使用者公平與預估工作量決定誰先取得空出的名額。"""
+
+    def __init__(self, max_in_flight, max_waiting, wait_timeout, retry_after, scheduling=None, max_waiting_per_user=None):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.max_waiting_per_user = max_waiting_per_user or max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.scheduling = scheduling or {"class_weights": {"default": 1}}  # AdmissionQueue 的參數
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._counters = {}
+
+    def _queue(self, model):
+        queue = self._queues.get(model)
+        if queue is None: queue = self._queues[model] = AdmissionQueue(self.max_in_flight, **self.scheduling)
+        return queue
+
+    def _model_counters(self, model):
+        return self._counters.setdefault(model, {"admitted": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "wait_seconds_total": 0.0, "max_waiting_seen": 0})
+
+    def _check_waiting_limits(self, model, queue, ticket):
+        counters = self._model_counters(model)
+        if queue.waiting() > self.max_waiting:
+            counters["rejected_queue_full"] += 1
+            raise OllamaOverloadedError(f"模型 {model} 的等待佇列已滿，請稍後再試。", self.retry_after)
+        if ticket.user != "-" and queue.waiting(user=ticket.user) > self.max_waiting_per_user:
+            counters["rejected_queue_full"] += 1
+            raise OllamaOverloadedError(f"同時等待中的請求過多 (模型 {model})，請等前面的回覆完成後再試。", self.retry_after)
+        counters["max_waiting_seen"] = max(counters["max_waiting_seen"], queue.waiting())
+
+    @contextmanager
+    def slot(self, model, request_class=None, user=None, cost=None):
+        with self._cond:
+            queue = self._queue(model)
+            ticket = queue.ticket(request_class, user, cost)
+            queue.push(ticket)
+            if queue.dispatch(): self._cond.notify_all()
+            if not ticket.granted:
+                try:
+                    self._check_waiting_limits(model, queue, ticket)
+                except OllamaOverloadedError:
+                    queue.remove(ticket)
+                    raise
+                wait_started = time.monotonic()
+                admitted = self._cond.wait_for(lambda: ticket.granted, timeout=self.wait_timeout)
+                self._model_counters(model)["wait_seconds_total"] += time.monotonic() - wait_started
+                if not admitted:
+                    queue.remove(ticket)
+                    self._model_counters(model)["rejected_timeout"] += 1
+                    raise OllamaOverloadedError(f"模型 {model} 排隊等待超過 {self.wait_timeout} 秒，請稍後再試。", self.retry_after)
+            self._model_counters(model)["admitted"] += 1
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                queue.finish(ticket)
+                if queue.dispatch(): self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            models = set(self._queues) | set(self._counters)
+            return {
+                model: dict(self._counters.get(model, {}), in_flight=self._queue(model).in_flight, waiting=self._queue(model).waiting(),
+                            max_in_flight=self.max_in_flight, max_waiting=self.max_waiting, classes=self._queue(model).class_stats())
+                for model in models
+            }
+
+
+class OllamaBackend:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.requests_total = 0
+        self.failures_total = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_healthy(self, now):
+        return now >= self.ejected_until
+
+    def snapshot(self, now):
+        return {"url": self.url, "in_flight": self.in_flight, "healthy": self.is_healthy(now),
+                "latency_ewma_seconds": round(self.latency_ewma, 4) if self.latency_ewma is not None else None,
+                "requests_total": self.requests_total, "failures_total": self.failures_total,
+                "consecutive_failures": self.consecutive_failures}
+
+
+class NoHealthyBackendError(Exception):
+    pass
+
+
+class OllamaRouter:
+    """在多個 Ollama 後端之間分配請求。
+
+    有 affinity_key (同一角色 + 同一對話) 時以 rendezvous hash 固定到同一節點，讓該節點上長長的系統 prompt
+    KV cache 可被重用；但若該節點比最空閒的節點多出 affinity_slack 個以上進行中的請求，就改走最空閒的節點。
+    被動健康檢查：連續失敗 max_failures 次的節點會被剔除 eject_seconds 秒，之後自動重新加入。
+    """
+
+    def __init__(self, urls, affinity_slack=2, max_failures=3, eject_seconds=30.0, latency_alpha=0.2):
+        if not urls: raise ValueError("OllamaRouter 至少需要一個後端 URL")
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.affinity_slack = affinity_slack
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.latency_alpha = latency_alpha
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _affinity_score(backend, affinity_key):
+        return hashlib.md5(f"{backend.url}|{affinity_key}".encode("utf-8")).digest()
+
+    @staticmethod
+    def _load_key(backend):
+        return (backend.in_flight, backend.latency_ewma or 0.0)
+
+    def acquire(self, affinity_key=None, exclude=()):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.is_healthy(now) and b not in exclude]
+            if not candidates:
+                # 全部被剔除時仍嘗試最早恢復的節點，而不是直接拒絕服務
+                candidates = sorted((b for b in self.backends if b not in exclude), key=lambda b: b.ejected_until)[:1]
+            if not candidates:
+                raise NoHealthyBackendError("沒有可用的 Ollama 後端")
+            least_loaded = min(candidates, key=self._load_key)
+            chosen = least_loaded
+            if affinity_key is not None:
+                preferred = max(candidates, key=lambda b: self._affinity_score(b, affinity_key))
+                if preferred.in_flight - least_loaded.in_flight <= self.affinity_slack:
+                    chosen = preferred
+            chosen.in_flight += 1
+            chosen.requests_total += 1
+            return chosen
+
+    def release(self, backend, elapsed_seconds, ok):
+        with self._lock:
+            backend.in_flight -= 1
+            if ok:
+                backend.consecutive_failures = 0
+                backend.latency_ewma = elapsed_seconds if backend.latency_ewma is None else \
+                    (1 - self.latency_alpha) * backend.latency_ewma + self.latency_alpha * elapsed_seconds
+            else:
+                backend.failures_total += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.max_failures:
+                    backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [backend.snapshot(now) for backend in self.backends]
+
+
+class OllamaClient:
+    """以單一 requests.Session 重用連線 (keep-alive)；連線池大小固定，滿了就阻塞等待而不是無限開新連線。"""
+
+    def __init__(self, base_urls, pool_maxsize=16, max_in_flight_per_model=4, max_waiting_per_model=16, queue_timeout=30, retry_after=5,
+                 router_options=None, scheduling=None, max_waiting_per_user=None):
+        if isinstance(base_urls, str): base_urls = [base_urls]
+        self.router = OllamaRouter(base_urls, **(router_options or {}))
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=len(base_urls), pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.limiter = ModelConcurrencyLimiter(max_in_flight_per_model, max_waiting_per_model, queue_timeout, retry_after,
+                                               scheduling=scheduling, max_waiting_per_user=max_waiting_per_user)
+
+    @contextmanager
+    def post(self, endpoint_path, payload, timeout, stream=False, affinity_key=None):
+        """挑選後端並送出請求；連線失敗時換下一個後端重試。離開 context 時才把請求從該後端的 in-flight 計數移除。"""
+        tried = []
+        while True:
+            backend = self.router.acquire(affinity_key, exclude=tried)
+            started = time.monotonic()
+            try:
+                response = self.session.post(f"{backend.url}{endpoint_path}", json=payload, timeout=timeout, stream=stream)
+            except requests.exceptions.ConnectionError:
+                self.router.release(backend, time.monotonic() - started, ok=False)
+                tried.append(backend)
+                if len(tried) >= len(self.router.backends): raise
+                continue
+            except Exception:
+                self.router.release(backend, time.monotonic() - started, ok=False)
+                raise
+            break
+        transport_error = None
+        try:
+            with response:
+                response.ollama_backend_url = backend.url
+                yield response
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            transport_error = e
+            raise
+        finally:
+            self.router.release(backend, time.monotonic() - started, ok=transport_error is None and response.status_code < 500)
+
+    def pool_stats(self):
+        pools = []
+        for pool_key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(pool_key)
+            if pool is None or pool.pool is None: continue
+            in_use = pool.pool.maxsize - pool.pool.qsize()  # 佇列中剩下的是可借出的連線槽位
+            pools.append({"host": f"{pool.host}:{pool.port}", "connections_opened": pool.num_connections, "in_use": in_use,
+                          "saturation": round(in_use / pool.pool.maxsize, 3) if pool.pool.maxsize else 0.0})
+        return {"pool_maxsize": self.pool_maxsize, "pools": pools, "backends": self.router.stats(), "models": self.limiter.stats()}
@@ -0,0 +1,115 @@
+"""以 token 數 (而不是訊息則數) 決定 prompt 放得下多少歷史。
+
+prompt 的每個片段 (風格規則、角色設定、摘要、每則訊息、最新一輪) 分開計算 token 數並記憶起來：同一段文字在之後每一輪都會再出現，
+只有新訊息需要真的計算。計數優先用 Ollama 的 /api/tokenize (與模型完全一致)；後端不支援或失敗時改用本地估計，
+本地估計再以 Ollama 回報的 prompt_eval_count 校正。片段之間以 Llama 3 的特殊 token 分隔，片段 token 數的總和即為整個 prompt 的 token 數。
+"""
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+SPECIAL_TOKEN_PATTERN = re.compile(r"<\|[a-z_]+\|>")
+# 近似 Llama 3 (tiktoken 風格) 的預切分：英文單字連同前導空白、最多三位數字、單一 CJK 字或標點、連續空白
+PRETOKEN_PATTERN = re.compile(r" ?[A-Za-z]+| ?\d{1,3}|[㐀-鿿豈-﫿]|\s+|[^\sA-Za-z\d]")
+CJK_PATTERN = re.compile(r"[㐀-鿿豈-﫿]")
+
+
+def estimate_tokens(text):
+    """不需要詞表的 Llama 3 token 數估計：特殊 token 與 CJK 字各算 1，英文單字每 6 個字母算 1，其他符號各算 1。
+    刻意略為高估 (罕用字在 Llama 3 詞表中其實會拆成 2~3 個 byte token)，以預算來說寧可少放一則訊息。"""
+    count = len(SPECIAL_TOKEN_PATTERN.findall(text))
+    for piece in PRETOKEN_PATTERN.findall(SPECIAL_TOKEN_PATTERN.sub("", text)):
+        word = piece.strip()
+        count += math.ceil(len(word) / 6) if word.isascii() and word.isalpha() else 1
+    return count
+
+
+class TokenCounter:
+    """記憶每段文字的 token 數 (LRU)。tokenize(model, text) 回傳精確的 token 數；失敗後 retry_seconds 秒內都改用本地估計。"""
+
+    def __init__(self, tokenize=None, estimator=estimate_tokens, max_entries=8192, retry_seconds=300.0, calibration_alpha=0.2):
+        self.tokenize = tokenize
+        self.estimator = estimator
+        self.max_entries = max_entries
+        self.retry_seconds = retry_seconds
+        self.calibration_alpha = calibration_alpha
+        self._cache = OrderedDict()
+        self._scale = {}  # 每個模型「實際 / 估計」的比例，只套用在估計值上
+        self._remote_failed_at = None
+        self._counters = dict.fromkeys(("hits", "misses", "remote_calls", "remote_failures", "calibrations"), 0)
+        self._lock = threading.Lock()
+
+    @property
+    def remote(self):
+        return self.tokenize is not None
+
+    def _remote_available(self):
+        return self.tokenize is not None and (self._remote_failed_at is None or time.monotonic() - self._remote_failed_at >= self.retry_seconds)
+
+    def exact(self):
+        with self._lock: return self._remote_available()
+
+    def count(self, text, model=None):
+        if not text: return 0
+        key = (model, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key); self._counters["hits"] += 1
+                tokens, exact = cached
+                return tokens if exact else self._scaled(model, tokens)
+            self._counters["misses"] += 1
+            use_remote = self._remote_available()
+            if use_remote: self._counters["remote_calls"] += 1
+        tokens, exact = None, False
+        if use_remote:
+            try:
+                tokens, exact = self.tokenize(model, text), True
+            except Exception:
+                with self._lock: self._remote_failed_at = time.monotonic(); self._counters["remote_failures"] += 1
+        if tokens is None: tokens = self.estimator(text)
+        with self._lock:
+            self._cache[key] = (tokens, exact)
+            if len(self._cache) > self.max_entries: self._cache.popitem(last=False)
+            return tokens if exact else self._scaled(model, tokens)
+
+    def _scaled(self, model, estimated):
+        scale = self._scale.get(model)
+        return estimated if scale is None else max(1, round(estimated * scale))
+
+    def calibrate(self, model, text, actual_tokens):
+        """以 Ollama 完整評估一個 prompt 時回報的 prompt_eval_count 校正本地估計 (只有估計模式才需要)。"""
+        if not actual_tokens or not text or self._remote_available(): return
+        estimated = self.estimator(text)
+        if not estimated: return
+        ratio = min(2.0, max(0.5, actual_tokens / estimated))
+        with self._lock:
+            current = self._scale.get(model)
+            self._scale[model] = ratio if current is None else (1 - self.calibration_alpha) * current + self.calibration_alpha * ratio
+            self._counters["calibrations"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._cache), exact=self._remote_available(), scale={model: round(scale, 3) for model, scale in self._scale.items()})
+
+
+def pack_history(message_tokens, budget, compaction_step=1, min_messages=1):
+    """回傳歷史視窗的起始位置：從最新的訊息往回放，直到下一則放不進 budget 為止。
+    起點無條件進位到 compaction_step 的倍數，只會一次往前跳一段，兩次跳動之間 prompt 前綴不變 (Ollama 才能重用 KV cache)。
+    最後 min_messages 則一定保留 (要回覆的就是最新一則)，即使因此超出預算。"""
+    start, used = len(message_tokens), 0
+    while start > 0 and used + message_tokens[start - 1] <= budget:
+        start -= 1; used += message_tokens[start]
+    if start == 0: return 0
+    return min(len(message_tokens) - min_messages, -(-start // compaction_step) * compaction_step)
+
+
+def token_report(budget, exact, fragments, history_messages, dropped_messages):
+    """回應與指標共用的格式：各片段的 token 數、總數、預算，以及放進與被擠出 (交給摘要) 的歷史訊息數。"""
+    fragments = {name: tokens for name, tokens in fragments.items() if tokens}
+    total = sum(fragments.values())
+    return {"total": total, "budget": budget, "over_budget": total > budget, "exact": exact, "fragments": fragments,
+            "history_messages": history_messages, "dropped_messages": dropped_messages}
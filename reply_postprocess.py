@@ -0,0 +1,117 @@
+"""LINE 風格回覆的後處理，app.py 與 model/ollama_api_chat.py 共用。
+
+每個 profile 的 regex 與 str.translate 表都在載入時建好：去掉前綴 → 一次掃描完成標點刪除 / 替換 →
+統一換行後切行並清掉空行。StreamingPostProcessor 以同一個 profile 逐片段處理串流輸出。
+"""
+import re
+
+
+class PostProcessProfile:
+    def __init__(self, name, prefix_pattern, remove_chars, space_chars="", strip_patterns=(), strip_trigger="{", line_breaks=("\\n", "\r\n", "\r"), keep_raw_if_empty=True):
+        self.name = name
+        self.prefix_pattern = prefix_pattern  # 以 ^ 開頭；只在字串開頭 match 一次，不用 sub 掃過整段
+        self.strip_patterns = tuple(strip_patterns)  # 整段回覆中要刪掉的區塊 (例如模型誤輸出的 JSON)
+        self.strip_trigger = strip_trigger  # 回覆中沒有這個字元時 strip_patterns 不可能命中，直接略過
+        self.translate_table = str.maketrans(dict.fromkeys(space_chars, " ") | dict.fromkeys(remove_chars, None))
+        # 中文回覆逐字 translate 比較慢；先用字元類別 regex 找出連續的標點，只對命中的片段 translate
+        self._punctuation_run = re.compile("[" + re.escape(space_chars + remove_chars) + "]+")
+        self.line_breaks = tuple(line_breaks)  # 依序換成 \n 的換行寫法 (模型常輸出字面上的 '\\n')
+        self.keep_raw_if_empty = keep_raw_if_empty  # 清理後為空時改回傳原始回覆 (去除首尾空白)
+
+    def strip_prefix(self, text):
+        match = self.prefix_pattern.match(text)
+        return text[match.end():] if match else text
+
+    def translate(self, text):
+        return self._punctuation_run.sub(self._translate_match, text)
+
+    def count_punctuation(self, text):
+        """會被 translate 刪除或換成空格的字元數 (候選排序用來衡量風格違反)。"""
+        return sum(len(match) for match in self._punctuation_run.findall(text))
+
+    def _translate_match(self, match):
+        return match.group().translate(self.translate_table)
+
+    def split_lines(self, text):
+        for line_break in self.line_breaks: text = text.replace(line_break, "\n")
+        return text.split("\n")
+
+    def clean(self, raw_reply):
+        if not raw_reply or raw_reply.isspace(): return ""
+        cleaned = self.strip_prefix(raw_reply).strip()
+        if self.strip_patterns and self.strip_trigger in cleaned:
+            for pattern in self.strip_patterns: cleaned = pattern.sub("", cleaned).strip()
+        return "\n".join([line for line in map(str.strip, self.split_lines(self.translate(cleaned))) if line])
+
+    def apply(self, raw_reply):
+        final_output = self.clean(raw_reply)
+        if not final_output and self.keep_raw_if_empty: return raw_reply.strip()
+        return final_output
+
+
+# 允許逗號與句號：app.py 的角色扮演 / 助手回覆
+LINE_STYLE = PostProcessProfile(
+    "line_style",
+    prefix_pattern=re.compile(
+        r'^\s*(?:好的[,，]?這是我(?:的|建議的)回覆：|你可以(?:這麼|這樣)說：|我建議你回覆：|(?:Okay|Ok|Alright|Sure)[,.]?\s*(?:here(?: is|\'s)\s*(?:a|my|the)?\s*(?:suggestion|reply)|I suggest|you could say)[:：]?|話翼|AI|Assistant|模型|回答|建議|助手|WingChat)\s*[:：]?\s*',
+        re.IGNORECASE | re.DOTALL),
+    remove_chars="、；：「」『』（）《》\"'();:",
+    strip_patterns=(re.compile(r'^```json\s*\{[\s\S]*?\}\s*```', re.DOTALL | re.MULTILINE),
+                    re.compile(r'^\{[\s\S]*?\}$', re.DOTALL | re.MULTILINE)),
+)
+
+# 只允許空格、換行、問號與驚嘆號：model/ollama_api_chat.py 的微調模型，逗號改成空格
+STRICT_LINE_STYLE = PostProcessProfile(
+    "strict_line_style",
+    prefix_pattern=re.compile(r'^\s*(?:話翼|AI|Assistant|模型|回答|建議|你|You|assistant)\s*[:：]?\s*', re.IGNORECASE),
+    remove_chars=".。、；：「」『』（）《》\"'();:",
+    space_chars=",，",
+    line_breaks=("\\n",),
+    keep_raw_if_empty=False,
+)
+
+PROFILES = {profile.name: profile for profile in (LINE_STYLE, STRICT_LINE_STYLE)}
+
+
+class StreamingPostProcessor:
+    """PostProcessProfile.apply 的增量版本：餵入串流片段，每完成一行就吐出清理後的短訊息。"""
+
+    def __init__(self, profile=LINE_STYLE):
+        self.profile = profile
+        self.raw_text = ""
+        self._pending = ""
+        self._prefix_done = False
+
+    def feed(self, text_chunk):
+        return [line for _, line in self.feed_lines(text_chunk) if line]
+
+    def feed_lines(self, text_chunk):
+        """回傳這個片段完成的每一行 [(原始行, 清理後的行)]，清理後為空的行也包含在內。"""
+        self.raw_text += text_chunk
+        self._pending += text_chunk
+        # 模型常輸出字面上的 '\\n'；結尾單獨的反斜線或 \r 可能是被切開的換行，先留在緩衝區
+        hold = ""
+        if self._pending.endswith("\\") or self._pending.endswith("\r"):
+            hold = self._pending[-1]; self._pending = self._pending[:-1]
+        *finished, rest = self.profile.split_lines(self._pending)
+        self._pending = rest + hold
+        return [(line, self._clean_line(line)) for line in finished]
+
+    @property
+    def pending(self):
+        """還沒換行的部分 (尚未清理)。"""
+        return self._pending
+
+    def finish(self):
+        return [line for _, line in self.finish_lines() if line]
+
+    def finish_lines(self):
+        tail, self._pending = self._pending, ""
+        return [(line, self._clean_line(line)) for line in self.profile.split_lines(tail)]
+
+    def _clean_line(self, line):
+        if not self._prefix_done:
+            if not line.strip(): return ""  # 與整段處理相同：開頭的空行不算入前綴判斷
+            self._prefix_done = True
+            line = self.profile.strip_prefix(line)
+        return self.profile.translate(line).strip()
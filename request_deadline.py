@@ -0,0 +1,166 @@
+"""端到端的請求期限與放棄偵測。
+
+用戶端以 X-Request-Timeout-Ms 告訴後端它還願意等多久 (前端 axios 的逾時)；期限與「用戶端是否已斷線」的檢查放在
+contextvars，送出 Ollama 請求前、排隊之後與每收到一個生成片段時檢查。已經沒人會讀的生成直接中止 (關閉上游連線，
+Ollama 就會停止生成)；剩餘時間不夠生成完整回覆時，依實測的生成速率縮小 num_predict。
+"""
+import asyncio
+import contextvars
+import select
+import socket
+import threading
+import time
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)  # time.monotonic() 的絕對時間
+_disconnect_check = contextvars.ContextVar("client_disconnect_check", default=None)
+
+
+class RequestAbandonedError(Exception):
+    reason = "abandoned"
+    status = 499  # 用戶端已離開，回應不會被讀取 (nginx 慣用的 499)
+
+
+class DeadlineExceededError(RequestAbandonedError):
+    reason = "deadline"
+    status = 504
+
+
+class ClientDisconnectedError(RequestAbandonedError):
+    reason = "disconnect"
+
+
+def parse_timeout_header(value, margin_seconds=1.0, max_seconds=600.0):
+    """X-Request-Timeout-Ms -> 可用秒數 (扣掉回應傳回用戶端的餘裕)；沒有或格式錯誤時回傳 None。"""
+    try: budget = float(value) / 1000
+    except (TypeError, ValueError): return None
+    if budget <= 0: return None
+    return min(budget, max_seconds) - margin_seconds
+
+
+def start(budget_seconds=None, deadline=None, disconnect_check=None):
+    """設定目前請求的期限 (相對秒數或絕對的 monotonic 時間) 與斷線檢查 (回傳 True 代表用戶端已離開的 callable)。"""
+    if deadline is None and budget_seconds is not None: deadline = time.monotonic() + budget_seconds
+    _deadline.set(deadline)
+    _disconnect_check.set(disconnect_check)
+    return deadline
+
+
+def finish():
+    _deadline.set(None); _disconnect_check.set(None)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+def remaining():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def abandoned():
+    """回傳放棄的原因 ("deadline" / "disconnect")，仍有人在等時回傳 None。"""
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline: return DeadlineExceededError.reason
+    check = _disconnect_check.get()
+    if check is not None and check(): return ClientDisconnectedError.reason
+    return None
+
+
+def raise_if_abandoned(stage):
+    reason = abandoned()
+    if reason == DeadlineExceededError.reason: raise DeadlineExceededError(f"請求在 {stage} 時已超過用戶端的等待期限")
+    if reason == ClientDisconnectedError.reason: raise ClientDisconnectedError(f"用戶端在 {stage} 時已斷線")
+
+
+def read_timeout(default_seconds):
+    """上游的讀取逾時不超過剩餘期限 (至少留 0.1 秒讓請求能送出)。"""
+    budget = remaining()
+    return default_seconds if budget is None else max(0.1, min(default_seconds, budget))
+
+
+def socket_disconnect_check(sock, interval=0.2):
+    """偷看用戶端 socket：可讀但 MSG_PEEK 讀到空 bytes 代表對方已關閉連線。同一請求最多每 interval 秒檢查一次。
+    只適用於請求 body 已讀完、用戶端不會再送資料的情況 (瀏覽器不會在同一連線上 pipeline 請求)。"""
+    state = {"checked": 0.0, "gone": False, "supported": True}
+
+    def check():
+        now = time.monotonic()
+        if state["gone"] or not state["supported"] or now - state["checked"] < interval: return state["gone"]
+        state["checked"] = now
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if readable: state["gone"] = sock.recv(1, socket.MSG_PEEK) == b""
+        except ValueError:
+            state["supported"] = False  # TLS socket 不支援 MSG_PEEK，只能靠期限
+        except OSError:
+            state["gone"] = True
+        return state["gone"]
+    return check
+
+
+class GenerationRateEstimator:
+    """每個模型的生成速率 (tokens/s) 與生成前的固定開銷 (載入 + prompt 評估) 的指數移動平均，用來估計剩餘時間內能生成多少 token。"""
+
+    def __init__(self, alpha=0.2, safety_factor=0.8):
+        self.alpha = alpha
+        self.safety_factor = safety_factor  # 只用估計值的八成，避免剛好卡在期限上
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model, response_data):
+        eval_count, eval_duration = response_data.get("eval_count"), response_data.get("eval_duration")
+        if not eval_count or not eval_duration: return
+        tokens_per_second = eval_count / (eval_duration / 1e9)
+        overhead = max(0.0, (response_data.get("total_duration", 0) - eval_duration) / 1e9)
+        with self._lock:
+            current = self._rates.get(model)
+            if current is None: self._rates[model] = (tokens_per_second, overhead)
+            else: self._rates[model] = tuple((1 - self.alpha) * old + self.alpha * new for old, new in zip(current, (tokens_per_second, overhead)))
+
+    def max_tokens(self, model, budget_seconds):
+        """剩餘 budget_seconds 秒內預估能生成的 token 數；還沒有實測資料時回傳 None (不限制)。"""
+        with self._lock: rate = self._rates.get(model)
+        if rate is None or budget_seconds is None: return None
+        tokens_per_second, overhead = rate
+        return max(0, int((budget_seconds - overhead) * tokens_per_second * self.safety_factor))
+
+    def stats(self):
+        with self._lock:
+            return {model: {"tokens_per_second": round(rate[0], 1), "overhead_seconds": round(rate[1], 3)} for model, rate in self._rates.items()}
+
+
+def guard(chunks):
+    """包住串流片段的 iterator：每個片段之前檢查期限與斷線，放棄時關閉 iterator (上游連線跟著關閉) 並丟出對應的例外。"""
+    try:
+        for chunk in chunks:
+            raise_if_abandoned("generation")
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"): chunks.close()
+
+
+async def async_guard(chunks):
+    try:
+        async for chunk in chunks:
+            raise_if_abandoned("generation")
+            yield chunk
+    finally:
+        if hasattr(chunks, "aclose"): await chunks.aclose()
+
+
+async def until_abandoned(awaitable, poll_interval=0.25):
+    """等待 awaitable，期間每 poll_interval 秒檢查期限與斷線；放棄時取消它並丟出對應的例外。
+    aiohttp 預設不會在用戶端斷線時取消 handler，沒有這層檢查生成會一直跑到結束。"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            budget = remaining()
+            done, _ = await asyncio.wait({task}, timeout=poll_interval if budget is None else max(0.0, min(poll_interval, budget)))
+            if done: return task.result()
+            if abandoned():
+                task.cancel()
+                await asyncio.wait({task})
+                raise_if_abandoned("generation")
+    finally:
+        if not task.done(): task.cancel()
@@ -0,0 +1,158 @@
+"""請求路徑上的低成本 logging。
+
+* log 呼叫端只把 record 放進有上限的佇列 (QueueHandler)，訊息格式化與寫出都在背景的 QueueListener 執行緒完成；
+  佇列滿時直接丟棄並計數，不讓請求卡在 I/O 上。
+* 每個請求一筆結構化 JSON 摘要 (request_id、模型、各段耗時、狀態碼)，依取樣率輸出；錯誤與慢請求一律輸出。
+  不記錄完整 prompt / 回覆，需要時開 DEBUG。
+* request_id 放在 contextvars，執行緒式 (Flask) 與 asyncio (aiohttp) 都能讓同一請求內的所有 log 帶上它。
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+
+_request_id = contextvars.ContextVar("request_id", default="-")
+_request_fields = contextvars.ContextVar("request_fields", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """佇列滿時丟棄 record (而不是阻塞或印出錯誤)，並保留訊息的延遲格式化：只有例外堆疊在呼叫端先轉成文字。"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: self.dropped += 1
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                 "request_id": getattr(record, "request_id", "-"), "msg": record.getMessage()}
+        if getattr(record, "fields", None): entry.update(record.fields)
+        if record.exc_text: entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        if getattr(record, "fields", None): message += " " + json.dumps(record.fields, ensure_ascii=False, default=str)
+        return message
+
+
+_listener = None
+_queue_handler = None
+ACCESS_LOGGERS = ("werkzeug", "aiohttp.access") # 伺服器內建的每請求存取紀錄
+
+
+def configure_logging(level="INFO", log_format="text", queue_size=10000, stream=None):
+    """以佇列 + 背景執行緒取代 basicConfig 的同步 StreamHandler。重複呼叫時會先停掉舊的 listener。"""
+    global _listener, _queue_handler
+    if _listener is not None: _listener.stop()
+    output_handler = logging.StreamHandler(stream or sys.stderr)
+    output_handler.setFormatter(JsonLogFormatter() if log_format == "json" else
+                                TextLogFormatter("%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"))
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    _queue_handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [_queue_handler]
+    root.setLevel(level)
+    # 每個請求一行的存取紀錄由 RequestLogSampler 取樣輸出；werkzeug 沒設定層級時會自行設成 INFO，不受 root 的層級影響
+    for access_logger in ACCESS_LOGGERS: logging.getLogger(access_logger).setLevel(max(root.level, logging.WARNING))
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output_handler, respect_handler_level=True)
+    _listener.start()
+    return _queue_handler
+
+
+def dropped_log_records():
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+class RequestLogSampler:
+    """每個請求結束時呼叫 finish()；依 sample_rate 取樣，但錯誤 (status >= 500) 與超過 slow_ms 的請求一律輸出。"""
+
+    def __init__(self, logger, sample_rate=0.1, slow_ms=5000, on_finish=None):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.on_finish = on_finish  # 每個請求 (不論是否被取樣) 都以完整欄位呼叫，例如更新指標
+
+    def start(self, request_id=None):
+        """開始一個請求的紀錄並回傳 request_id (沿用呼叫端的 X-Request-ID)。
+        Flask 每個請求在自己的執行緒、aiohttp 每個請求在自己的 task，所以直接 set 不會影響其他請求。"""
+        request_id = request_id or uuid.uuid4().hex[:16]
+        _request_id.set(request_id)
+        _request_fields.set({"started": time.perf_counter(), "timings_ms": {}})
+        return request_id
+
+    def finish(self, **fields):
+        state = _request_fields.get()
+        if state is None: return
+        duration_ms = round((time.perf_counter() - state["started"]) * 1000, 1)
+        status = fields.get("status", state.get("status", 200))
+        try:
+            record_fields = {k: v for k, v in state.items() if k != "started"}
+            record_fields.update(fields, duration_ms=duration_ms)
+            if self.on_finish is not None: self.on_finish(record_fields)
+            if status >= 500 or duration_ms >= self.slow_ms or random.random() < self.sample_rate:
+                self.logger.info("request", extra={"fields": record_fields})
+        finally:
+            _request_id.set("-"); _request_fields.set(None)
+
+    def wrap_stream(self, iterable):
+        """串流回應的 body 在 handler 返回之後才被逐段讀取；在原請求的 context 中執行它，並在串流結束時才輸出摘要。"""
+        context = contextvars.copy_context()
+        iterator = iter(iterable)
+        try:
+            while True:
+                try: chunk = context.run(next, iterator)
+                except StopIteration: break
+                yield chunk
+        finally:
+            if hasattr(iterable, "close"): context.run(iterable.close)
+            context.run(self.finish)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def request_field(name, default=None):
+    state = _request_fields.get()
+    return state.get(name, default) if state is not None else default
+
+
+def current_timings():
+    state = _request_fields.get()
+    return dict(state["timings_ms"]) if state is not None else {}
+
+
+def note_request(**fields):
+    """把欄位 (例如 model、mode、cached) 附加到目前請求的摘要紀錄上；不在請求內時不做事。"""
+    state = _request_fields.get()
+    if state is not None: state.update(fields)
+
+
+def note_timing(stage, milliseconds):
+    state = _request_fields.get()
+    if state is not None: state["timings_ms"][stage] = round(state["timings_ms"].get(stage, 0.0) + milliseconds, 1)
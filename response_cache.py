@@ -0,0 +1,90 @@
+"""Ollama 回應快取：以 (模型, options, 完整 prompt) 的正規化雜湊為 key，記憶體 LRU + TTL、以位元組計的容量上限，
+可選擇加上 SQLite 持久層 (重啟後仍可命中)。"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+_WHITESPACE_RUN = re.compile(r"[ \t　]+")
+
+
+def make_cache_key(model, options, prompt):
+    normalized_prompt = _WHITESPACE_RUN.sub(" ", unicodedata.normalize("NFKC", prompt)).strip()
+    material = json.dumps([model, options or {}, normalized_prompt], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl_seconds=3600, sqlite_path=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path
+        self._entries = OrderedDict()  # key -> (expires_at, encoded_value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {"hits": 0, "persistent_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if sqlite_path:
+            with self._connection() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _store_in_memory(self, key, expires_at, encoded):
+        if len(encoded) > self.max_bytes: return
+        previous = self._entries.pop(key, None)
+        if previous is not None: self._bytes -= len(previous[1])
+        self._entries[key] = (expires_at, encoded)
+        self._bytes += len(encoded)
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self._counters["evictions"] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return json.loads(entry[1])
+                del self._entries[key]; self._bytes -= len(entry[1])
+        if self.sqlite_path:
+            row = self._connection().execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] > now:
+                with self._lock:
+                    self._store_in_memory(key, row[1], row[0])
+                    self._counters["persistent_hits"] += 1
+                return json.loads(row[0])
+        with self._lock: self._counters["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        encoded = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store_in_memory(key, expires_at, encoded)
+            self._counters["stores"] += 1
+        if self.sqlite_path:
+            with self._connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)", (key, encoded, expires_at))
+                conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["persistent_hits"] + self._counters["misses"]
+            hit_ratio = (self._counters["hits"] + self._counters["persistent_hits"]) / lookups if lookups else 0.0
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                        hit_ratio=round(hit_ratio, 3), persistent=bool(self.sqlite_path))
@@ -0,0 +1,230 @@
+"""正式環境的啟動器：pre-fork 多行程，取代 app.run(debug=True)。
+
+主行程只負責綁定埠號、fork worker 並看顧它們，本身不載入 app；每個 worker 在 fork 之後才 import app (或 async_app)，
+各自擁有連線池、limiter 與背景執行緒，SIGHUP 重新啟動時也就會載入新的程式碼。所有 worker 共用同一個監聽 socket，
+由核心分配連線；執行緒模式下 worker 的執行緒都在忙時不 accept，連線留在 backlog 給其他 worker。
+
+訊號:
+    SIGTERM / SIGINT  停止接受新連線，等進行中的請求 (含串流) 完成，最多 SERVE_GRACEFUL_TIMEOUT 秒後強制結束
+    SIGHUP            先啟動一組新的 worker，再讓舊的 worker 依上述方式排空後結束 (不中斷服務的重新載入)
+    worker 異常結束時自動補上。
+
+設定 (環境變數):
+    HOST / PORT                 預設 0.0.0.0:5001
+    WEB_CONCURRENCY             worker 數，預設為 CPU 核心數
+    SERVE_STATE_PATH            多個 worker 時共用狀態的 SQLite 檔，預設 wingchat_state.db：session、回饋工作、滾動摘要、逐輪評估
+                                與回應快取的持久層若未另外設定 (SESSION_STORE_BACKEND、FEEDBACK_JOB_SQLITE_PATH 等)，都改存在這裡，
+                                輪詢與同一段對話的下一輪落在哪個 worker 都能取得同一份狀態
+    SERVE_APP                   threaded (app.py，Flask) 或 async (async_app.py，aiohttp)，預設 threaded
+    SERVE_THREADS               threaded 模式每個 worker 同時處理的請求數 (串流回應會佔住一個執行緒直到結束)，預設 64
+    SERVE_BACKLOG               監聽 socket 的 backlog，預設 1024
+    SERVE_GRACEFUL_TIMEOUT      排空的秒數上限，預設 30
+    其餘 (OLLAMA_*、LOG_LEVEL 等) 見 app.AppConfig；限制 (例如 OLLAMA_MAX_IN_FLIGHT_PER_MODEL) 都是每個 worker 各自計算。
+
+用法: WEB_CONCURRENCY=4 SERVE_THREADS=64 python serve.py
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("wingchat.serve")
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 5001))
+WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+STATE_PATH = os.environ.get("SERVE_STATE_PATH", "wingchat_state.db")
+SERVE_APP = os.environ.get("SERVE_APP", "threaded")
+THREADS = max(1, int(os.environ.get("SERVE_THREADS", 64)))
+BACKLOG = int(os.environ.get("SERVE_BACKLOG", 1024))
+GRACEFUL_TIMEOUT = float(os.environ.get("SERVE_GRACEFUL_TIMEOUT", 30))
+RESPAWN_BACKOFF_SECONDS = 1.0 # worker 一啟動就結束 (例如 import 失敗) 時，補上之前先等一下，避免瘋狂 fork
+
+
+def make_threaded_server(listener, wsgi_app, threads):
+    """以固定大小的執行緒池服務請求的 werkzeug server。執行緒都在忙時不 accept，連線留給其他 worker。"""
+    from werkzeug.serving import BaseWSGIServer
+
+    class PooledWSGIServer(BaseWSGIServer):
+        multithread = True
+
+        def __init__(self):
+            super().__init__(HOST, PORT, wsgi_app, fd=listener.fileno())
+            # 共用的 socket 可能被其他 worker 先 accept：非阻塞 accept 失敗時直接回到 select 迴圈
+            self.socket.setblocking(False)
+            self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+            self.slots = threading.BoundedSemaphore(threads)
+            self.active = 0
+            self.idle = threading.Condition()
+
+        def get_request(self):
+            # 拿不到空的執行緒時以 OSError 結束這一輪 (socketserver 會忽略)，serve_forever 才能照常檢查 shutdown
+            if not self.slots.acquire(timeout=0.5): raise OSError("all worker threads are busy")
+            try:
+                return super().get_request()
+            except BaseException:
+                self.slots.release()
+                raise
+
+        def process_request(self, request, client_address):
+            with self.idle: self.active += 1
+            self.pool.submit(self._process, request, client_address)
+
+        def _process(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.slots.release()
+                with self.idle:
+                    self.active -= 1
+                    self.idle.notify_all()
+
+        def drain(self, timeout):
+            """等進行中的請求完成，回傳是否在 timeout 內排空。"""
+            with self.idle: return self.idle.wait_for(lambda: self.active == 0, timeout)
+
+    return PooledWSGIServer()
+
+
+def run_threaded_worker(listener):
+    import app as wingchat
+    server = make_threaded_server(listener, wingchat.app, THREADS)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    if wingchat.cfg.MODEL_WARMUP_ENABLED: wingchat.model_warmer.start()
+    threading.Thread(target=server.serve_forever, name="accept", daemon=True).start()
+    logger.info("Worker %d serving %s:%d with %d threads", os.getpid(), HOST, PORT, THREADS)
+    while not stopping.wait(1.0): pass
+    server.shutdown()  # 停止 accept；已接受的連線繼續處理
+    if not server.drain(GRACEFUL_TIMEOUT): logger.warning("Worker %d drain timed out with %d requests in flight", os.getpid(), server.active)
+
+
+def run_async_worker(listener):
+    from aiohttp import web
+    import async_app
+    logger.info("Worker %d serving %s:%d (asyncio)", os.getpid(), HOST, PORT)
+    # run_app 收到 SIGTERM / SIGINT 時停止接受連線，最多等 shutdown_timeout 秒讓進行中的 handler 完成
+    web.run_app(async_app.create_app(), sock=listener, shutdown_timeout=GRACEFUL_TIMEOUT, print=None, handle_signals=True)
+
+
+WORKER_RUNNERS = {"threaded": run_threaded_worker, "async": run_async_worker}
+
+
+def watch_master(master_pid):
+    """主行程意外結束 (例如被 SIGKILL) 時，worker 自己排空後結束，不留下沒人管的行程佔著埠號。"""
+    while os.getppid() == master_pid: time.sleep(1.0)
+    logger.warning("Master %d is gone, worker %d shutting down", master_pid, os.getpid())
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class Arbiter:
+    """主行程：維持 WORKERS 個 worker，處理停止與重新載入的訊號。"""
+
+    def __init__(self, listener, runner, workers):
+        self.listener = listener
+        self.runner = runner
+        self.workers = workers
+        self.children = {}  # pid -> 啟動時間
+        self.retiring = set()  # 重新載入後正在排空的舊 worker
+        self.signals = []
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+        # worker：恢復預設的訊號處理，由 runner 自己安裝
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD): signal.signal(signum, signal.SIG_DFL)
+        threading.Thread(target=watch_master, args=(os.getppid(),), name="watch-master", daemon=True).start()
+        exit_code = 0
+        try:
+            self.runner(self.listener)
+        except Exception:
+            logger.exception("Worker %d crashed", os.getpid())
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP): signal.signal(signum, lambda signum, _frame: self.signals.append(signum))
+        signal.signal(signal.SIGCHLD, lambda *_: None)  # 只為了讓 sleep 提早醒來
+        for _ in range(self.workers): self.spawn()
+        logger.info("Listening on %s:%d with %d %s workers (master pid %d)", HOST, PORT, self.workers, SERVE_APP, os.getpid())
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP: self.reload()
+                else: return self.stop()
+            self.reap(respawn=True)
+            time.sleep(0.5)
+
+    def reap(self, respawn):
+        while self.children or self.retiring:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear(); self.retiring.clear(); return
+            if pid == 0: return
+            self.retiring.discard(pid)
+            started = self.children.pop(pid, None)
+            if started is None or not respawn: continue
+            logger.warning("Worker %d exited (status %d), starting a replacement", pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < RESPAWN_BACKOFF_SECONDS: time.sleep(RESPAWN_BACKOFF_SECONDS)
+            self.spawn()
+
+    def reload(self):
+        old = list(self.children)
+        logger.info("Reloading: starting %d new workers, then draining %d old ones", self.workers, len(old))
+        for _ in range(self.workers): self.spawn()
+        for pid in old:
+            self.children.pop(pid, None)  # 舊 worker 結束時不補上
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def stop(self):
+        logger.info("Shutting down: draining %d workers (up to %.0fs)", len(self.children), GRACEFUL_TIMEOUT)
+        for pid in list(self.children): self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        while (self.children or self.retiring) and time.monotonic() < deadline:
+            self.reap(respawn=False)
+            time.sleep(0.1)
+        for pid in list(self.children) + list(self.retiring): self._kill(pid, signal.SIGKILL)
+        self.reap(respawn=False)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try: os.kill(pid, signum)
+        except ProcessLookupError: pass
+
+
+def share_worker_state(path):
+    """worker 在 fork 之後才 import app，這裡設定的環境變數就是它們的預設值：每個 worker 記憶體中的狀態改存在同一個 SQLite 檔。
+    已明確設定的值不覆蓋；仍選擇記憶體 session 的話，同一段對話的下一輪落在別的 worker 就找不到 session，因此警告。"""
+    os.environ.setdefault("SESSION_STORE_BACKEND", "sqlite")
+    os.environ.setdefault("SESSION_SQLITE_PATH", path)
+    for name in ("FEEDBACK_JOB_SQLITE_PATH", "CONVERSATION_STATE_SQLITE_PATH", "RESPONSE_CACHE_SQLITE_PATH"): os.environ.setdefault(name, path)
+    if os.environ["SESSION_STORE_BACKEND"] != "sqlite":
+        logger.warning("%d workers with SESSION_STORE_BACKEND=%s: a session only exists in the worker that created it", WORKERS, os.environ["SESSION_STORE_BACKEND"])
+    logger.info("%d workers share sessions, feedback jobs, conversation summaries, turn assessments and cached responses via %s", WORKERS, path)
+
+
+def main():
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(asctime)s - %(name)s - %(levelname)s - [pid %(process)d] %(message)s")
+    if SERVE_APP not in WORKER_RUNNERS: raise SystemExit(f"SERVE_APP must be one of {', '.join(WORKER_RUNNERS)}")
+    if WORKERS > 1: share_worker_state(STATE_PATH)
+    listener = socket.create_server((HOST, PORT), backlog=BACKLOG)
+    Arbiter(listener, WORKER_RUNNERS[SERVE_APP], WORKERS).run()
+    listener.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
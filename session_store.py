@@ -0,0 +1,117 @@
+"""伺服器端對話 session：保存滾動歷史視窗、預先組好的系統 prompt 與 Ollama 回傳的 context，
+讓前端每輪只需送出新訊息。提供記憶體 (LRU + TTL) 與 SQLite 兩種儲存後端。"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class SessionNotFoundError(Exception):
+    pass
+
+
+def new_session(session_id=None, mode="character_play", goal="", character=None, messages=None):
+    return {
+        "session_id": session_id or uuid.uuid4().hex,
+        "mode": mode,
+        "goal": goal,
+        "character": character or {},
+        "messages": list(messages or []),
+        "message_offset": 0, # 已從前端裁掉的訊息數，messages[0] 在整段對話中的位置
+        "system_prompt": None,
+        "system_prompt_key": None,
+        "ollama_context": None,
+        "updated_at": time.time(),
+    }
+
+
+def trim_session_messages(session, max_messages, compaction_step):
+    """只保留最後 max_messages 則左右的訊息。一次丟掉 compaction_step 的整數倍，
+    讓 prompt_budget.pack_history 在裁切前後選到相同的歷史視窗 (prompt 前綴不變)；被丟掉的部分由滾動摘要涵蓋。"""
+    overflow = len(session["messages"]) - max_messages
+    if overflow > 0:
+        drop = -(-overflow // compaction_step) * compaction_step
+        session["messages"] = session["messages"][drop:]
+        session["message_offset"] = session.get("message_offset", 0) + drop
+
+
+class InMemorySessionStore:
+    def __init__(self, max_sessions=1000, ttl_seconds=3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None: return None
+            if time.time() - session["updated_at"] > self.ttl_seconds:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session):
+        session["updated_at"] = time.time()
+        with self._lock:
+            self._sessions[session["session_id"]] = session
+            self._sessions.move_to_end(session["session_id"])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "sessions": len(self._sessions), "max_sessions": self.max_sessions, "ttl_seconds": self.ttl_seconds}
+
+
+class SQLiteSessionStore:
+    """跨行程 / 重啟後仍保留的 session；過期資料在寫入時順便清除。"""
+
+    def __init__(self, path, ttl_seconds=3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id):
+        row = self._connection().execute("SELECT data, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds: return None
+        return json.loads(row[0])
+
+    def put(self, session):
+        session["updated_at"] = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)",
+                         (session["session_id"], json.dumps(session, ensure_ascii=False), session["updated_at"]))
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+
+    def delete(self, session_id):
+        with self._connection() as conn:
+            return conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def stats(self):
+        count = self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "sessions": count, "ttl_seconds": self.ttl_seconds}
+
+
+def create_session_store(backend, sqlite_path=None, max_sessions=1000, ttl_seconds=3600):
+    if backend == "sqlite":
+        return SQLiteSessionStore(sqlite_path, ttl_seconds=ttl_seconds)
+    return InMemorySessionStore(max_sessions=max_sessions, ttl_seconds=ttl_seconds)
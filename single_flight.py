@@ -0,0 +1,234 @@
+"""相同 Ollama 請求的合併 (single-flight)。
+
+重複點擊或前端逾時重送時，完全相同的 payload 會同時送進來；同一時間只讓第一個請求真的呼叫 Ollama，
+其他請求等待同一次生成並拿到相同結果。串流請求共用同一個上游串流：每個訂閱者從頭重播已收到的片段再接著等新的，
+所有訂閱者都斷線時關閉上游連線，讓 Ollama 停止生成。
+
+SingleFlight 給執行緒式 (Flask) 使用，AsyncSingleFlight 給 asyncio (aiohttp) 使用，兩者的 stats() 欄位相同。
+"""
+import asyncio
+import hashlib
+import json
+import threading
+
+
+def coalescing_key(endpoint_path, payload):
+    """以完整 payload (已組好的 prompt、options、context…) 為 key；只有完全相同的請求才會合併。"""
+    material = json.dumps([endpoint_path, payload], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class CoalescingCounters:
+    """可由多個 SingleFlight / AsyncSingleFlight 共用 (例如 async_app 與 app.py 的背景工作)，讓指標只有一份。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(("calls", "coalesced_calls", "cancelled_calls", "streams", "coalesced_streams", "cancelled_streams"), 0)
+
+    def inc(self, name):
+        with self._lock: self._values[name] += 1
+
+    def snapshot(self, in_flight_calls, in_flight_streams):
+        with self._lock: return dict(self._values, in_flight_calls=in_flight_calls, in_flight_streams=in_flight_streams)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SharedStream:
+    """一個上游串流與它的訂閱者。同一時間只有一個訂閱者向上游取下一個片段，其他訂閱者在 condition 上等。"""
+
+    def __init__(self, source):
+        self.source = source
+        self.items = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self._pulling = False
+        self._cond = threading.Condition()
+
+    def iterate(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.items) and not self.finished and self._pulling: self._cond.wait()
+                if index < len(self.items):
+                    item = self.items[index]; index += 1
+                elif self.error is not None:
+                    raise self.error
+                elif self.finished:
+                    return
+                else:
+                    item = None; self._pulling = True
+            if item is not None:
+                yield item
+                continue
+            try:
+                item = next(self.source)
+            except StopIteration:
+                self._finish(None)
+            except Exception as e:
+                self._finish(e)
+            else:
+                with self._cond:
+                    self.items.append(item); self._pulling = False; self._cond.notify_all()
+
+    def _finish(self, error):
+        with self._cond:
+            self.finished, self.error, self._pulling = True, error, False
+            self._cond.notify_all()
+
+
+class SingleFlight:
+    def __init__(self, counters=None):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self.counters = counters or CoalescingCounters()
+
+    def do(self, key, fn):
+        """回傳 (fn 的結果, 是否與其他請求共用)。fn 丟出的例外會傳給所有等待者。"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(); self.counters.inc("calls")
+            else:
+                self.counters.inc("coalesced_calls")
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock: self._calls.pop(key, None)
+            call.done.set()
+
+    def stream(self, key, start_fn):
+        """回傳 (片段的 iterator, 是否與其他請求共用)。start_fn() 回傳上游的 generator，只有第一個請求會呼叫。
+        iterator 被關閉 (用戶端斷線) 時退訂；最後一個訂閱者離開而上游還沒結束時關閉上游。"""
+        with self._lock:
+            flight = self._streams.get(key)
+            shared = flight is not None
+            if shared:
+                self.counters.inc("coalesced_streams")
+            else:
+                flight = self._streams[key] = _SharedStream(start_fn()); self.counters.inc("streams")
+            flight.subscribers += 1
+        return self._subscribe(key, flight), shared
+
+    def _subscribe(self, key, flight):
+        try:
+            yield from flight.iterate()
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                cancel = flight.subscribers == 0 and not flight.finished
+                # 上游結束後新進的相同請求重新生成，而不是重播舊的結果
+                if (cancel or flight.finished) and self._streams.get(key) is flight: del self._streams[key]
+                if cancel: self.counters.inc("cancelled_streams")
+            # 上游 generator 的 finally 會關掉 HTTP 連線，Ollama 偵測到斷線就停止生成
+            if cancel: flight.source.close()
+
+    def stats(self):
+        with self._lock: return self.counters.snapshot(len(self._calls), len(self._streams))
+
+
+class _AsyncSharedStream:
+    """_SharedStream 的 asyncio 版本。向上游取片段的工作放在獨立 task 並以 shield 等待，
+    取的那個訂閱者被取消時不會連帶中斷上游，其他訂閱者可以接著等同一個 task。"""
+
+    def __init__(self, source):
+        self.source = source
+        self.items = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self.pending = None
+
+    async def _fetch(self):
+        try:
+            self.items.append(await self.source.__anext__())
+        except StopAsyncIteration:
+            self.finished = True
+        except Exception as e:
+            self.finished, self.error = True, e
+        finally:
+            self.pending = None
+
+    async def iterate(self):
+        index = 0
+        while True:
+            if index < len(self.items):
+                yield self.items[index]; index += 1
+            elif self.error is not None:
+                raise self.error
+            elif self.finished:
+                return
+            else:
+                if self.pending is None: self.pending = asyncio.get_running_loop().create_task(self._fetch())
+                await asyncio.shield(self.pending)
+
+
+class AsyncSingleFlight:
+    def __init__(self, counters=None):
+        self._calls = {}
+        self._streams = {}
+        self.counters = counters or CoalescingCounters()
+
+    async def do(self, key, coro_fn):
+        """回傳 (結果, 是否共用)。等待者被取消 (用戶端斷線) 時退出；所有等待者都離開時取消上游 task。"""
+        entry = self._calls.get(key)
+        shared = entry is not None
+        if shared:
+            self.counters.inc("coalesced_calls")
+        else:
+            task = asyncio.get_running_loop().create_task(coro_fn())
+            entry = self._calls[key] = {"task": task, "waiters": 0}
+            self.counters.inc("calls")
+            task.add_done_callback(lambda _task: self._calls.pop(key, None) if self._calls.get(key) is entry else None)
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"]), shared
+        except asyncio.CancelledError:
+            if entry["waiters"] == 1 and not entry["task"].done():
+                entry["task"].cancel(); self.counters.inc("cancelled_calls")
+            raise
+        finally:
+            entry["waiters"] -= 1
+
+    def stream(self, key, start_fn):
+        flight = self._streams.get(key)
+        shared = flight is not None
+        if shared:
+            self.counters.inc("coalesced_streams")
+        else:
+            flight = self._streams[key] = _AsyncSharedStream(start_fn()); self.counters.inc("streams")
+        flight.subscribers += 1
+        return self._subscribe(key, flight), shared
+
+    async def _subscribe(self, key, flight):
+        try:
+            async for item in flight.iterate(): yield item
+        finally:
+            flight.subscribers -= 1
+            cancel = flight.subscribers == 0 and not flight.finished
+            if (cancel or flight.finished) and self._streams.get(key) is flight: del self._streams[key]
+            if cancel:
+                self.counters.inc("cancelled_streams")
+                flight.finished = True
+                # 取消進行中的讀取會在上游 generator 內丟出 CancelledError，離開 async with 時關閉連線
+                if flight.pending is not None: flight.pending.cancel()
+                else: asyncio.get_running_loop().create_task(flight.source.aclose())
+
+    def stats(self):
+        return self.counters.snapshot(len(self._calls), len(self._streams))
@@ -1,7 +1,7 @@
 // src/components/Chat/ChatAssistant.js
 import React, { useState, useEffect, useCallback } from 'react';
 import { Form, InputGroup, Container, Row, Col, Spinner, Alert, Button, Card, Image } from 'react-bootstrap';
-import { sendMessageToOllama } from '../../services/ollamaService';
+import { getReplyCandidates } from '../../services/ollamaService';
 import DOMPurify from 'dompurify';
 import { marked } from 'marked';
 
@@ -17,6 +17,7 @@ function ChatAssistant({ interactingWithCharacter }) {
   const [goal, setGoal] = useState('');
   const [partnerMessage, setPartnerMessage] = useState('');
   const [suggestedReply, setSuggestedReply] = useState('');
+  const [alternativeReplies, setAlternativeReplies] = useState([]);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState(null);
   const [conversationHistory, setConversationHistory] = useState([]);
@@ -96,7 +97,7 @@ function ChatAssistant({ interactingWithCharacter }) {
   const handleGetSuggestion = async () => {
     if (!partnerMessage.trim() || !goal.trim()) { setError("請先設定目標並輸入對方說的話。"); return; }
     if (isLoading) return;
-    setIsLoading(true); setError(null); setSuggestedReply('');
+    setIsLoading(true); setError(null); setSuggestedReply(''); setAlternativeReplies([]);
 
     const messagesForOllama = [
         ...conversationHistory.map(turn => [
@@ -107,19 +108,29 @@ function ChatAssistant({ interactingWithCharacter }) {
     ];
 
     try {
-      const responseText = await sendMessageToOllama(goal, messagesForOllama, interactingWithCharacter, "assistant");
+      const [best, ...alternatives] = await getReplyCandidates(goal, messagesForOllama, interactingWithCharacter, 3);
+      const responseText = best.content;
       setSuggestedReply(responseText);
+      setAlternativeReplies(alternatives.map(candidate => candidate.content));
       setConversationHistory(prev => [...prev, { partner: partnerMessage, suggestion: responseText, timestamp: Date.now() }]);
       setPartnerMessage(''); 
     } catch (err) {
       console.error("Error in handleGetSuggestion (ChatAssistant):", err);
       setError(err.message || "獲取建議時發生錯誤。");
-      setSuggestedReply('');
+      setSuggestedReply(''); setAlternativeReplies([]);
     } finally {
       setIsLoading(false);
     }
   };
   
+  // Swap in one of the other ranked candidates; the history keeps whichever suggestion was chosen last.
+  const handleUseAlternative = (index) => {
+    const chosen = alternativeReplies[index];
+    setAlternativeReplies(prev => prev.map((reply, i) => (i === index ? suggestedReply : reply)));
+    setSuggestedReply(chosen);
+    setConversationHistory(prev => prev.length === 0 ? prev : [...prev.slice(0, -1), { ...prev[prev.length - 1], suggestion: chosen }]);
+  };
+
   const handlePartnerMessageKeyDown = (e) => {
     if (e.key === 'Enter' && !e.shiftKey && !isLoading && partnerMessage.trim() && goal.trim()) {
       e.preventDefault();
@@ -229,6 +240,19 @@ function ChatAssistant({ interactingWithCharacter }) {
       </Card>
 
       {suggestedReply && ( <Card className="mb-3 shadow-sm"> <Card.Header as="h5" className="bg-success text-white">AI 建議回覆：</Card.Header> <Card.Body> <div className="p-2 rounded assistant-suggestion" style={{ whiteSpace: 'pre-wrap', background: '#f0fff0', minHeight: '50px' }} dangerouslySetInnerHTML={{ __html: renderMarkdown(suggestedReply) }} /> <Button variant="outline-secondary" size="sm" className="mt-2" onClick={() => { const textToCopy = suggestedReply.replace(/<br\s*\/?>/gi, '\n').replace(/</g, '<').replace(/>/g, '>'); navigator.clipboard.writeText(textToCopy); alert("建議已複製！"); }} title="複製建議文字" > <i className="bi bi-clipboard me-1"></i> 複製文字 </Button> </Card.Body> </Card> )}
+      {suggestedReply && alternativeReplies.length > 0 && (
+        <Card className="mb-3 shadow-sm">
+          <Card.Header as="h6">其他建議</Card.Header>
+          <Card.Body className="p-2">
+            {alternativeReplies.map((reply, index) => (
+              <div key={`alternative-${index}`} className="d-flex align-items-start justify-content-between border-bottom py-2">
+                <div className="small" style={{ whiteSpace: 'pre-wrap' }} dangerouslySetInnerHTML={{ __html: renderMarkdown(reply) }} />
+                <Button variant="outline-success" size="sm" className="ms-2 flex-shrink-0" onClick={() => handleUseAlternative(index)}> 改用這個 </Button>
+              </div>
+            ))}
+          </Card.Body>
+        </Card>
+      )}
       
       {conversationHistory.length > 0 && goal.trim() && (
         <div className="mt-4"> 
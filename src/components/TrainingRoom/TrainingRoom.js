@@ -3,12 +3,19 @@ import React, { useState, useEffect, useCallback } from 'react';
 import { Container, Row, Col, Alert, Button, Image } from 'react-bootstrap';
 import ChatDisplay from './ChatDisplay';
 import MessageInput from './MessageInput';
-import { sendMessageToOllama, getFeedbackFromBackend } from '../../services/ollamaService';
+import { streamMessageFromBackend, getFeedbackFromBackend } from '../../services/ollamaService';
 import { USER_SOCIAL_SKILL_CHART_CONFIG } from '../FeedbackWall/FeedbackWall';
 import '../../styles/TrainingRoom.css';
 
 const TRAINING_ROOM_HISTORY_BASE_PREFIX = 'wingchat_training_history_v3.1_';
 const FEEDBACK_STORAGE_KEY = 'wingchat_feedback';
+const PRACTICE_GOAL = "進行自然的對話練習";
+// Chat and feedback send the same conversation_id: the backend keys its per-turn assessments
+// and conversation summary by it, so the final feedback only merges this conversation's turns.
+const CONVERSATION_ID_SUFFIX = '_conversation_id';
+const newConversationId = () => (window.crypto && window.crypto.randomUUID
+  ? window.crypto.randomUUID()
+  : `${Date.now()}-${Math.random().toString(36).slice(2)}`);
 
 // 【移除】 wrapText 輔助函數，使用者訊息將不再自動換行
 
@@ -19,6 +26,7 @@ function TrainingRoom({ selectedCharacter }) {
   const [isGettingFeedback, setIsGettingFeedback] = useState(false);
   const [error, setError] = useState(null);
   const [isInitialLoadDone, setIsInitialLoadDone] = useState(false);
+  const [conversationId, setConversationId] = useState(newConversationId);
 
   const getMessageHistoryStorageKey = useCallback(() => {
     if (!selectedCharacter || !selectedCharacter.id) return null;
@@ -36,6 +44,7 @@ function TrainingRoom({ selectedCharacter }) {
     setIsInitialLoadDone(false);
     const messageKey = getMessageHistoryStorageKey();
     if (messageKey) {
+      setConversationId(localStorage.getItem(messageKey + CONVERSATION_ID_SUFFIX) || newConversationId());
       const savedMessages = localStorage.getItem(messageKey);
       if (savedMessages) {
         try {
@@ -64,15 +73,18 @@ function TrainingRoom({ selectedCharacter }) {
     if (messageKey) {
       if (messages.length > 0) {
         localStorage.setItem(messageKey, JSON.stringify(messages));
+        localStorage.setItem(messageKey + CONVERSATION_ID_SUFFIX, conversationId);
       } else {
         localStorage.removeItem(messageKey);
+        localStorage.removeItem(messageKey + CONVERSATION_ID_SUFFIX);
       }
     }
-  }, [messages, selectedCharacter, getMessageHistoryStorageKey, isInitialLoadDone]);
+  }, [messages, conversationId, selectedCharacter, getMessageHistoryStorageKey, isInitialLoadDone]);
 
   const handleClearChat = () => {
     if (selectedCharacter && window.confirm(`確定要清除與 ${selectedCharacter.name} 的所有聊天記錄嗎？`)) {
         setMessages([]);
+        setConversationId(newConversationId());
     } else if (!selectedCharacter) {
         alert("錯誤：未選擇角色。");
     }
@@ -96,19 +108,21 @@ function TrainingRoom({ selectedCharacter }) {
         .filter(msg => msg.sender === 'user' || msg.sender === 'ai')
         .map(msg => ({ role: msg.sender === 'user' ? 'user' : 'assistant', content: msg.text }));
       
-      const placeholderGoal = "進行自然的對話練習"; 
-      const aiResponseText = await sendMessageToOllama(placeholderGoal, historyForOllama, selectedCharacter, "character_play");
+      // Each short message is shown as soon as the backend finishes generating it.
+      const replyStartedAt = Date.now();
+      let streamedLines = 0;
+      const appendAiLine = (line, index) => {
+        if (!line || !line.trim()) return;
+        streamedLines += 1;
+        setMessages(prev => [...prev, { id: `ai-${replyStartedAt}-${index}`, sender: 'ai', text: line.trim() }]);
+      };
+      const aiResponseText = await streamMessageFromBackend(PRACTICE_GOAL, historyForOllama, selectedCharacter, "character_play", appendAiLine, conversationId);
 
-      if (aiResponseText && typeof aiResponseText === 'string') {
-        const individualLines = aiResponseText.split('\n').map(l => l.trim()).filter(l => l.length > 0);
-        const newAiMessages = individualLines.map((line, index) => ({
-            id: `ai-${Date.now()}-${index}`, sender: 'ai', text: line,
-        }));
-        setMessages(prev => [...prev, ...newAiMessages]);
-      } else if (aiResponseText) {
-        setMessages(prev => [...prev, { id: `ai-${Date.now()}-single`, sender: 'ai', text: String(aiResponseText) }]);
-      } else {
-        console.warn("TrainingRoom: AI response was empty or null.");
+      if (streamedLines === 0) {
+        // No line events arrived: fall back to splitting the final reply.
+        const individualLines = String(aiResponseText || '').split('\n').map(l => l.trim()).filter(l => l.length > 0);
+        if (individualLines.length > 0) individualLines.forEach(appendAiLine);
+        else console.warn("TrainingRoom: AI response was empty or null.");
       }
     } catch (err) {
       console.error("Error in handleSendMessage (TrainingRoom):", err);
@@ -137,8 +151,7 @@ function TrainingRoom({ selectedCharacter }) {
             .filter(msg => msg.sender === 'user' || msg.sender === 'ai')
             .map(msg => ({ role: msg.sender === 'user' ? 'user' : 'assistant', content: msg.text }));
           
-          const placeholderGoalForFeedback = "對話練習";
-          const feedbackDataFromBackend = await getFeedbackFromBackend(placeholderGoalForFeedback, historyForFeedback, selectedCharacter);
+          const feedbackDataFromBackend = await getFeedbackFromBackend(PRACTICE_GOAL, historyForFeedback, selectedCharacter, () => {}, conversationId);
           
           if (!feedbackDataFromBackend || !feedbackDataFromBackend.userEvaluation) {
             throw new Error("從後端收到的回饋數據格式不正確或為空。");
@@ -188,7 +201,7 @@ function TrainingRoom({ selectedCharacter }) {
           const userMessagesSummary = messages.filter(m => m.sender === 'user').map(m=>m.text).join(' ').substring(0,100);
           const newFeedbackEntry = {
               id: `feedback-${Date.now()}`, timestamp: Date.now(), 
-              goal: placeholderGoalForFeedback, 
+              goal: PRACTICE_GOAL, 
               characterId: selectedCharacter.id, characterName: selectedCharacter.name,
               scores: scoresForStorage,
               summary: userEval.summary || `與 ${selectedCharacter.name} 進行的對話練習。用戶發言摘要: ${userMessagesSummary}...`,
@@ -1,15 +1,22 @@
 import axios from 'axios';
 
 const PYTHON_API_BASE_URL = process.env.REACT_APP_PYTHON_API_URL || 'http://localhost:5001';
+const CHAT_TIMEOUT_MS = 70000;
+const FEEDBACK_TIMEOUT_MS = 180000;
+
+// Tells the backend how long we are still willing to wait, so it can stop (or shorten)
+// the generation instead of finishing a reply nobody will read.
+const deadlineHeaders = (timeoutMs) => ({ 'X-Request-Timeout-Ms': String(timeoutMs) });
 
 // Added 'mode' parameter: "assistant" or "character_play"
-export const sendMessageToOllama = async (goal, messages, character, mode = "character_play") => {
+// conversationId keys the backend's per-conversation summary and per-turn assessments.
+export const sendMessageToOllama = async (goal, messages, character, mode = "character_play", conversationId = null) => {
   const apiUrl = `${PYTHON_API_BASE_URL}/api/chat_py`;
-  const payload = { goal, character, messages, mode }; // Add mode to payload
+  const payload = { goal, character, messages, mode, conversation_id: conversationId }; // Add mode to payload
   console.log(`Sending message to Python backend (/api/chat_py) with mode: ${mode}:`, payload);
 
   try {
-    const response = await axios.post(apiUrl, payload, { timeout: 70000 });
+    const response = await axios.post(apiUrl, payload, { timeout: CHAT_TIMEOUT_MS, headers: deadlineHeaders(CHAT_TIMEOUT_MS) });
     console.log("Python backend response for chat:", response.data);
     if (response.data && response.data.message && typeof response.data.message.content === 'string') {
       return response.data.message.content;
@@ -23,24 +30,127 @@ export const sendMessageToOllama = async (goal, messages, character, mode = "cha
   }
 };
 
-// This service now expects the backend to return an evaluation of THE USER's performance
-export const getFeedbackFromBackend = async (goal, messages, character) => {
+// Assistant mode: one request returns several ranked suggestions (best first) instead of
+// regenerating one at a time. Each candidate is { content, score, issues, seed, temperature }.
+export const getReplyCandidates = async (goal, messages, character, count = 3) => {
+  const apiUrl = `${PYTHON_API_BASE_URL}/api/chat_py`;
+  const payload = { goal, character, messages, mode: "assistant", candidates: count };
+  console.log(`Requesting ${count} reply candidates from Python backend (/api/chat_py):`, payload);
+
+  try {
+    const response = await axios.post(apiUrl, payload, { timeout: CHAT_TIMEOUT_MS, headers: deadlineHeaders(CHAT_TIMEOUT_MS) });
+    if (response.data && Array.isArray(response.data.candidates) && response.data.candidates.length > 0) {
+      return response.data.candidates;
+    } else if (response.data && response.data.error) {
+      throw new Error(`AI 服務錯誤: ${response.data.error}`);
+    } else {
+      throw new Error('從 Python AI 服務收到的回應結構無效 (candidates)');
+    }
+  } catch (error) {
+    handlePythonApiError(error, 'getReplyCandidates');
+  }
+};
+
+// Streaming variant of sendMessageToOllama: the backend answers with NDJSON events,
+// onLine is called with each finished short message as soon as it is generated.
+export const streamMessageFromBackend = async (goal, messages, character, mode = "character_play", onLine = () => {}, conversationId = null) => {
+  const apiUrl = `${PYTHON_API_BASE_URL}/api/chat_py`;
+  const payload = { goal, character, messages, mode, stream: true, conversation_id: conversationId };
+  console.log(`Streaming message from Python backend (/api/chat_py) with mode: ${mode}:`, payload);
+
+  const controller = new AbortController();
+  const timer = setTimeout(() => controller.abort(), CHAT_TIMEOUT_MS);
+  try {
+    const response = await fetch(apiUrl, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', ...deadlineHeaders(CHAT_TIMEOUT_MS) },
+      body: JSON.stringify(payload),
+      signal: controller.signal,
+    });
+    if (!response.ok || !response.body) {
+      const errorBody = await response.json().catch(() => null);
+      throw new Error(errorBody && errorBody.error ? `AI 服務錯誤: ${errorBody.error}` : `AI 服務錯誤 (狀態碼: ${response.status})。`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n');
+      buffer = events.pop();
+      for (const rawEvent of events) {
+        if (!rawEvent.trim()) continue;
+        const event = JSON.parse(rawEvent);
+        if (event.type === 'line') {
+          onLine(event.content, event.index);
+        } else if (event.type === 'done') {
+          return event.message.content;
+        } else if (event.type === 'error') {
+          throw new Error(`AI 服務錯誤: ${event.error}`);
+        }
+      }
+    }
+    throw new Error('從 Python AI 服務收到的串流回應不完整 (chat)');
+  } catch (error) {
+    if (error.name === 'AbortError') throw new Error('連接 AI 服務超時，請稍後再試。');
+    if (error instanceof TypeError) throw new Error('無法連接到 AI 服務。請檢查後端服務是否正在運行以及網路連接是否正常。');
+    throw error;
+  } finally {
+    clearTimeout(timer);
+  }
+};
+
+// A 404 means the job is gone (e.g. the server restarted without a shared job store). Resubmit once with the
+// same payload, which the backend deduplicates by content, so a job still running elsewhere is reused rather
+// than evaluated twice. A second 404 is reported as an error instead of being hidden.
+const pollFeedbackJob = async (job, deadline, onProgress, resubmit) => {
+  let resubmitted = false;
+  while (job.status === 'queued' || job.status === 'running') {
+    if (Date.now() > deadline) throw new Error('AI 服務產生回饋的時間過長，請稍後再試。');
+    try {
+      job = (await axios.get(`${PYTHON_API_BASE_URL}${job.poll_url}`, { params: { wait: 25 }, timeout: 35000 })).data;
+    } catch (error) {
+      if (!error.response || error.response.status !== 404) throw error;
+      if (resubmitted) throw new Error('回饋工作在伺服器上遺失了 (可能已重新啟動)，請再試一次。');
+      console.warn(`Feedback job ${job.job_id} is gone (404), resubmitting it.`);
+      resubmitted = true;
+      job = await resubmit();
+    }
+    if (job.progress) onProgress(job.progress);
+  }
+  return job;
+};
+
+// This service now expects the backend to return an evaluation of THE USER's performance.
+// The evaluation runs as a background job: we submit it in async mode, then long-poll the job
+// until it is done (onProgress receives { generated_tokens, num_predict } while it runs).
+export const getFeedbackFromBackend = async (goal, messages, character, onProgress = () => {}, conversationId = null) => {
   const apiUrl = `${PYTHON_API_BASE_URL}/api/feedback`;
-  const payload = { goal, messages, character }; // messages here are the user-AI character chat
-  console.log("Sending request to Python backend for USER feedback (/api/feedback):", payload);
+  const payload = { goal, messages, character, async: true, conversation_id: conversationId }; // messages here are the user-AI character chat
+  console.log("Submitting USER feedback job to Python backend (/api/feedback):", payload);
+  const deadline = Date.now() + FEEDBACK_TIMEOUT_MS;
+  // The job outlives the submit request; the header carries the remaining polling budget to the background worker.
+  const submit = async () => {
+    const budgetMs = Math.max(deadline - Date.now(), 1000);
+    return (await axios.post(apiUrl, payload, { timeout: 15000, headers: deadlineHeaders(budgetMs) })).data;
+  };
 
   try {
-    const response = await axios.post(apiUrl, payload, { timeout: 90000 });
-    console.log("Python backend response for USER feedback:", response.data);
+    const job = await pollFeedbackJob(await submit(), deadline, onProgress, submit);
+    console.log("Python backend response for USER feedback:", job);
+    if (job.status === 'failed') {
+      throw new Error(`AI 服務錯誤 (使用者回饋): ${job.error}`);
+    }
     // Backend should now return 'userEvaluation' field
-    if (response.data && response.data.userEvaluation) {
+    if (job.result && job.result.userEvaluation) {
       return {
-          userEvaluation: response.data.userEvaluation, // Evaluation of the USER
-          rawFeedback: response.data.raw_feedback,
-          modelUsed: response.data.model
+          userEvaluation: job.result.userEvaluation, // Evaluation of the USER
+          rawFeedback: job.result.raw_feedback,
+          modelUsed: job.result.model
       };
-    } else if (response.data && response.data.error) {
-      throw new Error(`AI 服務錯誤 (使用者回饋): ${response.data.error}`);
     } else {
       throw new Error('從 Python AI 服務收到的回應結構無效 (使用者回饋)');
     }
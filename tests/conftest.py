@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 後端模組直接放在專案根目錄 (不是套件)，測試以 `python -m pytest` 或 `pytest` 執行時都要能 import
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT_DIR, "bench")
+sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,87 @@
+from conversation_memory import ConversationStateStore, RollingSummaryCache, covered_prefix_matches, extend_fingerprints, message_fingerprint
+
+
+def conversation(*contents):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": content} for index, content in enumerate(contents)]
+
+
+MESSAGES = conversation("嗨", "你好", "週末有空嗎", "有啊", "去看電影？", "好")
+
+
+def test_message_fingerprint_depends_on_role_and_content():
+    assert message_fingerprint({"role": "user", "content": "嗨"}) == message_fingerprint({"role": "user", "content": "嗨", "extra": 1})
+    assert message_fingerprint({"role": "user", "content": "嗨"}) != message_fingerprint({"role": "assistant", "content": "嗨"})
+    assert message_fingerprint({"role": "user"}) == message_fingerprint({"role": "user", "content": ""})
+
+
+def test_extend_fingerprints_appends_and_pads_gaps():
+    fingerprints = extend_fingerprints([], 0, MESSAGES[:2])
+    assert fingerprints == [message_fingerprint(message) for message in MESSAGES[:2]]
+    assert extend_fingerprints(fingerprints, 4, MESSAGES[4:5]) == fingerprints + [None, None, message_fingerprint(MESSAGES[4])]
+    assert extend_fingerprints(fingerprints, 1, MESSAGES[3:4]) == fingerprints[:1] + [message_fingerprint(MESSAGES[3])]
+
+
+def test_covered_prefix_matches_same_conversation():
+    fingerprints = extend_fingerprints([], 0, MESSAGES[:4])
+    assert covered_prefix_matches(fingerprints, MESSAGES, 0)
+    assert covered_prefix_matches(fingerprints, MESSAGES[:4], 0)
+    assert covered_prefix_matches([], [], 0)
+
+
+def test_covered_prefix_rejects_shorter_or_different_conversation():
+    fingerprints = extend_fingerprints([], 0, MESSAGES[:4])
+    assert not covered_prefix_matches(fingerprints, MESSAGES[:3], 0)
+    # 另一段同 key 的對話：最後一則相同，但前面不同 (只比對最後一則會誤判為同一段)
+    other = conversation("哈囉", "你好", "週末有空嗎", "有啊")
+    assert not covered_prefix_matches(fingerprints, other, 0)
+    edited = MESSAGES[:1] + [{"role": "assistant", "content": "改過"}] + MESSAGES[2:]
+    assert not covered_prefix_matches(fingerprints, edited, 0)
+
+
+def test_covered_prefix_with_trimmed_history():
+    fingerprints = extend_fingerprints([], 0, MESSAGES[:4])
+    # session 裁切後只送來絕對位置 2 之後的訊息：只比對重疊的部分
+    assert covered_prefix_matches(fingerprints, MESSAGES[2:], 2)
+    assert not covered_prefix_matches(fingerprints, conversation("x", "y", "z", "w")[2:], 2)
+    # 當時不在請求中的訊息 (None) 不比對
+    assert covered_prefix_matches(extend_fingerprints([], 2, MESSAGES[2:4]), conversation("x", "y") + MESSAGES[2:], 0)
+
+
+def summarize(previous, new_messages):
+    return " / ".join(filter(None, [previous] + [message["content"] for message in new_messages]))
+
+
+def test_summary_cache_never_reuses_another_conversations_summary():
+    cache = RollingSummaryCache(summarize)
+    assert cache.get_digest("character|goal", MESSAGES, upto=4, wait_timeout=5) == ("嗨 / 你好 / 週末有空嗎 / 有啊", 4)
+    other = conversation("哈囉", "你好", "週末有空嗎", "有啊", "吃飯？")
+    summary, covered = cache.get_digest("character|goal", other, upto=2, wait_timeout=5)
+    assert "嗨" not in summary and covered == 2
+    assert cache.get_digest("character|goal", MESSAGES[:2], upto=0) == ("", 0)
+
+
+def test_summary_cache_summarizes_only_new_messages():
+    batches = []
+    cache = RollingSummaryCache(lambda previous, new_messages: batches.append(len(new_messages)) or summarize(previous, new_messages))
+    cache.get_digest("key", MESSAGES[:4], upto=2, wait_timeout=5)
+    cache.get_digest("key", MESSAGES, upto=4, wait_timeout=5)
+    assert batches == [2, 2]
+
+
+def test_summary_shared_through_store_and_invalidated_there_too(tmp_path):
+    path = str(tmp_path / "state.db")
+    first = RollingSummaryCache(summarize, store=ConversationStateStore(path, "conversation_summaries"))
+    first.get_digest("key", MESSAGES, upto=4, wait_timeout=5)
+    second = RollingSummaryCache(lambda *args: "should not run", store=ConversationStateStore(path, "conversation_summaries"))
+    assert second.get_digest("key", MESSAGES, upto=4) == ("嗨 / 你好 / 週末有空嗎 / 有啊", 4)
+    third = RollingSummaryCache(summarize, store=ConversationStateStore(path, "conversation_summaries"))
+    assert third.get_digest("key", conversation("別的", "對話"), upto=0) == ("", 0)
+
+
+def test_state_store_expires_entries(tmp_path):
+    store = ConversationStateStore(str(tmp_path / "state.db"), "turn_assessments", ttl_seconds=60)
+    store.save("fresh", {"covered": 1}, updated_at=10_000_000_000)
+    store.save("stale", {"covered": 1}, updated_at=1.0)
+    assert store.load("fresh") == {"covered": 1, "updated_at": 10_000_000_000}
+    assert store.load("fresh", newer_than=10_000_000_000) is None
+    assert store.load("stale") is None
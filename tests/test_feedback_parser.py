@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import sys
+
+import pytest
+
+from conftest import BENCH_DIR
+from feedback_parser import SCORE_CATEGORIES, StructuredFeedbackStream, parse_feedback_text, parse_legacy_feedback, parse_turn_assessment, validate_structured_feedback
+
+sys.path.insert(0, BENCH_DIR)
+import legacy_feedback_parser  # noqa: E402
+
+with open(os.path.join(BENCH_DIR, "feedback_corpus.jsonl"), encoding="utf-8") as f:
+    CORPUS = [json.loads(line) for line in f if line.strip()]
+
+STRUCTURED = {
+    "summary": "  表現積極，邀約略顯急躁。 ",
+    "scores": {key: {"score": 70 + index, "justification": f"理由 {key}"} for index, key in enumerate(SCORE_CATEGORIES)},
+    "strengths": ["能延續話題", "  "],
+    "improvements": ["多問開放式問題"],
+}
+
+
+@pytest.mark.parametrize("sample", [sample for sample in CORPUS if sample["format"] == "legacy"], ids=lambda sample: sample["text"][:12])
+def test_legacy_text_matches_legacy_parser(sample):
+    logging.disable(logging.CRITICAL)
+    try:
+        expected = legacy_feedback_parser.parse_user_feedback_from_llm(sample["text"])
+    finally:
+        logging.disable(logging.NOTSET)
+    assert parse_legacy_feedback(sample["text"])[0] == expected
+    assert parse_feedback_text(sample["text"])[0] == expected
+
+
+def test_validate_structured_feedback_cleans_fields():
+    feedback, problems = validate_structured_feedback(STRUCTURED)
+    assert problems == []
+    assert feedback["summary"] == "表現積極，邀約略顯急躁。"
+    assert feedback["scores"]["clarity"] == {"score": 70, "justification": "理由 clarity"}
+    assert feedback["strengths"] == ["能延續話題"]
+
+
+def test_validate_structured_feedback_reports_problems():
+    data = {"summary": "", "scores": {"clarity": {"score": "150"}, "empathy": {"score": True}, "confidence": "80"}, "strengths": "只有一點"}
+    feedback, problems = validate_structured_feedback(data)
+    assert feedback["scores"]["clarity"] == {"score": 100, "justification": "AI 未提供"}
+    assert feedback["scores"]["empathy"]["score"] is None
+    assert feedback["strengths"] == ["只有一點"]
+    assert feedback["improvements"] == ["AI 未提供具體建議"]
+    assert problems == ["summary", "scores.empathy.score", "scores.confidence", "scores.appropriateness", "scores.goalAchievement", "improvements"]
+    assert validate_structured_feedback([])[1] == ["top-level value is not an object"]
+
+
+def test_parse_feedback_text_detects_json():
+    feedback, problems = parse_feedback_text("\n" + json.dumps(STRUCTURED, ensure_ascii=False))
+    assert problems == [] and feedback["scores"]["goalAchievement"]["score"] == 74
+
+
+def test_parse_turn_assessment_keeps_valid_scores_only():
+    raw = json.dumps({"scores": {"clarity": {"score": 80, "justification": " 清楚 "}, "empathy": {"score": "x"}}, "strengths": ["主動"], "improvements": []})
+    assessment, problems = parse_turn_assessment(raw)
+    assert assessment == {"scores": {"clarity": {"score": 80, "justification": "清楚"}}, "strengths": ["主動"], "improvements": []}
+    assert problems == [f"scores.{key}" for key in SCORE_CATEGORIES if key != "clarity"]
+
+
+@pytest.mark.parametrize("raw", ["not json", "[1, 2]", '{"scores": {}}'])
+def test_parse_turn_assessment_without_scores_returns_none(raw):
+    assert parse_turn_assessment(raw)[0] is None
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_stream_yields_each_top_level_field_once(chunk_size):
+    text = json.dumps(STRUCTURED, ensure_ascii=False, indent=2)
+    stream = StructuredFeedbackStream()
+    completed = []
+    for start in range(0, len(text), chunk_size): completed.extend(stream.feed(text[start:start + chunk_size]))
+    assert [key for key, _ in completed] == ["summary", "scores", "strengths", "improvements"]
+    assert dict(completed) == STRUCTURED
+    assert stream.finish() == validate_structured_feedback(STRUCTURED)
+
+
+def test_stream_handles_braces_and_quotes_inside_strings():
+    data = {"summary": 'He said "{not, a field}" \\ ok', "scores": {}, "strengths": ["[a, b]"], "improvements": ["}"]}
+    stream = StructuredFeedbackStream()
+    completed = [field for char in json.dumps(data, ensure_ascii=False) for field in stream.feed(char)]
+    assert dict(completed) == data
+
+
+def test_stream_truncated_output_uses_completed_fields():
+    text = json.dumps(STRUCTURED, ensure_ascii=False)
+    stream = StructuredFeedbackStream()
+    stream.feed(text[:text.index('"strengths"') + 5])
+    feedback, problems = stream.finish()
+    assert feedback["summary"] == STRUCTURED["summary"].strip()
+    assert problems == ["strengths", "improvements"]
+
+
+def test_stream_falls_back_to_legacy_text():
+    legacy = next(sample["text"] for sample in CORPUS if sample["format"] == "legacy")
+    stream = StructuredFeedbackStream()
+    stream.feed(legacy)
+    assert stream.finish() == parse_legacy_feedback(legacy)
@@ -0,0 +1,101 @@
+from conversation_memory import ConversationStateStore
+from feedback_parser import SCORE_CATEGORIES
+from incremental_feedback import TurnAssessmentCache, merge_turn_assessments
+
+
+def conversation(*contents):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": content} for index, content in enumerate(contents)]
+
+
+def assessment(score, strengths=(), improvements=(), justification="理由"):
+    return {"scores": {key: {"score": score, "justification": justification} for key in SCORE_CATEGORIES},
+            "strengths": list(strengths), "improvements": list(improvements)}
+
+
+def fake_assess(context, previous_messages, new_messages):
+    return assessment(10 * len(new_messages), strengths=[message["content"] for message in new_messages if message["role"] == "user"])
+
+
+def test_merge_weights_scores_by_user_messages():
+    turns = [dict(assessment(60, justification="舊"), user_messages=1), dict(assessment(90, justification="新"), user_messages=2)]
+    feedback = merge_turn_assessments(turns)
+    assert feedback["scores"]["clarity"] == {"score": 80, "justification": "新"}
+    assert feedback["summary"] == "AI 未能提供整體總結。"
+
+
+def test_merge_skips_missing_scores_and_keeps_latest_justification():
+    turns = [dict(assessment(50, justification="有理由"), user_messages=1),
+             {"scores": {"clarity": {"score": 70, "justification": ""}}, "user_messages": 1}]
+    feedback = merge_turn_assessments(turns)
+    assert feedback["scores"]["clarity"] == {"score": 60, "justification": "有理由"}
+    assert feedback["scores"]["empathy"] == {"score": 50, "justification": "有理由"}
+
+
+def test_merge_dedups_items_newest_first():
+    turns = [assessment(50, strengths=["主動開話題", "語氣自然"]), assessment(50, strengths=["主動 開話題！", "有回應情緒"]), assessment(50, strengths=["懂得收尾"])]
+    feedback = merge_turn_assessments(turns, max_items=3)
+    assert feedback["strengths"] == ["懂得收尾", "主動 開話題！", "有回應情緒"]
+    assert feedback["improvements"] == ["AI 未提供具體建議"]
+
+
+def test_merge_without_turns_is_empty_feedback():
+    feedback = merge_turn_assessments([])
+    assert all(item["score"] is None for item in feedback["scores"].values())
+
+
+def test_collect_covers_observed_conversation():
+    cache = TurnAssessmentCache(fake_assess)
+    messages = conversation("嗨", "你好", "週末有空嗎", "有啊")
+    cache.observe("conversation-1", messages[:2])
+    turns, complete = cache.collect("conversation-1", messages, wait_timeout=5)
+    assert complete
+    assert [(turn["start"], turn["end"], turn["user_messages"]) for turn in turns] == [(0, 2, 1), (2, 4, 1)]
+
+
+def test_collect_unknown_conversation():
+    assert TurnAssessmentCache(fake_assess).collect("never-seen", conversation("嗨")) == (None, False)
+
+
+def test_never_merges_another_conversations_assessments():
+    # 回歸測試：同 key 的短對話曾經拿到長對話全部的評估，而且 complete=True
+    cache = TurnAssessmentCache(fake_assess)
+    long_conversation = conversation(*[f"第 {index} 句" for index in range(10)])
+    cache.observe("character|goal", long_conversation)
+    assert cache.collect("character|goal", long_conversation, wait_timeout=5)[1]
+    short_conversation = conversation("完全不同的開場", "嗯")
+    assert cache.collect("character|goal", short_conversation, wait_timeout=5) == (None, False)
+    same_length_other = conversation(*[f"另一段 {index}" for index in range(9)], "第 9 句")
+    assert cache.collect("character|goal", same_length_other, wait_timeout=5) == (None, False)
+
+
+def test_edited_conversation_is_reassessed():
+    cache = TurnAssessmentCache(fake_assess)
+    messages = conversation("嗨", "你好", "週末有空嗎", "有啊")
+    cache.observe("key", messages)
+    cache.collect("key", messages, wait_timeout=5)
+    edited = messages[:2] + conversation("改成吃飯？", "好")
+    cache.observe("key", edited)
+    turns, complete = cache.collect("key", edited, wait_timeout=5)
+    assert complete and [turn["strengths"] for turn in turns] == [["嗨", "改成吃飯？"]]
+
+
+def test_assistant_only_messages_advance_without_assessing():
+    calls = []
+    cache = TurnAssessmentCache(lambda *args: calls.append(args) or assessment(50))
+    messages = [{"role": "assistant", "content": "歡迎"}]
+    cache.observe("key", messages)
+    assert cache.collect("key", messages) == ([], True)
+    assert calls == []
+
+
+def test_shared_store_rejects_other_conversation(tmp_path):
+    path = str(tmp_path / "state.db")
+    messages = conversation("嗨", "你好", "週末有空嗎", "有啊")
+    first = TurnAssessmentCache(fake_assess, store=ConversationStateStore(path, "turn_assessments"))
+    first.observe("key", messages)
+    first.collect("key", messages, wait_timeout=5)
+    second = TurnAssessmentCache(lambda *args: None, store=ConversationStateStore(path, "turn_assessments"))
+    turns, complete = second.collect("key", messages)
+    assert complete and len(turns) == 1
+    third = TurnAssessmentCache(fake_assess, store=ConversationStateStore(path, "turn_assessments"))
+    assert third.collect("key", conversation("別人的", "對話")) == (None, False)
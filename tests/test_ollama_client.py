@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+import requests
+
+from ollama_client import ModelConcurrencyLimiter, NoHealthyBackendError, OllamaClient, OllamaOverloadedError, OllamaRouter
+
+URLS = ["http://ollama-a:11434", "http://ollama-b:11434", "http://ollama-c:11434"]
+
+
+def test_router_keeps_affinity_key_on_one_backend():
+    router = OllamaRouter(URLS)
+    chosen = set()
+    for _ in range(5):
+        backend = router.acquire("character-1|conversation-1")
+        chosen.add(backend.url)
+        router.release(backend, 0.1, ok=True)
+    assert len(chosen) == 1
+
+
+def test_router_leaves_affinity_backend_when_it_is_much_busier():
+    router = OllamaRouter(URLS, affinity_slack=1)
+    preferred = router.acquire("key")
+    assert router.acquire("key") is preferred  # 多 1 個進行中仍在 slack 內
+    assert router.acquire("key") is not preferred
+
+
+def test_router_spreads_requests_without_affinity_key():
+    router = OllamaRouter(URLS)
+    assert len({router.acquire().url for _ in URLS}) == len(URLS)
+
+
+def test_router_ejects_backend_after_consecutive_failures():
+    router = OllamaRouter(URLS[:2], max_failures=2, eject_seconds=60)
+    failing = router.backends[0]
+    for _ in range(2):
+        failing.in_flight += 1
+        router.release(failing, 0.0, ok=False)
+    assert all(router.acquire("any") is router.backends[1] for _ in range(3))
+    assert [snapshot["healthy"] for snapshot in router.stats()] == [False, True]
+
+
+def test_router_success_resets_failure_count():
+    router = OllamaRouter(URLS[:1], max_failures=2)
+    backend = router.backends[0]
+    for ok in (False, True, False):
+        backend.in_flight += 1
+        router.release(backend, 0.0, ok=ok)
+    assert backend.consecutive_failures == 1 and backend.is_healthy(0.0)
+
+
+def test_router_excluding_every_backend_raises():
+    router = OllamaRouter(URLS[:2])
+    with pytest.raises(NoHealthyBackendError):
+        router.acquire(exclude=router.backends)
+
+
+def test_limiter_rejects_when_waiting_queue_is_full():
+    limiter = ModelConcurrencyLimiter(max_in_flight=1, max_waiting=0, wait_timeout=1, retry_after=7)
+    with limiter.slot("llama3"):
+        with pytest.raises(OllamaOverloadedError) as excinfo:
+            with limiter.slot("llama3"): pass
+    assert excinfo.value.retry_after == 7
+    assert limiter.stats()["llama3"]["rejected_queue_full"] == 1
+    with limiter.slot("llama3"): pass  # 名額歸還後可以再取得
+
+
+def test_limiter_times_out_waiting_request():
+    limiter = ModelConcurrencyLimiter(max_in_flight=1, max_waiting=4, wait_timeout=0.05, retry_after=1)
+    with limiter.slot("llama3"):
+        with pytest.raises(OllamaOverloadedError):
+            with limiter.slot("llama3"): pass
+    stats = limiter.stats()["llama3"]
+    assert stats["rejected_timeout"] == 1 and stats["waiting"] == 0
+
+
+def test_limiter_admits_waiter_when_slot_is_released():
+    limiter = ModelConcurrencyLimiter(max_in_flight=1, max_waiting=4, wait_timeout=5, retry_after=1)
+    admitted = threading.Event()
+
+    def waiter():
+        with limiter.slot("llama3"): admitted.set()
+
+    with limiter.slot("llama3"):
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        assert not admitted.wait(0.05)
+    thread.join(5)
+    assert admitted.is_set()
+    assert limiter.stats()["llama3"]["admitted"] == 2
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc_info): return False
+
+
+class FakeSession:
+    def __init__(self, down_urls):
+        self.down_urls = down_urls
+        self.posted = []
+
+    def post(self, url, **kwargs):
+        self.posted.append(url)
+        if any(url.startswith(down) for down in self.down_urls): raise requests.exceptions.ConnectionError(url)
+        return FakeResponse()
+
+
+def test_client_fails_over_to_next_backend_on_connection_error():
+    client = OllamaClient(URLS[:2])
+    preferred = client.router.acquire("key")
+    client.router.release(preferred, 0.0, ok=True)
+    down = preferred.url
+    client.session = FakeSession([down])
+    with client.post("/api/generate", {"prompt": "hi"}, timeout=1, affinity_key="key") as response:
+        assert response.ollama_backend_url != down
+    assert [url.startswith(down) for url in client.session.posted] == [True, False]
+    assert all(backend.in_flight == 0 for backend in client.router.backends)
+
+
+def test_client_raises_when_every_backend_refuses_connection():
+    client = OllamaClient(URLS[:2])
+    client.session = FakeSession(URLS[:2])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        with client.post("/api/generate", {}, timeout=1): pass
+    assert [backend.failures_total for backend in client.router.backends] == [1, 1]
@@ -0,0 +1,96 @@
+import pytest
+
+from prompt_budget import TokenCounter, estimate_tokens, pack_history, token_report
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", 0),
+    ("你好嗎", 3),
+    ("hello world", 2),
+    ("internationalization", 4),  # 20 個字母 → ceil(20 / 6)
+    ("12345", 2),
+    ("<|start_header_id|>user<|end_header_id|>", 3),
+    ("好啊！", 3),
+])
+def test_estimate_tokens(text, expected):
+    assert estimate_tokens(text) == expected
+
+
+def test_pack_history_keeps_everything_that_fits():
+    assert pack_history([10, 10, 10], budget=100) == 0
+
+
+def test_pack_history_drops_oldest_messages_over_budget():
+    assert pack_history([30, 10, 10], budget=25) == 1
+    assert pack_history([30, 10, 10], budget=20) == 1
+    assert pack_history([30, 10, 10], budget=19) == 2
+
+
+def test_pack_history_always_keeps_latest_messages():
+    assert pack_history([5, 100], budget=50) == 1
+    assert pack_history([5, 5, 100], budget=50, min_messages=2) == 1
+
+
+def test_pack_history_rounds_start_up_to_compaction_step():
+    assert pack_history([5] * 10, budget=22, compaction_step=4) == 8
+
+
+def test_pack_history_start_only_moves_in_steps():
+    starts = [pack_history([5] * count, budget=22, compaction_step=4) for count in range(1, 20)]
+    assert starts == sorted(starts)
+    assert {start % 4 for start in starts} == {0}  # 兩次跳動之間起點 (prompt 前綴) 不變
+
+
+def test_counter_caches_per_model_and_text():
+    calls = []
+
+    def tokenize(model, text):
+        calls.append((model, text)); return 42
+
+    counter = TokenCounter(tokenize)
+    assert counter.count("你好", "llama3") == 42 and counter.count("你好", "llama3") == 42
+    assert counter.count("你好", "other") == 42
+    assert counter.count("") == 0
+    assert calls == [("llama3", "你好"), ("other", "你好")]
+    stats = counter.stats()
+    assert (stats["hits"], stats["misses"], stats["remote_calls"], stats["exact"]) == (1, 2, 2, True)
+
+
+def test_counter_falls_back_to_estimate_and_retries_later():
+    def tokenize(model, text):
+        raise ConnectionError("no /api/tokenize")
+
+    counter = TokenCounter(tokenize, retry_seconds=60)
+    assert counter.count("你好嗎", "llama3") == 3
+    assert counter.count("再一句", "llama3") == 3
+    stats = counter.stats()
+    assert (stats["remote_calls"], stats["remote_failures"], stats["exact"]) == (1, 1, False)
+    counter._remote_failed_at -= 60
+    assert counter.exact()
+
+
+def test_counter_evicts_least_recently_used():
+    counter = TokenCounter(max_entries=2)
+    for text in ("a", "b", "a", "c"): counter.count(text)
+    counter.count("a"); counter.count("b")
+    assert counter.stats()["hits"] == 2  # "a" 兩次命中，"b" 已被擠出
+
+
+def test_calibration_scales_estimates_only():
+    counter = TokenCounter(calibration_alpha=0.5)
+    assert counter.count("你好嗎你好嗎", "llama3") == 6
+    counter.calibrate("llama3", "你好嗎你好嗎", 12)
+    assert counter.count("你好嗎你好嗎", "llama3") == 12
+    counter.calibrate("llama3", "你好嗎你好嗎", 100)  # 比例限制在 2 倍以內
+    assert counter.stats()["scale"] == {"llama3": 2.0}
+    assert counter.count("你好嗎你好嗎", "other") == 6
+
+    exact = TokenCounter(lambda model, text: 5)
+    exact.calibrate("llama3", "你好嗎", 50)
+    assert exact.stats()["calibrations"] == 0
+
+
+def test_token_report_omits_empty_fragments():
+    report = token_report(100, True, {"system": 40, "summary": 0, "history": 70}, history_messages=6, dropped_messages=2)
+    assert report == {"total": 110, "budget": 100, "over_budget": True, "exact": True, "fragments": {"system": 40, "history": 70},
+                      "history_messages": 6, "dropped_messages": 2}
@@ -0,0 +1,63 @@
+import logging
+import sys
+
+import pytest
+
+from conftest import BENCH_DIR
+from reply_postprocess import LINE_STYLE, PROFILES, STRICT_LINE_STYLE, StreamingPostProcessor
+
+sys.path.insert(0, BENCH_DIR)
+import legacy_postprocess  # noqa: E402
+from postprocess_benchmark import SAMPLE_REPLIES  # noqa: E402
+
+REPLIES = SAMPLE_REPLIES + [
+    "", "   ", "\\n\\n", "「」（）", "話翼：「」", "Okay, here's my reply: 嗯\\n好",
+    "{\"reply\": \"好\"}", "你：你好，我是You。\r\n\r\n第二行,還有;分號", "AI\n\n\n好\\r\\n喔",
+]
+STREAMABLE = [reply for reply in REPLIES if "{" not in reply and LINE_STYLE.clean(reply)]
+
+
+@pytest.fixture(autouse=True)
+def quiet_legacy_logging():
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize("reply", REPLIES)
+def test_line_style_matches_legacy(reply):
+    assert LINE_STYLE.apply(reply) == legacy_postprocess.post_process_line_style_reply(reply)
+
+
+@pytest.mark.parametrize("reply", REPLIES)
+def test_strict_line_style_matches_legacy(reply):
+    assert STRICT_LINE_STYLE.apply(reply) == legacy_postprocess.post_process_reply(reply)
+
+
+def test_profiles_are_registered_by_name():
+    assert PROFILES == {"line_style": LINE_STYLE, "strict_line_style": STRICT_LINE_STYLE}
+
+
+def test_count_punctuation_counts_translated_characters():
+    assert LINE_STYLE.count_punctuation("好啊，「真的」；嗯。") == 3
+    assert STRICT_LINE_STYLE.count_punctuation("好啊，「真的」；嗯。") == 5
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 1000])
+@pytest.mark.parametrize("reply", STREAMABLE)
+def test_streaming_matches_whole_reply(reply, chunk_size):
+    for profile in (LINE_STYLE, STRICT_LINE_STYLE):
+        processor = StreamingPostProcessor(profile)
+        lines = []
+        for start in range(0, len(reply), chunk_size): lines.extend(processor.feed(reply[start:start + chunk_size]))
+        lines.extend(processor.finish())
+        assert "\n".join(lines) == profile.clean(reply)
+        assert processor.raw_text == reply
+
+
+def test_streaming_holds_back_split_line_break():
+    processor = StreamingPostProcessor(LINE_STYLE)
+    assert processor.feed("AI：好啊\\") == []
+    assert processor.pending == "AI：好啊\\"
+    assert processor.feed("n想去哪") == ["好啊"]
+    assert processor.finish() == ["想去哪"]
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from single_flight import AsyncSingleFlight, CoalescingCounters, SingleFlight, coalescing_key
+
+
+def test_coalescing_key_ignores_dict_order_but_not_values():
+    assert coalescing_key("/api/generate", {"a": 1, "b": [1, 2]}) == coalescing_key("/api/generate", {"b": [1, 2], "a": 1})
+    assert coalescing_key("/api/generate", {"a": 1}) != coalescing_key("/api/chat", {"a": 1})
+    assert coalescing_key("/api/generate", {"a": 1}) != coalescing_key("/api/generate", {"a": 2})
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda index=index: results.__setitem__(index, target())) for index in range(count)]
+    for thread in threads: thread.start()
+    return threads, results
+
+
+def test_do_shares_one_call_between_concurrent_callers():
+    flight = SingleFlight()
+    release, calls = threading.Event(), []
+
+    def fn():
+        calls.append(1); release.wait(5); return "reply"
+
+    threads, results = run_concurrently(4, lambda: flight.do("key", fn))
+    while flight.stats()["coalesced_calls"] < 3: time.sleep(0.01)
+    release.set()
+    for thread in threads: thread.join(5)
+    assert len(calls) == 1
+    assert sorted(results, key=lambda result: result[1]) == [("reply", False)] + [("reply", True)] * 3
+    stats = flight.stats()
+    assert (stats["calls"], stats["coalesced_calls"], stats["in_flight_calls"]) == (1, 3, 0)
+
+
+def test_do_propagates_error_to_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5); raise RuntimeError("ollama down")
+
+    def call():
+        try: return flight.do("key", fn)
+        except RuntimeError as e: return str(e)
+
+    threads, results = run_concurrently(3, call)
+    while flight.stats()["coalesced_calls"] < 2: time.sleep(0.01)
+    release.set()
+    for thread in threads: thread.join(5)
+    assert results == ["ollama down"] * 3
+    assert flight.do("key", lambda: "retry") == ("retry", False)  # 失敗的呼叫不會留下來
+
+
+def test_stream_replays_earlier_chunks_to_late_subscriber():
+    flight = SingleFlight()
+    first, shared = flight.stream("key", lambda: iter(["a", "b", "c"]))
+    assert not shared and next(first) == "a"
+    second, shared = flight.stream("key", lambda: pytest.fail("upstream started twice"))
+    assert shared
+    assert list(second) == ["a", "b", "c"]
+    assert list(first) == ["b", "c"]
+    assert flight.stats()["in_flight_streams"] == 0
+
+
+def test_stream_finished_upstream_is_not_replayed_to_new_request():
+    flight = SingleFlight()
+    assert list(flight.stream("key", lambda: iter(["a"]))[0]) == ["a"]
+    assert flight.stream("key", lambda: iter(["b"]))[1] is False
+
+
+def test_stream_closes_upstream_when_last_subscriber_leaves():
+    closed = []
+
+    def upstream():
+        try: yield from ("a", "b", "c")
+        finally: closed.append(True)
+
+    flight = SingleFlight()
+    first, _ = flight.stream("key", upstream)
+    second, _ = flight.stream("key", upstream)
+    assert next(first) == "a" and next(second) == "a"
+    first.close()
+    assert closed == []
+    second.close()
+    assert closed == [True]
+    assert flight.stats()["cancelled_streams"] == 1
+
+
+def test_stream_error_reaches_every_subscriber():
+    def upstream():
+        yield "a"
+        raise ConnectionError("reset")
+
+    flight = SingleFlight()
+    first, _ = flight.stream("key", upstream)
+    second, _ = flight.stream("key", upstream)
+    for subscriber in (first, second):
+        assert next(subscriber) == "a"
+        with pytest.raises(ConnectionError): next(subscriber)
+
+
+def test_counters_are_shared_between_flights():
+    counters = CoalescingCounters()
+    SingleFlight(counters).do("a", lambda: 1)
+    asyncio.run(AsyncSingleFlight(counters).do("b", lambda: asyncio.sleep(0, 2)))
+    assert SingleFlight(counters).stats()["calls"] == 2
+
+
+def test_async_do_shares_result_and_cancels_upstream_without_waiters():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        started, cancelled = asyncio.Event(), []
+
+        async def generate():
+            started.set()
+            try: await asyncio.sleep(5)
+            except asyncio.CancelledError: cancelled.append(True); raise
+            return "reply"
+
+        async def quick():
+            await asyncio.sleep(0)
+            return "reply"
+
+        results = await asyncio.gather(flight.do("shared", quick), flight.do("shared", quick))
+        waiters = [asyncio.ensure_future(flight.do("slow", generate)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters: waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return results, cancelled, flight.stats()
+
+    results, cancelled, stats = asyncio.run(scenario())
+    assert results == [("reply", False), ("reply", True)]
+    assert cancelled == [True]
+    assert stats["cancelled_calls"] == 1 and stats["in_flight_calls"] == 0
+
+
+def test_async_stream_shares_upstream():
+    async def scenario():
+        flight, starts = AsyncSingleFlight(), []
+
+        async def upstream():
+            starts.append(1)
+            for chunk in ("a", "b"):
+                await asyncio.sleep(0)
+                yield chunk
+
+        async def consume():
+            iterator, shared = flight.stream("key", upstream)
+            return [chunk async for chunk in iterator], shared
+
+        return await asyncio.gather(consume(), consume()), starts
+
+    results, starts = asyncio.run(scenario())
+    assert results == [(["a", "b"], False), (["a", "b"], True)]
+    assert starts == [1]